@@ -17,18 +17,127 @@
 # You should have received a copy of the GNU General Public License
 # along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
 
+# Conversions commonly used in brewing: between SG, Plato and Brix for
+# gravity, and between F and C for temperatures. Every conversion is a
+# plain function of its value using arithmetic only, so the same function
+# converts a number or a whole NumPy array in one call. Nothing is kept
+# between calls, so conversions are safe from any thread.
 
-import math
+import time
+import numpy as np
+
+GRAVITY_UNITS = ['sg', 'plato', 'brix']
+TEMPERATURE_UNITS = ['c', 'f']
+
+
+def sgToBrix(sg):
+    return ((182.4601 * sg - 775.6821) * sg + 1262.7794) * sg - 669.5622
+
+
+def sgToPlato(sg):
+    return ((135.997 * sg - 630.272) * sg + 1111.14) * sg - 616.868
+
+
+def platoToSg(plato):
+    return 1 + (plato / (258.6 - ((plato / 258.2) * 227.1)))
+
+
+def platoToBrix(plato):
+    return plato * 1.04
+
+
+def brixToSg(brix):
+    return (brix / (258.6 - ((brix / 258.2) * 227.1))) + 1
+
+
+def brixToPlato(brix):
+    return brix / 1.04
+
+
+def cToF(c):
+    return c * 9 / 5 + 32
+
+
+def fToC(f):
+    return (f - 32) * 5 / 9
+
+
+def identity(value):
+    return value
+
+
+# (original, target): function
+CONVERSIONS = {
+    ('sg', 'brix'): sgToBrix,
+    ('sg', 'plato'): sgToPlato,
+    ('plato', 'sg'): platoToSg,
+    ('plato', 'brix'): platoToBrix,
+    ('brix', 'sg'): brixToSg,
+    ('brix', 'plato'): brixToPlato,
+    ('c', 'f'): cToF,
+    ('f', 'c'): fToC,
+}
+for unit in GRAVITY_UNITS + TEMPERATURE_UNITS:
+    CONVERSIONS[(unit, unit)] = identity
+
+
+def converter(original, target):
+    """
+    Returns the function converting between two units, None if there is
+    none
+
+    Params:
+    original: Unit of the values, e.g. sg, plato, brix, f or c
+    target: Unit to convert to
+    """
+    return CONVERSIONS.get((str(original).lower(), str(target).lower()))
+
+
+def convert(value, original='plato', target='sg'):
+    """
+    Converts a value between units
+
+    Params:
+    value: Value to be converted
+    original: Unit of the value (e.g. sg, plato, brix, f or c)
+    target: Unit to return (e.g. sg, plato, brix, f or c)
+
+    Returns:
+    Converted value, or 0 if the units are invalid
+    """
+    function = converter(original, target)
+    if function is None:
+        return 0
+    return function(value)
+
+
+def convertArray(values, original='plato', target='sg'):
+    """
+    Converts a sequence of values between units in one go
+
+    Params:
+    values: Sequence or NumPy array of numbers, NaN stays NaN
+    original: Unit of the values (e.g. sg, plato, brix, f or c)
+    target: Unit to return (e.g. sg, plato, brix, f or c)
+
+    Returns:
+    NumPy array of float64, or None if the units are invalid
+    """
+    function = converter(original, target)
+    if function is None:
+        return None
+    return np.array(function(np.asarray(values, dtype=np.float64)), dtype=np.float64)
 
 
 class BrewConvert():
+    """
+    Conversions as methods, for existing callers. Holds no state.
+    """
+
     def convert(self, value, original='plato', target='sg'):
         """
         Dispatch method for brew conversions.
 
-        Conversions commonly used in brewing. Between SG, Plato, and Brix for
-        gravity measurements; and F and C for temperatures.
-
         Parameters:
             value (float):      Value to be converted
             original (string):  Type of measurement being passed (e.g. sg,
@@ -39,68 +148,30 @@ class BrewConvert():
         Returns:
             float:  Converted value, or 0 if parameters are invalid
         """
-        self.value = value
-        self.original = original.lower()
-        self.target = target.lower()
-
-        method_name = 'from_{0}'.format(str(self.original))
-        # Concatenate the target method from 'self'
-        method = getattr(self, method_name, lambda: 0)
-        return method()
-
-    def from_sg(self):
-        sg = self.value
-        if self.target == 'brix':
-            brix = (((182.4601 * sg - 775.6821) * sg + 1262.7794) * sg - 669.5622)
-            return brix
-        if self.target == 'plato':
-            plato = (-1 * 616.868) + (1111.14 * sg) - (630.272 * math.pow(sg, 2)) + (135.997 * math.pow(sg, 3))
-            return plato
-        if self.target == 'sg':
-            return sg
-        return 0
-
-    def from_brix(self):
-        brix = self.value
-        if self.target == 'sg':
-            sg = (brix / (258.6-((brix / 258.2) * 227.1))) + 1
-            return sg
-        if self.target == 'plato':
-            plato = brix / 1.04
-            return plato
-        if self.target == 'brix':
-            return brix
-        return 0
-
-    def from_plato(self):
-        plato = self.value
-        if self.target == 'brix':
-            brix = plato * 1.04
-            return brix
-        if self.target == 'sg':
-            sg = 1 + (plato / (258.6 - ((plato / 258.2) * 227.1)))
-            return sg
-        if self.target == 'plato':
-            return plato
-        return 0
+        return convert(value, original, target)
 
-    def from_c(self):
-        if self.target == 'f':
-            c = self.value
-            f = c * 9/5 + 32
-            return f
-        if self.target == 'c':
-            return c
-        return 0
-
-    def from_f(self):
-        if self.target == 'c':
-            f = self.value
-            c = (f - 32) * 5/9
-            return c
-        if self.target == 'f':
-            return f
-        return 0
+    def convertArray(self, values, original='plato', target='sg'):
+        """
+        Converts a sequence of values, see convertArray()
+        """
+        return convertArray(values, original, target)
+
+
+def benchmark(count):
+    # Compare converting value by value with converting an array
+    values = np.linspace(1.000, 1.120, count)
+    listed = values.tolist()
+    results = []
+    for original, target in (('sg', 'plato'), ('c', 'f')):
+        start = time.perf_counter()
+        for value in listed:
+            convert(value, original, target)
+        perValue = count / (time.perf_counter() - start)
+        start = time.perf_counter()
+        convertArray(values, original, target)
+        perArray = count / (time.perf_counter() - start)
+        results.append((original, target, perValue, perArray))
+    return results
 
 
 def main():
@@ -120,6 +191,12 @@ def main():
         10, cvt.convert(10, 'brix', 'plato')))
     print('\t{0} C to F = {1}'.format(20, cvt.convert(20, 'c', 'f')))
     print('\t{0} F to C = {1}'.format(68, cvt.convert(68, 'f', 'c')))
+    print('\nWhole arrays convert in one call, e.g. convertArray([1.040, 1.010], \'sg\', \'plato\')'
+        '\n\t= {0}'.format(convertArray([1.040, 1.010], 'sg', 'plato')))
+    print('\nConversions per second, value by value and as an array of 1000000:')
+    for original, target, perValue, perArray in benchmark(1000000):
+        print('\t{0} to {1}: {2:.0f}/s, {3:.0f}/s ({4:.0f}x)'.format(
+            original, target, perValue, perArray, perArray / perValue))
 
 
 if __name__ == '__main__':
@@ -36,13 +36,17 @@ from sys import path, stderr, stdout, platform
 import os
 import serial
 import psutil
+import shutil
 import stat
+import threading
 import pwd
 import grp
 import git
 from psutil import process_iter as ps
 from time import sleep, strftime
+from contextlib import contextmanager
 from configobj import ConfigObj, ParseError
+import simplejson as json
 import BrewPiSocket
 import autoSerial
 import BrewPiProcess
@@ -59,27 +63,17 @@ def addSlash(path):
     return path
 
 
-def readCfgWithDefaults(configFile = None):
+def defaultConfig(defaultFile):
     """
-    Reads a config file with the default config file as fallback
+    Reads the default config file, writing a new one if it is missing or
+    cannot be parsed
 
     Params:
-    configFile: string, path to config file (defaults to {scriptpath}/settings/config.cfg)
+    defaultFile: string, path to the default config file
 
     Returns:
-    ConfigObj of settings
+    ConfigObj of default settings
     """
-
-    # Get settings folder
-    settings = '{0}settings/'.format(scriptPath())
-
-    # The configFile is always a named file rather than the default one
-    if not configFile:
-        configFile = '{0}config.cfg'.format(settings)
-
-    # Now grab the default config file
-    defaultFile = '{0}defaults.cfg'.format(settings)
-
     error = 0
     try:
         defCfg = ConfigObj(defaultFile, file_error=True)
@@ -111,27 +105,248 @@ def readCfgWithDefaults(configFile = None):
         defCfg['clampTempUpper'] = 110.0
         defCfg['clampTempLower'] = -5.0
         defCfg.write()
+    return defCfg
+
+
+def fileTime(fileName):
+    """
+    Returns the modification time and size of a file, None if missing
+    """
+    try:
+        info = os.stat(fileName)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+
+def keepOwner(tempName, fileName):
+    """
+    Gives a temp file the mode and owner of the file it is about to
+    replace, or those of a new file if there is none yet
+    """
+    try:
+        info = os.stat(fileName)
+    except OSError:
+        permissions.newFile(tempName)
+        return
+    try:
+        os.chmod(tempName, stat.S_IMODE(info.st_mode))
+        os.chown(tempName, info.st_uid, info.st_gid)
+    except OSError:
+        pass  # Not allowed to, keep ours
+
+
+class ConfigStore():
+    """
+    Keeps the default and user config files parsed in memory
+
+    A file is parsed again only when its modification time or size changes.
+    If the user file cannot be parsed the last good one is kept and
+    parseError says why. Settings may be changed in a transaction, so
+    several of them are written to the user file at once. The file is
+    written to a temporary name and renamed into place.
+    """
 
-    if configFile:
+    def __init__(self, configFile, defaultFile):
+        self.configFile = configFile
+        self.defaultFile = defaultFile
+        self.lock = threading.RLock()
+        self.defaults = None
+        self.defaultsTime = None
+        self.user = None
+        self.userTime = None
+        self.parseError = None  # Why the user file could not be parsed
+        self.merged = None
+        self.pending = {}  # Settings set in the open transaction
+        self.depth = 0  # Nesting of open transactions
+
+    def get(self):
+        """
+        Returns a copy of the merged settings, reading any file that changed
+        """
+        with self.lock:
+            self.__refresh()
+            return ConfigObj(self.merged)
+
+    def getDefaults(self):
+        """
+        Returns a copy of the settings of the default config file
+        """
+        with self.lock:
+            self.__refresh()
+            return ConfigObj(self.defaults)
+
+    def changed(self):
+        """
+        Returns True if either file changed since it was last read
+        """
+        return (fileTime(self.defaultFile) != self.defaultsTime or
+                fileTime(self.configFile) != self.userTime)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Writes the settings set within it once, when the outermost
+        transaction ends
+        """
+        with self.lock:
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+                if self.depth == 0 and self.pending:
+                    pending = self.pending
+                    self.pending = {}
+                    self.__write(pending)
+
+    def set(self, settingName, value):
+        """
+        Sets a user setting, written at once or when the transaction ends
+        """
+        with self.lock:
+            self.pending[settingName] = value
+            self.merged = None
+            if self.depth == 0:
+                pending = self.pending
+                self.pending = {}
+                self.__write(pending)
+
+    def __refresh(self):
+        defaultsTime = fileTime(self.defaultFile)
+        if self.defaults is None or defaultsTime != self.defaultsTime:
+            self.defaults = defaultConfig(self.defaultFile)
+            self.defaultsTime = fileTime(self.defaultFile)
+            self.merged = None
+        userTime = fileTime(self.configFile)
+        if self.user is None or userTime != self.userTime:
+            user = self.__readUser()
+            if user is not None:
+                self.user = user
+            elif self.user is None:
+                self.user = ConfigObj()
+            self.userTime = userTime
+            self.merged = None
+        if self.merged is None:
+            merged = ConfigObj()
+            merged.merge(self.defaults)
+            merged.merge(self.user)
+            merged.merge(self.pending)
+            # Fix pathnames
+            merged['toolPath'] = addSlash(merged['toolPath'])
+            merged['scriptPath'] = addSlash(merged['scriptPath'])
+            merged['wwwPath'] = addSlash(merged['wwwPath'])
+            self.merged = merged
+
+    def __readUser(self):
+        # Returns None if the file cannot be parsed
         try:
-            userConfig = ConfigObj(configFile, file_error=True)
-            defCfg.merge(userConfig)
-        except ParseError:
-            error = 1
+            config = ConfigObj(self.configFile, file_error=True)
+            self.parseError = None
+            return config
+        except ParseError as e:
             logError("Could not parse user config file:")
-            logError("{0}".format(configFile))
+            logError("{0}".format(self.configFile))
+            logError("{0}".format(e))
+            self.parseError = str(e)
+            return None
         except IOError:
-            error = 1
             logMessage("No user config file found:")
-            logMessage("{0}".format(configFile))
+            logMessage("{0}".format(self.configFile))
             logMessage("Using default configuration.")
+        self.parseError = None
+        return ConfigObj()
+
+    def __write(self, settings):
+        # Start from the file as it is now, keeping its comments, or from
+        # the last good one if it cannot be parsed
+        config = self.__readUser()
+        if config is None:
+            config = ConfigObj(self.user or {})
+        config.filename = None
+        config.initial_comment = ["File created or updated on {0}\n#".format(strftime("%Y-%m-%d %H:%M:%S"))]
+        for settingName in settings:
+            config[settingName] = settings[settingName]
+        fileMode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
+        tempName = '{0}.tmp'.format(self.configFile)
+        try:
+            lines = config.write()
+            with open(tempName, 'w') as tempFile:
+                tempFile.write('\n'.join(lines) + '\n')
+            # Keep the owner of the config file and chmod 660 it, before it
+            # replaces the old one
+            keepOwner(tempName, self.configFile)
+            os.chmod(tempName, fileMode)
+            os.replace(tempName, self.configFile)
+        except (IOError, OSError) as e:
+            logError("I/O error({0}) while writing:".format(e.errno))
+            logError("{0}:".format(self.configFile))
+            logError("{0}.".format(e.strerror))
+            logError("You are not running as root or brewpi, or your")
+            logError("permissions are not set correctly. To fix this, run:")
+            logError("sudo {0}utils/doPerms.sh".format(scriptPath()))
+        # Parse what was written, so values read back as strings
+        self.user = self.__readUser() or self.user or ConfigObj()
+        self.userTime = fileTime(self.configFile)
+        self.merged = None
 
-    # Fix pathnames
-    defCfg['toolPath'] = addSlash(defCfg['toolPath'])
-    defCfg['scriptPath'] = addSlash(defCfg['scriptPath'])
-    defCfg['wwwPath'] = addSlash(defCfg['wwwPath'])
 
-    return defCfg
+configStores = {}  # ConfigStore of each config file
+configStoresLock = threading.Lock()
+
+
+def configFileName(configFile = None):
+    """
+    Returns the full path of a config file
+
+    Params:
+    configFile: string, path or name in the settings folder (defaults to config.cfg)
+    """
+    settings = '{0}settings/'.format(scriptPath())
+    if not configFile:
+        return '{0}config.cfg'.format(settings)
+    # Maybe it was a simple filename, add path
+    if not os.path.isfile(configFile) and "/" not in configFile:
+        return "{0}{1}".format(settings, configFile)
+    return configFile
+
+
+def getConfigStore(configFile = None):
+    """
+    Returns the ConfigStore of a config file, one per file
+
+    Params:
+    configFile: string, path to config file (defaults to {scriptpath}/settings/config.cfg)
+    """
+    configFile = os.path.abspath(configFileName(configFile))
+    with configStoresLock:
+        if configFile not in configStores:
+            configStores[configFile] = ConfigStore(
+                configFile, '{0}settings/defaults.cfg'.format(scriptPath()))
+        return configStores[configFile]
+
+
+def readCfgWithDefaults(configFile = None):
+    """
+    Reads a config file with the default config file as fallback
+
+    Params:
+    configFile: string, path to config file (defaults to {scriptpath}/settings/config.cfg)
+
+    Returns:
+    ConfigObj of settings
+    """
+    return getConfigStore(configFile).get()
+
+
+def configTransaction(configFile = None):
+    """
+    Returns a context in which configSet() calls are written at once
+
+    Params:
+    configFile (optional): Name of configuration file (defaults to config.cfg)
+    """
+    return getConfigStore(configFile).transaction()
 
 
 def configSet(settingName, value, configFile = None):
@@ -146,78 +361,113 @@ def configSet(settingName, value, configFile = None):
     Returns:
     ConfigObj of current settings
     """
-    settings = '{0}settings/'.format(scriptPath())
-    newConfigFile = "{0}config.cfg".format(settings)
-    fileExists = True
-
-    # If we passed a configFile
-    if configFile:
-        # Check for the file
-        if not os.path.isfile(configFile):
-            # If there's no configFile, assume a "/" in it means a valid path at least
-            if "/" in configFile:
-                # Path seems legit, create it later
-                fileExists = False
-            else:
-                # Maybe it was a simple filename, add path and try again
-                configFile = "{0}{1}".format(settings, configFile)
-                if not os.path.isfile(configFile):
-                    # Still no dice
-                    fileExists = False
-        # No configFile passed
-        else:
-            # Path/File exists
-            fileExists = True
-    # No config file passed
-    else:
-        # Default to config.cfg in settings directory
-        configFile = newConfigFile
-        if not os.path.isfile(configFile):
-            fileExists = False
+    store = getConfigStore(configFile)
+    if not os.path.isfile(store.configFile):
+        logMessage("Config file {0} did not exist, creating new file.".format(store.configFile))
+    store.set(settingName, value)
+    return store.get()  # Return (hopefully updated) ConfigObj
+
 
-    # If there's no config file, create it and set permissions
-    if not fileExists:
+class WwwSettings():
+    """
+    In-memory mirror of userSettings.json, the copy of some settings the
+    web server needs even when the script is not running
+
+    Setting a value which did not change costs nothing. Changes are kept
+    until flush(), so all changes made in one pass of the main loop are
+    written at once. The file is written to a temporary name and renamed
+    into place, and read again if the web server changed it.
+    """
+
+    def __init__(self, wwwPath):
+        self.fileName = '{0}userSettings.json'.format(addSlash(wwwPath))
+        self.defaultFileName = '{0}defaultSettings.json'.format(addSlash(wwwPath))
+        self.lock = threading.RLock()
+        self.settings = None
+        self.settingsTime = None
+        self.defaults = None
+        self.dirty = {}  # Settings changed since the last flush
+        self.writes = 0
+
+    def get(self, settingName):
+        """
+        Returns a setting, from defaultSettings.json if not set, else None
+        """
+        with self.lock:
+            self.__refresh()
+            if settingName in self.dirty:
+                return self.dirty[settingName]
+            if settingName in self.settings:
+                return self.settings[settingName]
+            if self.defaults is None:
+                self.defaults = self.__read(self.defaultFileName) or {}
+            return self.defaults.get(settingName)
+
+    def set(self, settingName, value):
+        """
+        Changes a setting, written with the next flush()
+        """
+        with self.lock:
+            self.__refresh()
+            if settingName not in self.dirty and settingName in self.settings and \
+                    self.settings[settingName] == value:
+                return
+            self.dirty[settingName] = value
+
+    def flush(self):
+        """
+        Writes the changed settings, if any
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            self.__refresh()
+            self.settings.update(self.dirty)
+            self.dirty = {}
+            tempName = '{0}.tmp'.format(self.fileName)
+            try:
+                with open(tempName, 'wb') as wwwSettingsFile:
+                    wwwSettingsFile.write(json.dumps(self.settings).encode(encoding="cp437"))
+                keepOwner(tempName, self.fileName)
+                os.replace(tempName, self.fileName)
+            except (IOError, OSError):
+                logError("Ran into an error writing the WWW JSON file.")
+            self.settingsTime = fileTime(self.fileName)
+            self.writes += 1
+
+    def __refresh(self):
+        # Read the file again if it is new or the web server changed it
+        settingsTime = fileTime(self.fileName)
+        if self.settings is None or settingsTime != self.settingsTime:
+            self.settings = self.__read(self.fileName, True) or {}
+            self.settingsTime = settingsTime
+
+    def __read(self, fileName, warn=False):
+        if not os.path.exists(fileName):
+            return None
         try:
-            # Create the file
-            open(configFile, 'a').close()
-            # chmod 660 the new file
-            fileMode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
-            os.chmod(configFile, fileMode)
-            logMessage("Config file {0} did not exist, created new file.".format(configFile))
-        except:
-            logError("Unable to create '{0}'.".format(configFile))
-            return readCfgWithDefaults()
+            with open(fileName, 'rb') as jsonFile:
+                return json.loads(jsonFile.read().decode(encoding="cp437"))
+        except (IOError, OSError, ValueError):
+            if warn:
+                # Start with a fresh file when the json is corrupt.
+                logMessage("Error while decoding {0}, creating new empty json file.".format(
+                    os.path.basename(fileName)))
+            return None
 
-    # Add or update the setting
-    try:
-        comment = "File created or updated on {0}\n#".format(strftime("%Y-%m-%d %H:%M:%S"))
-        config = ConfigObj()
-        config = readCfgWithDefaults()
-        config.initial_comment = [comment]
-        config.filename = configFile
-        config[settingName] = value
-        config.write()
-    except ParseError:
-        logError("Invalid configuration settings: '{0}': '{1}'".format(settingName, value))
-    except IOError as e:
-        logError("I/O error({0}) while setting permissions on:".format(e.errno))
-        logError("{0}:".format(configFile))
-        logError("{0}.".format(e.strerror))
-        logError("You are not running as root or brewpi, or your")
-        logError("permissions are not set correctly. To fix this, run:")
-        logError("sudo {0}utils/doPerms.sh".format(scriptPath()))
-    # chmod 660 the config file just in case
-    try:
-        fileMode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
-        os.chmod(configFile, fileMode)
-    except IOError as e:
-        logError("I/O error({0}) while setting permissions on:".format(e.errno))
-        logError("{0}:".format(configFile))
-        logError("{0}.".format(e.strerror))
-        logError("You are not running as root or brewpi, or your")
-        logError("permissions are not set correctly. To fix this, run:")
-        logError("sudo {0}utils/doPerms.sh".format(scriptPath()))
-    return readCfgWithDefaults(configFile)  # Return (hopefully updated) ConfigObj
+
+wwwSettingsFiles = {}  # WwwSettings of each web path
+
+
+def getWwwSettings(wwwPath):
+    """
+    Returns the WwwSettings of a web path, one per path
+    """
+    wwwPath = addSlash(wwwPath)
+    with configStoresLock:
+        if wwwPath not in wwwSettingsFiles:
+            wwwSettingsFiles[wwwPath] = WwwSettings(wwwPath)
+        return wwwSettingsFiles[wwwPath]
 
 
 def scriptPath():
@@ -290,6 +540,148 @@ def logError(*objs):
         printStdErr(*objs)
 
 
+class PermissionManager():
+    """
+    Sets owner, group and mode of the files and directories BrewPi creates
+
+    Directory trees are registered once with their owner and group. New
+    files and directories below a tree get its ownership as they are
+    created, so nothing needs to walk the tree afterwards. User and group
+    lookups are cached.
+    """
+
+    FILE_MODE = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH  # 664
+    DIR_MODE = stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH  # 775
+
+    def __init__(self):
+        self.trees = {}  # Root path: (owner, group)
+        self.ids = {}  # (owner, group): (uid, gid), or None if unknown
+
+    def addTree(self, root, owner, group):
+        """
+        Register a directory tree and the owner and group of its contents
+
+        Params:
+        root: Top directory of the tree
+        owner: User name
+        group: Group name
+        """
+        self.trees[os.path.abspath(root)] = (owner, group)
+
+    def lookup(self, owner, group):
+        """
+        Returns (uid, gid) for a user and group name, or None if either
+        does not exist
+        """
+        key = (owner, group)
+        if key not in self.ids:
+            try:
+                self.ids[key] = (pwd.getpwnam(owner).pw_uid, grp.getgrnam(group).gr_gid)
+            except KeyError:
+                logError("Unknown user '{0}' or group '{1}', not setting ownership.".format(
+                    owner, group))
+                self.ids[key] = None
+        return self.ids[key]
+
+    def treeOf(self, path):
+        """
+        Returns the root of the registered tree holding a path, or None
+        """
+        path = os.path.abspath(path)
+        best = None
+        for root in self.trees:
+            if path == root or path.startswith(addSlash(root)):
+                if best is None or len(root) > len(best):
+                    best = root
+        return best
+
+    def makeDirs(self, path):
+        """
+        Create a directory and any missing parents, setting ownership on the
+        ones which are new
+
+        Params:
+        path: Directory to create
+        """
+        path = os.path.abspath(path)
+        missing = []
+        while path and not os.path.isdir(path):
+            missing.append(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        for directory in reversed(missing):
+            os.mkdir(directory)
+            self.apply(directory, self.DIR_MODE)
+
+    def newFile(self, path):
+        """
+        Set ownership and mode of a file which has just been created
+        """
+        self.apply(path, self.FILE_MODE)
+
+    def copyFile(self, src, dst):
+        """
+        Copy a file's contents, setting ownership if the copy is new. An
+        existing copy is overwritten in place and keeps its ownership.
+        """
+        isNew = not os.path.exists(dst)
+        shutil.copyfile(src, dst)
+        if isNew:
+            self.newFile(dst)
+
+    def apply(self, path, mode):
+        """
+        Set ownership from the tree holding a path, and the given mode.
+        Paths outside the registered trees are left alone.
+
+        Returns:
+        True if set, False if not
+        """
+        root = self.treeOf(path)
+        if root is None:
+            return False
+        ids = self.lookup(*self.trees[root])
+        if ids is None:
+            return False
+        try:
+            os.chown(path, ids[0], ids[1])
+            os.chmod(path, mode)
+        except OSError as e:
+            logError("Unable to set permissions on {0}: {1}".format(path, e.strerror))
+            logError("You are not running as root or brewpi, or your")
+            logError("permissions are not set correctly. To fix this, run:")
+            logError("sudo {0}brewpi.py --repair-perms".format(scriptPath()))
+            return False
+        return True
+
+    def repair(self, root=None):
+        """
+        Walk a tree (or all registered trees) and set ownership and mode on
+        everything in it. Only needed once, e.g. after restoring a backup.
+
+        Returns:
+        Number of paths fixed
+        """
+        roots = [os.path.abspath(root)] if root else list(self.trees)
+        fixed = 0
+        for top in roots:
+            if not os.path.isdir(top):
+                continue
+            fixed += self.apply(top, self.DIR_MODE)
+            for path, dirs, files in os.walk(top):
+                for name in dirs:
+                    fixed += self.apply(os.path.join(path, name), self.DIR_MODE)
+                for name in files:
+                    fixed += self.apply(os.path.join(path, name), self.FILE_MODE)
+        return fixed
+
+
+# Shared by everything which creates files in the data trees
+permissions = PermissionManager()
+
+
 def removeDontRunFile(path = None):
     """
     Removes the semaphore file which prevents script processing
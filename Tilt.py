@@ -23,27 +23,54 @@
 import argparse
 import asyncio
 import datetime
-from decimal import *
+import hashlib
 import json
+import os
 import re
 import subprocess
 import sys
 import threading
+from bisect import bisect_left, insort
+from collections import deque
 from configparser import ConfigParser
 from csv import reader
-from os.path import abspath, dirname, exists, getmtime, isfile
-from struct import unpack
-from time import sleep, time
+from os.path import abspath, dirname, exists, isfile
+from struct import Struct, pack, unpack
+from time import perf_counter, sleep, time
 # Third Party Imports
 import numpy
 import aioblescan
 # Local Imports
-#
+from brewpiJson import TILT_COLORS
 
-# Tilt colors
-TILT_COLORS = ['Red', 'Green', 'Black', 'Purple', 'Orange', 'Blue', 'Yellow', 'Pink']
 # Known Tilt hardware versions
 TILT_VERSIONS = ['Unknown', 'v1', 'v2', 'v3', 'Pro', 'v2 or 3']
+# Tilt colors by the raw bytes of their iBeacon UUID
+TILT_UUIDS = {
+    bytes.fromhex('a495bb10c5b14b44b5121370f02d74de'): 'Red',
+    bytes.fromhex('a495bb20c5b14b44b5121370f02d74de'): 'Green',
+    bytes.fromhex('a495bb30c5b14b44b5121370f02d74de'): 'Black',
+    bytes.fromhex('a495bb40c5b14b44b5121370f02d74de'): 'Purple',
+    bytes.fromhex('a495bb50c5b14b44b5121370f02d74de'): 'Orange',
+    bytes.fromhex('a495bb60c5b14b44b5121370f02d74de'): 'Blue',
+    bytes.fromhex('a495bb70c5b14b44b5121370f02d74de'): 'Yellow',
+    bytes.fromhex('a495bb80c5b14b44b5121370f02d74de'): 'Pink',
+}
+# Apple iBeacon manufacturer data after the company ID: type and length
+# (0x02 0x15), UUID, major, minor and TX power
+IBEACON = Struct('>2s16sHHB')
+IBEACON_TYPE = b'\x02\x15'
+APPLE_ID = b'\x4c\x00'
+# Raw HCI LE advertising report up to its data: packet type (0x04 event),
+# event code (0x3e LE meta), length, subevent (0x02 advertising report),
+# number of reports, event type, address type, address (reversed) and data
+# length
+ADV_REPORT = Struct('<BBBBBBB6sB')
+MANUFACTURER_DATA = 0xff
+# A Tilt's Apple company ID, iBeacon type and the start of its UUID, and
+# where they are in its raw HCI event: after the flags, or without flags
+TILT_PREFIX = APPLE_ID + IBEACON_TYPE + b'\xa4\x95'
+TILT_OFFSETS = (ADV_REPORT.size + 5, ADV_REPORT.size + 2)
 
 
 class TiltManager(object):
@@ -77,6 +104,7 @@ class TiltManager(object):
         for i in range(len(TILT_COLORS)):
             self.tilt[i] = Tilt(
                 TILT_COLORS[i], averagingPeriod, medianWindow)
+        self.tiltByColor = dict(zip(TILT_COLORS, self.tilt))
 
         self.conn = None
         self.btctrl = None
@@ -84,6 +112,10 @@ class TiltManager(object):
         self.mysocket = None
         self.fac = None
 
+        # Packets passed to and turned away by the prefilter
+        self.accepted = 0
+        self.rejected = 0
+
     def setDebug(self, debug):
         self.debug = debug
 
@@ -134,24 +166,19 @@ class TiltManager(object):
         else:
             print('INFO: Config file does not exist: {0}'.format(filename))
 
+        # Size the Tilts' stores of readings for the settings
+        for tilt in self.tilt:
+            tilt.setWindow(self.averagingPeriod, self.medianWindow)
+
     def tiltName(self, uuid):
         """
         Return Tilt color given UUID
 
-        :param uuid: UUID from BLEacon
+        :param uuid: UUID from BLEacon, as hex
         :return: Tilt color
         """
 
-        return {
-            'a495bb10c5b14b44b5121370f02d74de': 'Red',
-            'a495bb20c5b14b44b5121370f02d74de': 'Green',
-            'a495bb30c5b14b44b5121370f02d74de': 'Black',
-            'a495bb40c5b14b44b5121370f02d74de': 'Purple',
-            'a495bb50c5b14b44b5121370f02d74de': 'Orange',
-            'a495bb60c5b14b44b5121370f02d74de': 'Blue',
-            'a495bb70c5b14b44b5121370f02d74de': 'Yellow',
-            'a495bb80c5b14b44b5121370f02d74de': 'Pink'
-        }.get(uuid)
+        return TILT_UUIDS.get(bytes.fromhex(uuid))
 
     def storeValue(self, timestamp, mac, hwVersion, fwVersion, color, temperature, gravity, battery):
         """
@@ -164,12 +191,21 @@ class TiltManager(object):
         """
 
         if isinstance(self.tilt, list):
-            for i in range(len(TILT_COLORS)):
-                if color == TILT_COLORS[i]:
-                    self.tilt[i].setValues(timestamp, mac, hwVersion, fwVersion, color, temperature, gravity, battery)
+            tilt = self.tiltByColor.get(color)
+            if tilt is not None:
+                tilt.setValues(timestamp, mac, hwVersion, fwVersion, color, temperature, gravity, battery)
         else:
             self.tilt.setValues(timestamp, mac, hwVersion, fwVersion, color, temperature, gravity, battery)
 
+    def reloadCalibration(self):
+        """
+        Reload the calibration files which changed
+
+        :return: List of the colors whose calibration changed
+        """
+
+        return [tilt.color for tilt in self.tilt if tilt.calibrate()]
+
     def getValue(self, color):
         """
         Retrieve Tilt value
@@ -180,43 +216,24 @@ class TiltManager(object):
 
         returnValue = None
         if isinstance(self.tilt, list):
-            # If there's an array of Tilt objects, loop through till we have a match
-            for i in range(len(TILT_COLORS)):
-                if TILT_COLORS[i] == color:
-                    returnValue = self.tilt[i].getValues(color)
+            # If there's an array of Tilt objects, use the one of the color
+            tilt = self.tiltByColor.get(color)
+            if tilt is not None:
+                returnValue = tilt.getValues(color)
         else:
             # If there's a single Tilt object, return it's value
             returnValue = self.tilt.getValues(color)
         return returnValue
 
-    def decode(self, ev):
+    def decode(self, data):
         """
         Decode BLEacon to Tilt data
 
-        :param ev: Pointer to aioblescan.HCI_Event()
-        :return: Tilt values in JSON
-        """
-
-        data = {}
-        manufacturer_data = ev.retrieve("Manufacturer Specific Data")
-        if manufacturer_data:
-            payload = manufacturer_data[0].payload
-            payload = payload[1].val.hex()
-            if payload[4:8] == self.TILT:
-                data['mfg_id'] = payload[0:8]
-                data['color'] = self.tiltName(payload[4:36])
-                data['mac'] = ev.retrieve("peer")[0].val
-                data['uuid'] = payload[0:-1]
-                data['major'] = int.from_bytes(bytes.fromhex(payload[36:40]), byteorder='big')
-                data['minor'] = int.from_bytes(bytes.fromhex(payload[40:44]), byteorder='big')
-                # On the latest tilts, TX power is used for battery age in
-                # weeks since battery change (0-152 when converted to unsigned
-                # 8 bit integer) and other TBD operation codes
-                data['tx_power'] = int.from_bytes(bytes.fromhex(payload[44:46]), byteorder='big', signed=False)
-                data['rssi'] = ev.retrieve("rssi")[-1].val
-                data['ev_type'] = int(ev.retrieve('ev type')[-1].val)
-
-                return json.dumps(data)
+        :param data: Raw HCI event from aioblescan.BLEScanRequester
+        :return: TiltReading, or None if not a Tilt
+        """
+
+        return decodeAdvertisement(data)
 
     def blecallback(self, data):
         """
@@ -231,76 +248,75 @@ class TiltManager(object):
         temperature = 68
         gravity = 1
 
-        ev = aioblescan.HCI_Event()
-        ev.decode(data)
-        tiltJson = self.decode(ev)
+        # Most of what the radio hears is not a Tilt, turn it away before
+        # decoding anything
+        if not isTiltPacket(data):
+            self.rejected += 1
+            return
+        self.accepted += 1
 
-        display_raw = True
-        if tiltJson:
-            if self.opts:
-                if self.opts.mac: # Limit to MAC in argument
-                    goon = False
-                    mac = ev.retrieve("peer")
-                    for x in mac:
-                        if x.val in self.opts.mac:
-                            goon =True
-                            break
-                    if not goon:
-                        return
-
-                if self.opts.raw and self.debug: # Print Debug
-                    display_raw = False
-                    print("Raw data: {}".format(ev.raw_data))
-
-                if self.opts.json and self.debug: # Print Debug
-                    display_raw = False
-                    print("Tilt JSON: {}".format(tiltJson))
-
-        else: # Not a Tilt
+        reading = self.decode(data)
+
+        if reading is None: # Not a Tilt
             return
 
-        if display_raw and self.debug: # Print Debug
-            ev.show(0)
+        display_raw = True
+        if self.opts:
+            if self.opts.mac and reading.mac not in self.opts.mac: # Limit to MAC in argument
+                return
+
+            if self.opts.raw and self.debug: # Print Debug
+                display_raw = False
+                print("Raw data: {}".format(data))
 
-        # Prepare to store Tilt data
-        tiltData = {}
-        tiltdata = json.loads(tiltJson)
+            if self.opts.json and self.debug: # Print Debug
+                display_raw = False
+                print("Tilt JSON: {}".format(json.dumps(reading.asDict())))
 
-        mac = str(tiltdata['mac'])
-        color = str(tiltdata['color'])
+        if display_raw and self.debug: # Print Debug
+            ev = aioblescan.HCI_Event()
+            ev.decode(data)
+            ev.show(0)
 
-        if int(tiltdata['major']) == 999:
+        if reading.major == 999:
             # For the latest Tilts, this is now actually a special code indicating that
             # the gravity is the version info.
-            fwVersion = int(tiltdata['minor'])
+            fwVersion = reading.minor
         else:
-            if int(tiltdata['minor']) >= 5000:
+            if reading.minor >= 5000:
                 # Is a Tilt Pro
-                # self.tilt_pro = True
-                gravity = Decimal(tiltdata['minor']) / 10000
-                temperature = Decimal(tiltdata['major']) / 10
+                gravity = reading.minor / 10000
+                temperature = reading.major / 10
             else:
                 # Is not a Pro model
-                gravity = Decimal(tiltdata['minor']) / 1000
-                temperature = int(tiltdata['major'])
+                gravity = reading.minor / 1000
+                temperature = reading.major
 
-        battery = int(tiltdata['tx_power'])
+        # On the latest tilts, TX power is used for battery age in weeks
+        # since battery change (0-152 as an unsigned 8 bit integer) and
+        # other TBD operation codes
+        battery = reading.txPower
 
         # Try to derive if we are v1, 2, or 3
-        if int(tiltdata['ev_type']) == 0: # Only Tilt v1 shows as "generic adv"
+        if reading.evType == 0: # Only Tilt v1 shows as "generic adv"
             hwVersion = 1
-        elif int(tiltdata['minor']) >= 5000:
+        elif reading.minor >= 5000:
             hwVersion = 4
         else: # TODO: 5 is "v2 or 3" until we can tell the difference between the two of them
             hwVersion = 5
 
-        rssi = tiltdata['rssi']
-
-        timestamp = datetime.datetime.now()
-
         # Store value
         timestamp = datetime.datetime.now()
-        self.storeValue(timestamp, mac, hwVersion, fwVersion, color, temperature, gravity, battery)
+        self.storeValue(timestamp, reading.mac, hwVersion, fwVersion, reading.color, temperature, gravity, battery)
+
+    def stats(self):
+        """
+        Returns the counts of packets the prefilter accepted and rejected
+
+        :return: dict with 'accepted' and 'rejected'
+        """
+
+        return {'accepted': self.accepted, 'rejected': self.rejected}
 
     def start(self, debug = False):
         """
@@ -354,6 +370,126 @@ class TiltManager(object):
         return
 
 
+def decodeBeacon(payload):
+    """
+    Decodes the Apple manufacturer data of an iBeacon advertisement
+
+    Params:
+    payload: bytes after the manufacturer ID
+
+    Returns:
+    Tuple of (color, uuid, major, minor, txPower), or None if not a Tilt
+    """
+    if len(payload) < IBEACON.size or payload[:2] != IBEACON_TYPE:
+        return None
+    _, uuid, major, minor, txPower = IBEACON.unpack_from(payload)
+    color = TILT_UUIDS.get(uuid)
+    if color is None:
+        return None
+    return color, uuid, major, minor, txPower
+
+
+def isTiltPacket(data):
+    """
+    Cheap check of a raw HCI event for the start of a Tilt iBeacon at the
+    places a Tilt puts it. Anything it passes still needs decoding.
+
+    Params:
+    data: bytes of the HCI event
+
+    Returns:
+    True if it may be a Tilt
+    """
+    for offset in TILT_OFFSETS:
+        if data[offset:offset + len(TILT_PREFIX)] == TILT_PREFIX:
+            return True
+    return False
+
+
+def decodeAdvertisement(data):
+    """
+    Decodes a raw HCI LE advertising report, as aioblescan passes them on,
+    if it is a Tilt. Only the first report of the event is looked at.
+
+    Params:
+    data: bytes of the HCI event
+
+    Returns:
+    TiltReading, or None if not a Tilt
+    """
+    if len(data) < ADV_REPORT.size:
+        return None
+    packetType, code, _, subevent, _, evType, _, address, length = ADV_REPORT.unpack_from(data)
+    if packetType != 0x04 or code != 0x3e or subevent != 0x02:
+        return None
+    start = ADV_REPORT.size
+    end = min(start + length, len(data))
+    # Walk the AD structures (length, type, value) for the Apple
+    # manufacturer data
+    offset = start
+    while offset + 1 < end:
+        size = data[offset]
+        if size == 0:
+            break
+        if data[offset + 1] == MANUFACTURER_DATA and data[offset + 2:offset + 4] == APPLE_ID:
+            beacon = decodeBeacon(data[offset + 4:offset + 1 + size])
+            if beacon is None:
+                return None
+            color, uuid, major, minor, txPower = beacon
+            rssi = unpack('b', data[end:end + 1])[0] if len(data) > end else None
+            mac = ':'.join('{:02x}'.format(byte) for byte in reversed(address))
+            return TiltReading(color, mac, uuid, major, minor, txPower, rssi, evType)
+        offset += 1 + size
+    return None
+
+
+def advertisement(color, major, minor, txPower=0, mac='00:00:00:00:00:00', rssi=-60, evType=3, flags=True):
+    """
+    Builds the raw HCI event of a Tilt advertisement, as decodeAdvertisement()
+    reads them, e.g. to replay packets
+
+    Returns:
+    bytes of the HCI event
+    """
+    uuid = [key for key in TILT_UUIDS if TILT_UUIDS[key] == color][0]
+    data = b'\x02\x01\x04' if flags else b''
+    data += pack('<BB', 1 + len(APPLE_ID) + IBEACON.size, MANUFACTURER_DATA) + APPLE_ID
+    data += IBEACON.pack(IBEACON_TYPE, uuid, major, minor, txPower)
+    address = bytes(reversed(bytes.fromhex(mac.replace(':', ''))))
+    report = pack('<BBB6sB', 1, evType, 0, address, len(data)) + data + pack('b', rssi)
+    return pack('<BBBB', 0x04, 0x3e, len(report) + 1, 0x02) + report
+
+
+class TiltReading:
+    """
+    Holds the decoded fields of one Tilt advertisement
+    """
+
+    __slots__ = ('color', 'mac', 'uuid', 'major', 'minor', 'txPower', 'rssi', 'evType')
+
+    def __init__(self, color, mac, uuid, major, minor, txPower, rssi, evType):
+        self.color = color
+        self.mac = mac
+        self.uuid = uuid
+        self.major = major
+        self.minor = minor
+        self.txPower = txPower
+        self.rssi = rssi
+        self.evType = evType
+
+    def asDict(self):
+        return {
+            'color': self.color,
+            'mac': self.mac,
+            'uuid': self.uuid.hex(),
+            'major': self.major,
+            'minor': self.minor,
+            'tx_power': self.txPower,
+            'rssi': self.rssi,
+            'ev_type': self.evType,
+        }
+
+
 class TiltValue:
     """
     Holds all category values of an individual Tilt reading
@@ -373,6 +509,331 @@ class TiltValue:
         return "S: " + str(self.timestamp) + " M: " + str(self.mac) + "F: " + str(self.fwVersion) + "C: " + str(self.color) + "T: " + str(self.temperature) + " G: " + str(self.gravity) + " B: " + str(self.battery)
 
 
+def meanOfMedians(values, window):
+    """
+    Moves a window across values taking the median of each position, and
+    averages those medians. The window shrinks to the number of values if
+    there are fewer.
+
+    This is the whole calculation done at once, SlidingMedian keeps the
+    same result up to date as values come and go.
+
+    Params:
+    values: Sequence of numbers, oldest first
+    window: Number of values in the window
+
+    Returns:
+    Mean of the window medians, or None without values
+    """
+    if len(values) == 0:
+        return None
+    values = numpy.asarray(values, dtype=float)
+    window = min(window, len(values))
+    total = 0
+    count = len(values) - (window - 1)
+    for i in range(count):
+        total += numpy.median(values[i:i + window])
+    return float(total / count)
+
+
+class SlidingMedian:
+    """
+    Mean of the medians of every window position across a series of
+    readings, as meanOfMedians() works it out, updated as readings are
+    added to the end and expire from the front
+
+    The last window of readings is kept sorted, so each new reading costs a
+    binary search and a list insert and delete. The median of each full
+    window is kept with their running total.
+    """
+
+    def __init__(self, window):
+        """
+        :param window: Number of readings in the window
+        """
+        self.window = max(1, int(window))
+        self.recent = deque()  # Last window of readings, oldest first
+        self.sorted = []  # The same readings, sorted
+        self.medians = deque()  # Median of each full window, oldest first
+        self.total = 0.0  # Sum of the medians
+        self.count = 0  # Readings kept
+
+    def add(self, value):
+        """
+        Add the newest reading
+        """
+        value = float(value)
+        self.count += 1
+        self.recent.append(value)
+        insort(self.sorted, value)
+        if len(self.recent) > self.window:
+            self.__remove(self.recent.popleft())
+        if len(self.recent) == self.window:
+            median = self.median()
+            self.medians.append(median)
+            self.total += median
+
+    def expire(self, count):
+        """
+        Forget the oldest readings
+
+        :param count: Number of readings to forget
+        """
+        for _ in range(min(count, self.count)):
+            if self.medians:
+                self.total -= self.medians.popleft()
+                if not self.medians:
+                    self.total = 0.0
+            self.count -= 1
+            if len(self.recent) > self.count:
+                # Fewer readings than the window, the oldest is in it
+                self.__remove(self.recent.popleft())
+
+    def median(self):
+        """
+        Returns the median of the last window of readings (or of all, if
+        fewer), None without readings
+        """
+        size = len(self.sorted)
+        if size == 0:
+            return None
+        middle = size // 2
+        if size % 2:
+            return self.sorted[middle]
+        return (self.sorted[middle - 1] + self.sorted[middle]) / 2
+
+    def value(self):
+        """
+        Returns the mean of the window medians, None without readings
+        """
+        if self.medians:
+            return self.total / len(self.medians)
+        # Fewer readings than the window, which shrinks to fit them
+        return self.median()
+
+    def __remove(self, value):
+        del self.sorted[bisect_left(self.sorted, value)]
+
+
+class TiltBuffer:
+    """
+    Holds the readings of one Tilt in fixed-capacity parallel numpy arrays
+
+    The arrays are twice the capacity long and readings are appended at the
+    end, so the readings kept are always one contiguous slice. When the end
+    is reached the kept readings are moved back to the front, which costs
+    one copy of at most capacity rows per capacity appends. Readings expire
+    from the front by moving the start index.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: Most readings kept, the oldest are dropped beyond it
+        """
+        self.capacity = max(1, int(capacity))
+        size = 2 * self.capacity
+        self.timestamps = numpy.zeros(size)  # Epoch seconds
+        self.temperatures = numpy.zeros(size)
+        self.gravities = numpy.zeros(size)
+        self.batteries = numpy.zeros(size, dtype=numpy.int16)
+        self.hwVersions = numpy.zeros(size, dtype=numpy.int8)
+        self.fwVersions = numpy.zeros(size, dtype=numpy.int32)
+        self.macs = numpy.empty(size, dtype=object)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, timestamp, mac, hwVersion, fwVersion, temperature, gravity, battery):
+        """
+        Add a reading, dropping the oldest one if full
+
+        :param timestamp: Epoch time of the reading
+        :return: Number of readings dropped, 0 or 1
+        """
+        if self.end == len(self.timestamps):
+            self.__compact()
+        index = self.end
+        self.timestamps[index] = timestamp
+        self.temperatures[index] = temperature
+        self.gravities[index] = gravity
+        self.batteries[index] = battery
+        self.hwVersions[index] = hwVersion
+        self.fwVersions[index] = fwVersion
+        self.macs[index] = mac
+        self.end = index + 1
+        if self.end - self.start > self.capacity:
+            self.start += 1
+            return 1
+        return 0
+
+    def expire(self, cutoff):
+        """
+        Drop the readings taken at or before an epoch time
+
+        The readings are in time order, so this is a binary search.
+
+        :return: Number of readings dropped
+        """
+        count = int(numpy.searchsorted(
+            self.timestamps[self.start:self.end], cutoff, side='right'))
+        self.start += count
+        return count
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+
+    def view(self, values):
+        """
+        Returns the kept readings of one of the arrays, oldest first, as a
+        view into it
+        """
+        return values[self.start:self.end]
+
+    def __compact(self):
+        count = self.end - self.start
+        for values in (self.timestamps, self.temperatures, self.gravities, self.batteries,
+                       self.hwVersions, self.fwVersions, self.macs):
+            values[:count] = values[self.start:self.end]
+        self.start = 0
+        self.end = count
+
+
+def fitCalibration(originalValues, actualValues):
+    """
+    Fits a polynomial of up to 3rd degree through calibration points. A
+    single point shifts all values by its difference.
+
+    Params:
+    originalValues: Values read from the Tilt
+    actualValues: The matching actual values
+
+    Returns:
+    numpy.poly1d
+    """
+    if len(set(originalValues)) < 2:
+        return numpy.poly1d([1.0, actualValues[0] - originalValues[0]])
+    return numpy.poly1d(numpy.polyfit(
+        originalValues, actualValues, deg=min(3, len(set(originalValues)) - 1)))
+
+
+class TiltCalibration:
+    """
+    Calibration of one Tilt value from a file of 'original, actual' points,
+    e.g. settings/GRAVITY.red
+
+    The file is read when created and on load(), not for each reading, and
+    load() only reads it again once its modification time or size changed.
+    The polynomial fitted to the points is saved next to the file (e.g.
+    GRAVITY.red.fit) with the SHA-1 of the file's content, and is only
+    fitted again when the content changes.
+    """
+
+    def __init__(self, which, color, configDir=None):
+        """
+        :param which: 'temperature' or 'gravity'
+        :param color: Tilt color
+        :param configDir: Directory of the calibration files, defaults to
+                          settings/
+        """
+        if configDir is None:
+            configDir = '{0}/settings/'.format(dirname(abspath(__file__)))
+        self.which = which
+        self.color = color
+        self.fileName = os.path.join(configDir, '{0}.{1}'.format(which.upper(), color.lower()))
+        self.fitFileName = '{0}.fit'.format(self.fileName)
+        self.digest = None  # SHA-1 of the file loaded, None without one
+        self.fileTime = None  # Modification time and size of the file loaded
+        self.function = None  # numpy.poly1d, None for no calibration
+        self.loaded = False
+        self.load()
+
+    def load(self):
+        """
+        Read the calibration file if it changed since it was last read
+
+        :return: True if the calibration changed
+        """
+        try:
+            info = os.stat(self.fileName)
+            fileTime = (info.st_mtime_ns, info.st_size)
+        except OSError:
+            fileTime = None
+        if self.loaded and fileTime == self.fileTime:
+            return False  # Not touched, no need to read it
+        self.fileTime = fileTime
+        try:
+            with open(self.fileName, 'rb') as calFile:
+                data = calFile.read()
+        except IOError:
+            data = None
+        digest = hashlib.sha1(data).hexdigest() if data is not None else None
+        if self.loaded and digest == self.digest:
+            return False
+        self.loaded = True
+        changed = digest != self.digest
+        self.digest = digest
+        self.function = None
+        if data is None:
+            return changed
+
+        try:
+            self.function = self.__loadFit(digest)
+            if self.function is None:
+                originalValues = []
+                actualValues = []
+                for row in reader(data.decode('utf-8').splitlines(), skipinitialspace=True):
+                    # Skip any blank or comment rows
+                    if row != [] and row[0][:1] != "#":
+                        originalValues.append(float(row[0]))
+                        actualValues.append(float(row[1]))
+                if actualValues:
+                    self.function = fitCalibration(originalValues, actualValues)
+                    self.__saveFit(digest)
+        except (ValueError, IndexError, numpy.linalg.LinAlgError) as e:
+            print('ERROR: Tilt ({0}): Unable to initialise {1} calibration data ({2}) - {3}'.format(
+                self.color, self.which.capitalize(), self.fileName, e))
+            self.function = None
+
+        if self.function is not None:
+            print('Tilt ({0}): Initialized {1} Calibration: Polyfill'.format(
+                self.color, self.which.capitalize()))
+        return True
+
+    def apply(self, values):
+        """
+        Calibrate a value or a numpy array of values at once
+
+        :return: Calibrated float or numpy array
+        """
+        if self.function is None:
+            return numpy.asarray(values, dtype=float)
+        return self.function(numpy.asarray(values, dtype=float))
+
+    def __loadFit(self, digest):
+        # The fit saved for this content of the file, if any
+        try:
+            with open(self.fitFileName, 'r') as fitFile:
+                fit = json.load(fitFile)
+            if fit.get('sha1') == digest:
+                return numpy.poly1d(fit['coefficients'])
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def __saveFit(self, digest):
+        tempName = '{0}.tmp'.format(self.fitFileName)
+        try:
+            with open(tempName, 'w') as fitFile:
+                json.dump({'sha1': digest, 'coefficients': self.function.coeffs.tolist()}, fitFile)
+            os.replace(tempName, self.fitFileName)
+        except (IOError, OSError) as e:
+            print('WARNING: Tilt ({0}): Unable to save {1} calibration ({2}) - {3}'.format(
+                self.color, self.which.capitalize(), self.fitFileName, e))
+
+
 class Tilt:
     """
     Manages Tilt values
@@ -380,67 +841,110 @@ class Tilt:
     Handles calibration, storing of values and smoothing of read values.
     """
 
+    # Tilts send about 1.3 readings a second, leave room for more
+    READINGS_PER_SECOND = 4
+    MIN_CAPACITY = 64
+
     values = None
+    tempMedian = None
+    gravMedian = None
     lastMAC = ''
     lastBatt = 0
     lastHwVersion = 0
     lastFwVersion = 0
     averagingPeriod = 0
     medianWindow = 0
-    calibrationDataTime = {}
     tempCal = None
     gravCal = None
-    tempFunction = None
-    gravityFunction = None
 
-    def __init__(self, color, averagingPeriod=0, medianWindow=0):
+    def __init__(self, color, averagingPeriod=0, medianWindow=0, configDir=None):
+        """
+        :param color: Tilt color
+        :param averagingPeriod: Time period in seconds for noise smoothing
+        :param medianWindow: Median filter setting in number of entries
+        :param configDir: Directory of the calibration files, defaults to
+                          settings/
+        """
         self.color = color
-        self.averagingPeriod = averagingPeriod
-        self.medianWindow = medianWindow
-        self.values = []
-        self.calibrate(color)
-        self.calibrationDataTime = {
-            'temperature': 0,
-            'temperature_checked': 0,
-            'gravity': 0,
-            'gravity_checked': 0
-        }
+        # Readings are stored from the BLE thread and read from the main
+        # loop, both of which expire old ones
+        self.lock = threading.RLock()
+        self.tempCal = TiltCalibration("temperature", color, configDir)
+        self.gravCal = TiltCalibration("gravity", color, configDir)
+        self.setWindow(averagingPeriod, medianWindow)
+
+    def setWindow(self, averagingPeriod, medianWindow):
+        """
+        Set the smoothing settings, sizing the store of readings to hold
+        averagingPeriod seconds of them
 
-    def calibrate(self, color):
+        Readings already stored are dropped if the store changes size.
         """
-        Load/reload calibration functions
+        with self.lock:
+            self.averagingPeriod = averagingPeriod
+            self.medianWindow = medianWindow
+            capacity = max(self.MIN_CAPACITY, int(averagingPeriod * self.READINGS_PER_SECOND) + 1)
+            if self.values is None or self.values.capacity != capacity:
+                self.values = TiltBuffer(capacity)
+
+            self.resetMedians()
+
+    def resetMedians(self):
         """
+        Set up the median filters over the calibrated readings kept, which
+        are then updated as readings come and go
 
-        # Check for temperature function. If none, then not changed since
-        # last load.
-        self.tempFunction = self.tiltCal("temperature", color)
-        if self.tempFunction is not None:
-            self.tempCal = self.tempFunction
+        The filters are only used with the lock held, they are not safe to
+        update from two threads.
+        """
+        with self.lock:
+            self.tempMedian = None
+            self.gravMedian = None
+            if self.medianWindow:
+                self.tempMedian = SlidingMedian(self.medianWindow)
+                self.gravMedian = SlidingMedian(self.medianWindow)
+                temperatures = self.tempCal.apply(self.values.view(self.values.temperatures))
+                gravities = self.gravCal.apply(self.values.view(self.values.gravities))
+                for temperature, gravity in zip(temperatures.tolist(), gravities.tolist()):
+                    self.tempMedian.add(temperature)
+                    self.gravMedian.add(gravity)
+
+    def calibrate(self):
+        """
+        Reload the calibration files if they changed
+
+        :return: True if the calibration changed
+        """
 
-        # Check for gravity function. If none, then not changed since last
-        # load.
-        self.gravityFunction = self.tiltCal("gravity", color)
-        if self.gravityFunction is not None:
-            self.gravCal = self.gravityFunction
+        with self.lock:
+            changed = self.tempCal.load()
+            changed = self.gravCal.load() or changed
+            if changed:
+                self.resetMedians()
+            return changed
 
     def setValues(self, timestamp, mac, hwVersion, fwVersion, color, temperature, gravity, battery):
         """
         Set/add the latest temperature & gravity readings to the store.
 
-        These values will be calibrated before storing if calibration is
-        enabled
+        The values are stored as read and calibrated when they are
+        averaged or filtered, so they can be calibrated again when the
+        calibration changes.
         """
 
-        self.cleanValues()
-        self.calibrate(color)
-        calTemp = self.tempCal(temperature)
-        calGrav = self.gravCal(gravity)
         # tx_power will be -59 every 5 seconds in order to allow iOS
         # to compute RSSI correctly.  Only use 0 or real value.
         if battery < 0:
             battery = 0
 
-        self.values.append(TiltValue(timestamp, mac, hwVersion, fwVersion, color, temperature, gravity, battery))
+        with self.lock:
+            self.cleanValues()
+            dropped = self.values.append(timestamp.timestamp(), mac, hwVersion, fwVersion, temperature, gravity, battery)
+            if self.tempMedian is not None:
+                self.tempMedian.expire(dropped)
+                self.gravMedian.expire(dropped)
+                self.tempMedian.add(float(self.tempCal.apply(float(temperature))))
+                self.gravMedian.add(float(self.gravCal.apply(float(gravity))))
 
     def getValues(self, color):
         """
@@ -450,166 +954,84 @@ class Tilt:
         been enabled
         """
 
-        colorValues = []
         returnValue = None
 
-        if len(self.values) > 0:
-            for i in range(len(self.values)):
-                if self.values[i].color == color:
-
-                    timestamp = self.values[i].timestamp
-                    mac = self.values[i].mac
-                    hwVersion = self.values[i].hwVersion
-                    fwVersion = self.values[i].fwVersion
-                    temperature = self.values[i].temperature
-                    gravity = self.values[i].gravity
-                    battery = self.values[i].battery
-
-                    colorValues.append(TiltValue(timestamp, mac, hwVersion, fwVersion, color, temperature, gravity, battery))
-
-            if len(colorValues) > 0:
+        with self.lock:
+            if len(self.values) > 0:
                 if self.medianWindow == 0:
-                    returnValue = self.averageValues(color, colorValues)
+                    returnValue = self.averageValues(color)
                 else:
-                    returnValue = self.medianValues(color, colorValues)
+                    returnValue = self.medianValues(color)
 
-            self.cleanValues()
+                self.cleanValues()
 
         return returnValue
 
-    def averageValues(self, color, values):
+    def averageValues(self, color):
         """
         Average all the stored values in the Tilt class (except battery)
 
         :param color:   Color of Tilt to check
-        :param values:  Array containing values to check
         :return:        Averaged values
         """
 
-        returnValue = None
-
-        if len(values) > 0:
-            returnValue = TiltValue()
-            for value in values:
-                returnValue.temperature += value.temperature
-                returnValue.gravity += value.gravity
-
-            # Get last timestamp from values (or 0)
-            returnValue.timestamp = self.getTimestamp(color)
-
-            # Get MAC out of array of values
-            returnValue.mac = self.getMAC(color)
-
-            # Get Hardware version out of array of values
-            returnValue.hwVersion = self.getHwVersion(color)
-
-            # Get Firmware version out of array of values
-            returnValue.fwVersion = self.getFWVersion(color)
-
-            # Average temp and gravity values
-            returnValue.temperature /= len(values)
-            returnValue.gravity /= len(values)
-
-            # Make sure battery returns max of current values (or 0)
-            returnValue.battery = self.getBatteryValue(color)
-
+        returnValue = self.latestValue(color)
+        returnValue.temperature = float(self.tempCal.apply(self.values.view(self.values.temperatures)).mean())
+        returnValue.gravity = float(self.gravCal.apply(self.values.view(self.values.gravities)).mean())
         return returnValue
 
-    def medianValues(self, color, values, window=3):
+    def medianValues(self, color):
         """
         Use a median method across the stored values to reduce noise
 
+        A window of medianWindow values is moved across the stored values
+        taking a median value for each position, with the resultant set
+        averaged. If there are fewer values than the window it shrinks to
+        fit them. The medians are kept up to date as values are stored and
+        expire, see SlidingMedian.
+
         :param color:   Color of Tilt to be checked
-        :param values:  Array containing values to check
-        :param window:  Smoothing window to apply across the data. If the
-                        window is less than the dataset size, the window
-                        will be moved across the dataset taking a median
-                        value for each window, with the resultant set
-                        averaged
         :return: Median value
         """
 
-        # Ensure there are enough values to do a median filter, if not shrink
-        # window temporarily
-        if len(values) < window:
-            window = len(values)
-
-        returnValue = TiltValue()
-
-        # sidebars = (window - 1) / 2
-        medianValueCount = 0
-
-        for i in range(len(values) - (window - 1)):
-            # Work out range of values to do median. At start and end of
-            # assessment, need to pad with start and end values.
-            medianValues = values[i:i + window]
-
-            medianValuesTemp = []
-            medianValuesGravity = []
-
-            # Separate out Temp and Gravity values
-            for medianValue in medianValues:
-                medianValuesTemp.append(medianValue.temperature)
-                medianValuesGravity.append(medianValue.gravity)
-
-            # Add the median value to the running total.
-            returnValue.temperature += numpy.median(
-                numpy.array(medianValuesTemp))
-            returnValue.gravity += numpy.median(
-                numpy.array(medianValuesGravity))
-
-            # Increase count
-            medianValueCount += 1
-
-        # Get last timestamp from values (or 0)
-        returnValue.timestamp = self.getTimestamp(color)
-
-        # Get MAC out of array of values
-        returnValue.mac = self.getMAC(color)
-
-        # Get Hardware version out of array of values
-        returnValue.hwVersion = self.getHwVersion(color)
+        returnValue = self.latestValue(color)
+        returnValue.temperature = self.tempMedian.value()
+        returnValue.gravity = self.gravMedian.value()
+        return returnValue
 
-        # Get Firmware version out of array of values
-        returnValue.fwVersion = self.getFWVersion(color)
+    def latestValue(self, color):
+        """
+        Returns a TiltValue with the timestamp, MAC, versions and battery
+        of the stored values, and no temperature or gravity
 
-        # Average values
-        returnValue.temperature /= medianValueCount
-        returnValue.gravity /= medianValueCount
+        :param color:   Color of Tilt to check
+        :return:        TiltValue
+        """
 
-        # Make sure battery returns max of current values (or 0)
-        returnValue.battery = self.getBatteryValue(color)
-
-        return returnValue
+        return TiltValue(self.getTimestamp(color), self.getMAC(color),
+                         self.getHwVersion(color), self.getFWVersion(color),
+                         color, 0, 0, self.getBatteryValue(color))
 
     def getTimestamp(self, color):
         """
         Return timestamp of last report for a given color
 
-        :param values:  Array of values to be checked
-        :return: Timestamp of last report, or 0
+        :return: datetime of last report, or 0
         """
 
-        timestamps = []
-        for i in range(len(self.values)):
-            value = self.values[i]
-            timestamps.append(value.timestamp)
-
-        return max(timestamps)
+        if len(self.values) == 0:
+            return 0
+        return datetime.datetime.fromtimestamp(self.values.timestamps[self.values.end - 1])
 
     def getBatteryValue(self, color):
         """
         Return battery age in weeks for a given color
 
-        :param values:  An array of Tilt values
         :return: Integer of battery age in weeks, or 0
         """
 
-        batteryValues = []
-        for i in range(len(self.values)):
-            value = self.values[i]
-            if not value.battery == 197: # Skip -59 (197 unsigned)
-                batteryValues.append(value.battery)
+        batteryValues = self.values.view(self.values.batteries)
+        batteryValues = batteryValues[batteryValues != 197] # Skip -59 (197 unsigned)
 
         # Since tx_power will be -59 every 5 seconds in order to allow iOS
         # to compute RSSI correctly, we cache the last good value and only
@@ -617,7 +1039,7 @@ class Tilt:
         # zeroes.  A zero value should only come from V1 (and maybe v2) Tilts.
         batteryValue = 0
         if len(batteryValues):
-            batteryValue = max(batteryValues)
+            batteryValue = int(batteryValues.max())
         self.lastBatt = max(batteryValue, self.lastBatt)
         return self.lastBatt
 
@@ -625,139 +1047,140 @@ class Tilt:
         """
         Return Hardware Version for a given color
 
-        :param values:  An array of Tilt values
-        :return: Int of TILT_VERSIONS or empty string
+        :return: Int of TILT_VERSIONS or 0
         """
 
-        hwVersions = []
-        for i in range(len(self.values)):
-            value = self.values[i]
-            hwVersions.append(value.hwVersion)
-
-        hwVersion = max(hwVersions)
-        self.lastHwVersion = max(hwVersion, self.lastHwVersion)
+        if len(self.values):
+            hwVersion = int(self.values.view(self.values.hwVersions).max())
+            self.lastHwVersion = max(hwVersion, self.lastHwVersion)
         return self.lastHwVersion
 
     def getFWVersion(self, color):
         """
         Return firmware version for a given color
 
-        :param values:  An array of Tilt values
         :return: Integer of version or 0
         """
 
-        fwVersions = []
-        for i in range(len(self.values)):
-            value = self.values[i]
-            fwVersions.append(value.fwVersion)
-
-        fwVersion = max(fwVersions)
-        self.lastFwVersion = max(fwVersion, self.lastFwVersion)
+        if len(self.values):
+            fwVersion = int(self.values.view(self.values.fwVersions).max())
+            self.lastFwVersion = max(fwVersion, self.lastFwVersion)
         return self.lastFwVersion
 
     def getMAC(self, color):
         """
         Return MAC for a given color
 
-        :param values:  An array of Tilt values
-        :return: String of version or empty string
+        :return: String of MAC or empty string
         """
 
-        macs = []
-        for i in range(len(self.values)):
-            value = self.values[i]
-            macs.append(value.mac)
-
-        mac = max(macs)
-        self.lastMAC = max(mac, self.lastMAC)
+        if len(self.values):
+            mac = max(self.values.view(self.values.macs))
+            self.lastMAC = max(mac, self.lastMAC)
         return self.lastMAC
 
     def cleanValues(self):
         """
-        Clean out stale values that are beyond the desired window
+        Clean out stale values that are beyond the desired window, called
+        with the lock held
 
         :return: None, operates on values in class
         """
 
-        nowTime = datetime.datetime.now()
-
-        for value in self.values:
-            if (nowTime - value.timestamp).seconds >= self.averagingPeriod:
-                self.values.pop(0)
-            else:
-                # The list is sorted in chronological order, so once we've hit
-                # this condition we can stop searching.
-                break
-
-    def tiltCal(self, which, color):
-        """
-        Loads settings from file and create the calibration functions
-
-        :param which: Which value (gravity or temperature) is to be processed
-        :return: The calibration function to be called
-        """
-
-        # Default time in seconds to wait before checking config files to see if
-        # calibration data has changed.
-        DATA_REFRESH_WINDOW = 60
+        expired = self.values.expire(time() - self.averagingPeriod)
+        if expired and self.tempMedian is not None:
+            self.tempMedian.expire(expired)
+            self.gravMedian.expire(expired)
 
-        originalValues = []
-        actualValues = []
-        csvFile = None
-        path = dirname(abspath(__file__))
-        configDir = '{0}/settings/'.format(path)
-        filename = '{0}{1}.{2}'.format(
-            configDir, which.upper(), color.lower())
 
-        lastChecked = self.calibrationDataTime.get(which + "_checked", 0)
-        if (int(time()) - lastChecked) < DATA_REFRESH_WINDOW:
-            # Only check every DATA_REFRESH_WINDOW seconds
-            return None
+def medianBenchmark(window, kept=390, readings=3900, every=3):
+    """
+    Times the median filter over a stream of readings, keeping the last
+    kept of them (390 is about 300 seconds of a Tilt) and asking for the
+    filtered value every few readings, as brewpi.py does on each 'T' line
+
+    Params:
+    window: Median window
+    kept: Number of readings kept
+    readings: Number of readings streamed
+    every: Readings between each request for the filtered value
+
+    Returns:
+    Tuple of (requests/s recalculating, requests/s kept up to date)
+    """
+    values = 1.050 + numpy.random.default_rng(1).normal(0, 0.001, readings)
+    requests = 0
+    start = perf_counter()
+    for i in range(every, readings + 1, every):
+        meanOfMedians(values[max(0, i - kept):i], window)
+        requests += 1
+    recalculated = requests / (perf_counter() - start)
+
+    median = SlidingMedian(window)
+    start = perf_counter()
+    for i, value in enumerate(values.tolist()):
+        if i >= kept:
+            median.expire(1)
+        median.add(value)
+        if (i + 1) % every == 0:
+            median.value()
+    incremental = requests / (perf_counter() - start)
+    return recalculated, incremental
+
+
+def decodeBenchmark(count=20000):
+    """
+    Times decoding replayed Tilt advertisements, as aioblescan's HCI_Event
+    and as decodeAdvertisement() does it
 
-        lastLoaded = self.calibrationDataTime.get(which, 0)
-        self.calibrationDataTime[which + "_checked"] = int(time())
+    Params:
+    count: Number of packets
 
-        try:
-            if isfile(filename):
-                fileModificationTime = getmtime(filename)
-                if lastLoaded >= fileModificationTime:
-                    # No need to load, no change
-                    return None
-                csvFile = open(filename, "rb")
-                csvFileReader = reader(csvFile, skipinitialspace=True)
-                self.calibrationDataTime[which] = fileModificationTime
-
-                for row in csvFileReader:
-                    # Skip any blank or comment rows
-                    if row != [] and row[0][:1] != "#":
-                        originalValues.append(Decimal(row[0]))
-                        actualValues.append(Decimal(row[1]))
-                # Close file
-                csvFile.close()
-        except IOError:
-            print('Tilt ({0}): {1}: No calibration data ({2})'.format(
-                color, which.capitalize(), filename))
-        except Exception as e:
-            print('ERROR: Tilt ({0}): Unable to initialise {1} calibration data ({2}) - {3}'.format(
-                color, which.capitalize(), filename, e))
-            # Attempt to close the file
-            if csvFile is not None:
-                # Close file
-                csvFile.close()
-
-        # If more than one values, use Polyfill
-        if len(actualValues) >= 1:
-            poly = numpy.poly1d(numpy.polyfit(
-                originalValues, actualValues, deg=min(3, len(x)-1)))
-
-            def returnFunction(x): return poly(x, color)
-            print('Tilt ({0}): Initialized {1} Calibration: Polyfill'.format(
-                color, which.capitalize()))
+    Returns:
+    Tuple of (packets/s with HCI_Event, packets/s with decodeAdvertisement)
+    """
+    packets = [advertisement(TILT_COLORS[i % len(TILT_COLORS)], 68, 1050 + i % 10, 3,
+                             'aa:bb:cc:dd:ee:{:02x}'.format(i % len(TILT_COLORS)))
+               for i in range(count)]
+    start = perf_counter()
+    for data in packets:
+        ev = aioblescan.HCI_Event()
+        ev.decode(data)
+        ev.retrieve("Manufacturer Specific Data")[0].payload[1].val.hex()
+        ev.retrieve("peer")
+        ev.retrieve("rssi")
+        ev.retrieve('ev type')
+    hciEvent = count / (perf_counter() - start)
+    start = perf_counter()
+    for data in packets:
+        decodeAdvertisement(data)
+    return hciEvent, count / (perf_counter() - start)
+
+
+def prefilterBenchmark(count=100000):
+    """
+    Times turning away replayed advertisements of other devices, by
+    decoding them and by the prefilter
 
-        else:
-            def returnFunction(x): return x
+    Params:
+    count: Number of packets
 
-        return returnFunction
+    Returns:
+    Tuple of (packets/s decoding, packets/s prefiltering)
+    """
+    # A phone's advertisement: flags, a name and manufacturer data
+    data = b'\x02\x01\x06\x0b\x09Phone12345\x07\xff\x06\x00\x01\x09\x20\x02'
+    report = pack('<BBB6sB', 1, 0, 1, bytes(6), len(data)) + data + pack('b', -80)
+    packet = pack('<BBBB', 0x04, 0x3e, len(report) + 1, 0x02) + report
+    packets = [packet] * count
+    start = perf_counter()
+    for data in packets:
+        decodeAdvertisement(data)
+    decoding = count / (perf_counter() - start)
+    start = perf_counter()
+    for data in packets:
+        isTiltPacket(data)
+    return decoding, count / (perf_counter() - start)
 
 
 def check_mac(mac):
@@ -833,6 +1256,12 @@ def parseArgs():
         type=int,
         default=None,
         help="number of entries in median window")
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action='store_true',
+        default=False,
+        help="time the median filter and decoding, and exit")
     try:
         opts = parser.parse_args()
         opts.col = opts.col.title() if opts.col else None
@@ -913,6 +1342,22 @@ def main():
 
     print("\nTilt BLEacon test.")
     opts = parseArgs()
+
+    if opts.benchmark:
+        print("\nMedian filter of 390 readings, requests per second:")
+        for window in (3, 10, 50, 101, 390):
+            recalculated, incremental = medianBenchmark(window)
+            print("\tWindow {}: {:.0f}/s recalculating, {:.0f}/s kept up to date ({:.0f}x)".format(
+                window, recalculated, incremental, incremental / recalculated))
+        hciEvent, raw = decodeBenchmark()
+        print("\nDecoding replayed Tilt packets, packets per second:")
+        print("\t{:.0f}/s with HCI_Event, {:.0f}/s from the raw bytes ({:.0f}x)".format(
+            hciEvent, raw, raw / hciEvent))
+        decoding, prefiltering = prefilterBenchmark()
+        print("\nTurning away other devices' packets, packets per second:")
+        print("\t{:.0f}/s decoding, {:.0f}/s with the prefilter ({:.0f}x)".format(
+            decoding, prefiltering, prefiltering / decoding))
+        return
     tiltColorName = None
     averaging = 0
     median = 0
@@ -972,6 +1417,7 @@ def main():
                             print("{}:\tLast Report: {}\n\tMAC: {}, Version: {}, Firmware: {}\n\tTemp: {}°F, Gravity: {}, Battery: {} weeks old".format(color, timestamp, mac.upper(), TILT_VERSIONS[hwVersion], fwVersion, temperature, gravity, battery))
                         else:
                             print("{}:\tNo results returned.".format(color))
+                print("Packets:\t{accepted} accepted, {rejected} rejected".format(**tilt.stats()))
 
     except KeyboardInterrupt:
         print('\nKeyboard interrupt.')
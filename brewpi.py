@@ -58,7 +58,16 @@ import simplejson as json
 from configobj import ConfigObj
 
 import BrewConvert
+import brewpiAnalytics
+import brewpiCompress
+import brewpiConfig
+import brewpiDataLog
+import brewpiDatabase
+import brewpiHistory
+import brewpiManifest
+import brewpiPipeline
 import brewpiJson
+import brewpiSinks
 import BrewPiProcess
 import BrewPiUtil as util
 import brewpiVersion
@@ -115,10 +124,12 @@ version = "0.0.0"
 branch = "unknown"
 commit = "unknown"
 configFile = None
+settings = None  # Typed settings, see brewpiConfig
 config = None
 dontRunFilePath = None
 checkDontRunFile = False
 checkStartupOnly = False
+repairPerms = False
 logToFiles = False
 logPath = None
 outputJson = None  # Print JSON to logs
@@ -126,6 +137,7 @@ localJsonFileName = None
 localCsvFileName = None
 wwwJsonFileName = None
 wwwCsvFileName = None
+persistence = None  # Background thread writing samples to the JSON and CSV files
 lastDay = None
 day = None
 thread = False
@@ -133,6 +145,11 @@ threads = []
 tilt = None
 ispindel = None
 tiltbridge = False
+compactor = None  # Background compression of closed day files
+history = None  # Recent readings kept in memory for the live chart
+analytics = None  # Rolling statistics of the readings
+database = None  # Optional SQLite store of readings and events
+sinks = None  # Publishes each sample to the file, database and network outputs
 
 # Timestamps to expire values
 lastBbApi = 0
@@ -190,6 +207,7 @@ def options():  # Parse command line options
     global configFile
     global checkStartupOnly
     global logToFiles
+    global repairPerms
 
     parser = argparse.ArgumentParser(
         description="Main BrewPi script which communicates with the controller(s)")
@@ -212,6 +230,8 @@ def options():  # Parse command line options
         "-d", "--donotrun", help="check for do not run semaphore", action='store_true')
     parser.add_argument(
         "-o", "--check", help="exit after startup checks", action='store_true')
+    parser.add_argument(
+        "--repair-perms", help="set owner and permissions on all data files and exit", action='store_true')
     args = parser.parse_args()
 
     # Supply a config file
@@ -282,11 +302,30 @@ def options():  # Parse command line options
     if args.check:
         checkStartupOnly = True
 
+    # Fix ownership of all data files once, e.g. after restoring a backup
+    if args.repair_perms:
+        repairPerms = True
+
 
 def config():  # Load config file
     global configFile
     global config
     config = util.readCfgWithDefaults(configFile)
+    loadSettings()
+
+
+def loadSettings():  # Convert the settings once, see brewpiConfig
+    global settings
+    settings, errors = brewpiConfig.parse(
+        config, util.getConfigStore(configFile).getDefaults())
+    for error in errors:
+        logError("{0}, using the default.".format(error))
+
+
+def setConfig(settingName, value):  # Change a setting in the config file
+    global config
+    config = util.configSet(settingName, value, configFile)
+    loadSettings()
 
 
 def checkDoNotRun():  # Check do not run file
@@ -344,30 +383,7 @@ def setUpLog():  # Set up log files
 
 
 def getWwwSetting(settingName):  # Get www json setting with default
-    setting = None
-    wwwPath = util.addSlash(config['wwwPath'])
-    userSettings = '{0}userSettings.json'.format(wwwPath)
-    defaultSettings = '{0}defaultSettings.json'.format(wwwPath)
-    try:
-        json_file = open(userSettings, 'r')
-        data = json.load(json_file)
-        # If settingName exists, get value
-        if checkKey(data, settingName):
-            setting = data[settingName]
-        json_file.close()
-    except:
-        # userSettings.json does not exist
-        try:
-            json_file = open(defaultSettings, 'r')
-            data = json.load(json_file)
-            # If settingName exists, get value
-            if checkKey(data, settingName):
-                setting = data[settingName]
-            json_file.close()
-        except:
-            # defaultSettings.json does not exist, use None
-            pass
-    return setting
+    return util.getWwwSettings(config['wwwPath']).get(settingName)
 
 
 def checkKey(dict, key):  # Check to see if a key exists in a dictionary
@@ -380,30 +396,12 @@ def checkKey(dict, key):  # Check to see if a key exists in a dictionary
 def changeWwwSetting(settingName, value):
     # userSettings.json is a copy of some of the settings that are needed by the
     # web server. This allows the web server to load properly, even when the script
-    # is not running.
-    wwwSettingsFileName = '{0}userSettings.json'.format(
-        util.addSlash(config['wwwPath']))
-    if os.path.exists(wwwSettingsFileName):
-        wwwSettingsFile = open(wwwSettingsFileName, 'r+b')
-        try:
-            wwwSettings = json.load(wwwSettingsFile)  # read existing settings
-        except json.JSONDecodeError:
-            logMessage(
-                "Error while decoding userSettings.json, creating new empty json file.")
-            # Start with a fresh file when the json is corrupt.
-            wwwSettings = {}
-    else:
-        wwwSettingsFile = open(wwwSettingsFileName, 'w+b')  # Create new file
-        wwwSettings = {}
+    # is not running. Changes are written by flushWwwSettings() once per loop.
+    util.getWwwSettings(config['wwwPath']).set(settingName, value)
 
-    try:
-        wwwSettings[settingName] = value
-        wwwSettingsFile.seek(0)
-        wwwSettingsFile.write(json.dumps(wwwSettings).encode(encoding="cp437"))
-        wwwSettingsFile.truncate()
-        wwwSettingsFile.close()
-    except:
-        logError("Ran into an error writing the WWW JSON file.")
+
+def flushWwwSettings():  # Write changed www settings to userSettings.json
+    util.getWwwSettings(config['wwwPath']).flush()
 
 
 def setFiles():
@@ -414,6 +412,11 @@ def setFiles():
     global wwwCsvFileName
     global lastDay
     global day
+    global compactor
+    global history
+
+    # Remember the file we are closing so it can be compressed
+    closedJsonFileName = localJsonFileName
 
     # Concatenate directory names for the data
     beerFileName = config['beerName']
@@ -422,68 +425,40 @@ def setFiles():
     wwwDataPath = '{0}data/{1}/'.format(
         util.addSlash(config['wwwPath']), beerFileName)
 
-    # Create path and set owner and perms (recursively) on directories and files
-    owner = 'brewpi'
-    group = 'brewpi'
-    uid = pwd.getpwnam(owner).pw_uid  # Get UID
-    gid = grp.getgrnam(group).gr_gid  # Get GID
-    fileMode = stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH | stat.S_IROTH  # 664
-    dirMode = stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH | stat.S_IROTH | stat.S_IXOTH  # 775
-    if not os.path.exists(dataPath):
-        os.makedirs(dataPath)  # Create path if it does not exist
-    os.chown(dataPath, uid, gid)  # chown root directory
-    os.chmod(dataPath, dirMode)  # chmod root directory
-    for root, dirs, files in os.walk(dataPath):
-        for dir in dirs:
-            os.chown(os.path.join(root, dir), uid, gid)  # chown directories
-            os.chmod(dir, dirMode)  # chmod directories
-        for file in files:
-            if os.path.isfile(file):
-                os.chown(os.path.join(root, file), uid, gid)  # chown files
-                os.chmod(file, fileMode)  # chmod files
-
-    # Create path and set owner and perms (recursively) on directories and files
-    owner = 'brewpi'
-    group = 'www-data'
-    uid = pwd.getpwnam(owner).pw_uid  # Get UID
-    gid = grp.getgrnam(group).gr_gid  # Get GID
-    fileMode = stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH | stat.S_IROTH  # 664
-    dirMode = stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH | stat.S_IROTH | stat.S_IXOTH  # 775
-    if not os.path.exists(wwwDataPath):
-        os.makedirs(wwwDataPath)  # Create path if it does not exist
-    os.chown(wwwDataPath, uid, gid)  # chown root directory
-    os.chmod(wwwDataPath, dirMode)  # chmod root directory
-    for root, dirs, files in os.walk(wwwDataPath):
-        for dir in dirs:
-            os.chown(os.path.join(root, dir), uid, gid)  # chown directories
-            os.chmod(dir, dirMode)  # chmod directories
-        for file in files:
-            if os.path.isfile(file):
-                os.chown(os.path.join(root, file), uid, gid)  # chown files
-                os.chmod(file, fileMode)  # chmod files
+    # Create the directories if needed, new ones get the owner, group and
+    # mode of their tree (see initPermissions)
+    util.permissions.makeDirs(dataPath)
+    util.permissions.makeDirs(wwwDataPath)
+
+    # Index of the day files of this beer
+    manifest = brewpiManifest.getManifest(dataPath, wwwDataPath)
+
+    # Repair files left behind by a crash or power cut from their journals
+    if closedJsonFileName is None:
+        brewpiDataLog.recoverAll(dataPath, manifest)
 
     # Keep track of day and make new data file for each day
     day = time.strftime("%Y%m%d")
     lastDay = day
-    # Define a JSON file to store the data
-    jsonFileName = '{0}-{1}'.format(beerFileName, day)
-
-    # If a file for today already existed, add suffix
-    if os.path.isfile('{0}{1}.json'.format(dataPath, jsonFileName)):
-        i = 1
-        while os.path.isfile('{0}{1}-{2}.json'.format(dataPath, jsonFileName, str(i))):
-            i += 1
-        jsonFileName = '{0}-{1}'.format(jsonFileName, str(i))
+    # Define a JSON file to store the data, the manifest adds a suffix if a
+    # file for today already exists
+    jsonFileName = os.path.splitext(manifest.nextFileName(
+        '{0}-{1}'.format(beerFileName, day)))[0]
 
     localJsonFileName = '{0}{1}.json'.format(dataPath, jsonFileName)
 
     # Handle if we are running Tilt or iSpindel
-    if checkKey(config, 'tiltColor'):
-        brewpiJson.newEmptyFile(localJsonFileName, config['tiltColor'], None)
+    chartFormat = settings.chartFormat
+    if tiltSchema():
+        brewpiJson.newEmptyFile(localJsonFileName, tiltSchema(), None, chartFormat)
     elif checkKey(config, 'iSpindel'):
-        brewpiJson.newEmptyFile(localJsonFileName, None, config['iSpindel'])
+        brewpiJson.newEmptyFile(localJsonFileName, None, config['iSpindel'], chartFormat)
     else:
-        brewpiJson.newEmptyFile(localJsonFileName, None, None)
+        brewpiJson.newEmptyFile(localJsonFileName, None, None, chartFormat)
+    util.permissions.newFile(localJsonFileName)
+    manifest.addFile(os.path.basename(localJsonFileName), brewpiJson.columnIds(
+        tiltSchema(), config.get('iSpindel') or None))
+    manifest.save()
 
     # Define a location on the web server to copy the file to after it is written
     wwwJsonFileName = wwwDataPath + jsonFileName + '.json'
@@ -492,6 +467,37 @@ def setFiles():
     localCsvFileName = (dataPath + beerFileName + '.csv')
     wwwCsvFileName = (wwwDataPath + beerFileName + '.csv')
 
+    dataLog = brewpiDataLog.DataLog(
+        localJsonFileName, localCsvFileName, wwwJsonFileName, wwwCsvFileName,
+        tiltSchema(), config.get('iSpindel') or None,
+        settings.logDurability,
+        settings.logFlushInterval, settings.logFlushRows,
+        manifest)
+
+    # Keep the last historyHours of readings in memory for the live chart,
+    # carried over from one day to the next
+    columns = brewpiJson.columnIds(tiltSchema(), config.get('iSpindel') or None)[1:]
+    capacity = int(settings.historyHours * 3600 / float(settings.interval)) + 1
+    if history is None or history.columns != columns or history.capacity != capacity:
+        history = brewpiHistory.History(columns, capacity)
+
+    # Hand closed day files to the compactor. Only the data tree is
+    # compressed, the web chart loads the plain .json copies.
+    onClosed = None
+    if compactor is not None:
+        method = settings.compressData
+        if closedJsonFileName is None:
+            # Starting up, pick up anything left from earlier runs
+            compactor.scan(dataPath, localJsonFileName, method, manifest.onCompressed)
+        else:
+            # Only once the old files have been written for the last time
+            def onClosed():
+                compactor.add(closedJsonFileName, method, manifest.onCompressed)
+
+    # The persistence thread finishes writing the old files before switching
+    # to the new ones
+    persistence.setWriter(dataLog, onClosed)
+
 
 def startBeer(beerName):
     global config
@@ -503,9 +509,11 @@ def startBeer(beerName):
 def startNewBrew(newName):
     global config
     if len(newName) > 1:
-        config = util.configSet('beerName', newName, configFile)
-        config = util.configSet('dataLogging', 'active', configFile)
+        with util.configTransaction(configFile):
+            setConfig('beerName', newName)
+            setConfig('dataLogging', 'active')
         startBeer(newName)
+        analytics.reset()
         logMessage("Restarted logging for beer '%s'." % newName)
         return {'status': 0, 'statusMessage': "Successfully switched to new brew '%s'. " % urllib.parse.unquote(newName) +
                                               "Please reload the page."}
@@ -517,8 +525,10 @@ def startNewBrew(newName):
 def stopLogging():
     global config
     logMessage("Stopped data logging temp control continues.")
-    config = util.configSet('beerName', None, configFile)
-    config = util.configSet('dataLogging', 'stopped', configFile)
+    persistence.setWriter(None)
+    with util.configTransaction(configFile):
+        setConfig('beerName', None)
+        setConfig('dataLogging', 'stopped')
     changeWwwSetting('beerName', None)
     return {'status': 0, 'statusMessage': "Successfully stopped logging."}
 
@@ -527,7 +537,8 @@ def pauseLogging():
     global config
     logMessage("Paused logging data, temp control continues.")
     if config['dataLogging'] == 'active':
-        config = util.configSet('dataLogging', 'paused', configFile)
+        persistence.close()
+        setConfig('dataLogging', 'paused')
         return {'status': 0, 'statusMessage': "Successfully paused logging."}
     else:
         return {'status': 1, 'statusMessage': "Logging already paused or stopped."}
@@ -537,7 +548,7 @@ def resumeLogging():
     global config
     logMessage("Continued logging data.")
     if config['dataLogging'] == 'paused':
-        config = util.configSet('dataLogging', 'active', configFile)
+        setConfig('dataLogging', 'active')
         return {'status': 0, 'statusMessage': "Successfully continued logging."}
     else:
         return {'status': 1, 'statusMessage': "Logging was not paused."}
@@ -580,10 +591,27 @@ def checkBluetooth(interface=0):
     return sock
 
 
+def tiltColors():  # Colors of the Tilts read, tiltColors or else tiltColor
+    if settings.tiltColors:
+        return settings.tiltColors
+    return [settings.tiltColor] if settings.tiltColor else []
+
+
+def tiltSchema():  # Tilt columns of the data files, see brewpiJson.tiltColumns()
+    return settings.tiltColors or settings.tiltColor
+
+
+def updateHighResTilt():  # isHighResTilt if any configured Tilt is a Pro
+    versions = [prevTempJson.get(color + 'HWVer') for color in tiltColors()]
+    versions = [version for version in versions if version is not None]
+    if versions:  # Keep the setting while no Tilt is heard
+        persistence.setting('isHighResTilt', any(version == 4 for version in versions))
+
+
 def initTilt():  # Set up Tilt
     global config
     global tilt
-    if checkKey(config, 'tiltColor') and config['tiltColor'] != "":
+    if tiltColors():
         if not checkBluetooth():
             logError("Configured for Tilt but no Bluetooth radio available.")
         else:
@@ -599,14 +627,86 @@ def initTilt():  # Set up Tilt
             tilt.loadSettings()
             tilt.start()
             # Create prevTempJson for Tilt
-            if not checkKey(prevTempJson, config['tiltColor'] + 'SG'):
-                prevTempJson.update({
-                    config['tiltColor'] + 'HWVer': 0,
-                    config['tiltColor'] + 'SWVer': 0,
-                    config['tiltColor'] + 'SG': 0,
-                    config['tiltColor'] + 'Temp': 0,
-                    config['tiltColor'] + 'Batt': 0
-                })
+            for color in tiltColors():
+                if not checkKey(prevTempJson, color + 'SG'):
+                    prevTempJson.update({
+                        color + 'HWVer': 0,
+                        color + 'SWVer': 0,
+                        color + 'SG': 0,
+                        color + 'Temp': 0,
+                        color + 'Batt': 0
+                    })
+
+
+def initCompactor():  # Set up compression of closed day files
+    global compactor
+    if settings.compressData in brewpiCompress.COMPRESSORS:
+        compactor = brewpiCompress.Compactor()
+        compactor.start()
+
+
+def initPermissions():  # Register owner and group of the data trees
+    util.permissions.addTree('{0}data/'.format(util.scriptPath()), 'brewpi', 'brewpi')
+    util.permissions.addTree('{0}data/'.format(util.addSlash(config['wwwPath'])), 'brewpi', 'www-data')
+
+
+def initDatabase():  # Start the optional SQLite store
+    global database
+    if settings.database == 'sqlite':
+        fileName = settings.databaseFile or '{0}data/brewpi.sqlite'.format(util.scriptPath())
+        database = brewpiDatabase.Database(fileName)
+        try:
+            database.start()
+        except brewpiDatabase.sqlite3.Error as e:
+            logError("Unable to open database {0}: {1}".format(fileName, e))
+            database = None
+            return
+        sinks.add(database)
+
+
+def initPersistence():  # Start the thread writing samples to disk
+    global persistence
+    global sinks
+    sinks = brewpiPipeline.SinkHub()
+    persistence = brewpiPipeline.PersistenceStage(
+        changeWwwSetting, settings.logQueueSize)
+    persistence.start()
+    sinks.add(persistence)
+
+
+def initAnalytics():  # Set up the rolling statistics
+    global analytics
+    # Follow one hydrometer, the first Tilt color or else the iSpindel
+    if tiltColors():
+        sgColumn = tiltColors()[0] + 'SG'
+    elif config.get('iSpindel'):
+        sgColumn = 'spinSG'
+    else:
+        sgColumn = None
+    analytics = brewpiAnalytics.Analytics(
+        [hours * 3600 for hours in settings.analyticsWindows],
+        og=settings.originalGravity, fg=settings.finalGravity, sgColumn=sgColumn)
+
+
+def initSinks():  # Start the optional network outputs
+    url = config.get('httpSink', '')
+    if url:
+        sink = brewpiSinks.HttpPostSink(
+            url, batchWindow=settings.httpSinkInterval)
+        sink.start()
+        sinks.add(sink)
+    url = config.get('exportUrl', '')
+    if url:
+        try:
+            sink = brewpiSinks.LineProtocolSink(
+                url, config.get('exportMeasurement', 'brewpi'),
+                config.get('exportSpool', '{0}data/export.spool'.format(util.scriptPath())),
+                batchWindow=settings.exportInterval)
+        except ValueError as e:
+            logError("Not exporting readings: {0}".format(e))
+            return
+        sink.start()
+        sinks.add(sink)
 
 
 def initISpindel():  # Initialize iSpindel
@@ -648,14 +748,12 @@ def setSocket():  # Create a listening socket to communicate with PHP
     global phpSocket
     global serialCheckInterval
     is_windows = sys.platform.startswith('win')
-    useInetSocket = bool(config.get('useInetSocket', is_windows))
+    useInetSocket = settings.useInetSocket if 'useInetSocket' in config else is_windows
     if useInetSocket:
         phpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         phpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        socketPort = config.get('socketPort', 6332)
-        phpSocket.bind(
-            (config.get('socketHost', 'localhost'), int(socketPort)))
-        logMessage('Bound to TCP socket on port %d ' % int(socketPort))
+        phpSocket.bind((settings.socketHost, settings.socketPort))
+        logMessage('Bound to TCP socket on port %d ' % settings.socketPort)
     else:
         socketFile = util.scriptPath() + 'BEERSOCKET'
         if os.path.exists(socketFile):
@@ -692,20 +790,11 @@ def startLogs():  # Log startup messages
     global version
     global branch
     global commit
-    global outputJson
 
     # Output the current script version
     logMessage('{0} ({1}) [{2}]'.format(version, branch, commit))
 
-    # Log JSON:
-    #   True    = Full
-    #   False   = Terse message
-    #   None    = No JSON
-    if checkKey(config, 'logJson'):
-        if config['logJson'] == 'True':
-            outputJson = True
-        else:
-            outputJson = False
+    setOutputJson()
 
     if config['beerName'] == 'None':
         logMessage("Not currently logging.")
@@ -714,6 +803,76 @@ def startLogs():  # Log startup messages
                    urllib.parse.unquote(config['beerName']) + ".'")
 
 
+def setOutputJson():  # Set how much of the controller JSON is logged
+    global outputJson
+    # Log JSON:
+    #   True    = Full
+    #   False   = Terse message
+    #   None    = No JSON
+    outputJson = settings.logJson
+
+
+def reloadConfig():  # Apply changes to the config file without restarting
+    global config
+    global tilt
+    global ispindel
+    global compactor
+    oldSettings = settings
+    store = util.getConfigStore(configFile)
+    newConfig = store.get()
+    if store.parseError:
+        # A typo must not put the defaults, e.g. another beerName, in place
+        logError("Not reloading settings, config file could not be parsed: {0}".format(store.parseError))
+        return {'status': 1, 'statusMessage': "Config file could not be parsed, settings not changed."}
+    config = newConfig
+    loadSettings()
+    changed = brewpiConfig.changes(oldSettings, settings)
+    if not changed:
+        return {'status': 0, 'statusMessage': "No settings changed."}
+    logMessage("Reloading changed settings: {0}.".format(', '.join(changed)))
+
+    if 'logJson' in changed:
+        setOutputJson()
+    if 'tiltColor' in changed or 'tiltColors' in changed:
+        if tilt is not None:
+            tilt.stop()
+            tilt = None
+        initTilt()
+    if 'iSpindel' in changed:
+        ispindel = None
+        initISpindel()
+    if 'compressData' in changed:
+        if compactor is not None:
+            compactor.stop()
+            compactor = None
+        initCompactor()
+    # A new hydrometer starts new statistics
+    if any(name in changed for name in ['analyticsWindows', 'tiltColor', 'tiltColors', 'iSpindel']):
+        initAnalytics()
+    else:
+        analytics.og = settings.originalGravity
+        analytics.fg = settings.finalGravity
+        analytics.cache = None
+
+    # Start new data files when their columns, layout or logging changed
+    fileSettings = ['beerName', 'dataLogging', 'tiltColor', 'tiltColors', 'iSpindel', 'chartFormat',
+                    'logDurability', 'logFlushInterval', 'logFlushRows', 'interval', 'historyHours']
+    if any(name in changed for name in fileSettings):
+        if settings.dataLogging == 'active' and settings.beerName is not None:
+            startBeer(config['beerName'])
+        elif settings.dataLogging == 'paused':
+            persistence.close()
+        else:
+            persistence.setWriter(None)
+            changeWwwSetting('beerName', None)
+
+    restart = [name for name in changed if name in brewpiConfig.RESTART_SETTINGS]
+    if restart:
+        logMessage("Restart BrewPi to apply: {0}.".format(', '.join(restart)))
+    return {'status': 0, 'statusMessage': "Reloaded settings: {0}.".format(', '.join(changed)) +
+            (" Restart BrewPi to apply: {0}.".format(', '.join(restart)) if restart else "")}
+
+
 def clamp(raw, minn, maxn):
     # Clamps value (raw) between minn and maxn
     return max(min(maxn, raw), minn)
@@ -735,7 +894,7 @@ def startSerial():  # Start controller
         else:
             # Wait for 10 seconds to allow an Uno to reboot
             logMessage("Waiting 10 seconds for board to restart.")
-            time.sleep(int(config.get('startupDelay', 10)))
+            time.sleep(settings.startupDelay)
 
         logMessage("Checking software version on controller.")
         hwVersion = brewpiVersion.getVersionFromSerial(serialConn)
@@ -843,6 +1002,7 @@ def loop():  # Main program loop
 
     bc = BrewConvert.BrewConvert()
     run = True  # Allow script loop to run
+    prevConfigCheck = time.time()
 
     try:  # Main loop
         while run:
@@ -854,6 +1014,24 @@ def loop():  # Main program loop
                     logMessage("New day, creating new JSON file.")
                     setFiles()
 
+            # Write www settings changed in the last pass
+            flushWwwSettings()
+
+            # Apply changes made to the config file by hand
+            if time.time() - prevConfigCheck > 5:
+                prevConfigCheck = time.time()
+                if util.getConfigStore(configFile).changed():
+                    reloadConfig()
+                # and to the Tilt calibration files
+                if tilt is not None:
+                    colors = tilt.reloadCalibration()
+                    if colors:
+                        logMessage("Reloaded Tilt calibration: {0}.".format(', '.join(colors)))
+
+            # Report problems from the output threads
+            for error in sinks.checkErrors():
+                logError(error)
+
             if os.path.exists(dontRunFilePath):
                 # Allow stopping script via semaphore
                 logMessage("Semaphore detected, exiting.")
@@ -877,6 +1055,10 @@ def loop():  # Main program loop
                     messageType = message
                     value = ""
 
+                # Record changes made over the socket
+                if database is not None and messageType in brewpiDatabase.EVENT_COMMANDS:
+                    database.addEvent(config['beerName'], messageType, value)
+
                 if messageType == "ack":  # Acknowledge request
                     phpConn.send("ack".encode(encoding="utf-8"))
                 elif messageType == "lcd":  # LCD contents requested
@@ -1005,8 +1187,7 @@ def loop():  # Main program loop
                     newInterval = int(value)
                     if 5 < newInterval < 5000:
                         try:
-                            config = util.configSet(
-                                'interval', Decimal(newInterval), configFile)
+                            setConfig('interval', Decimal(newInterval))
                         except ValueError:
                             logMessage(
                                 "Cannot convert interval '{0}' to float.".format(value))
@@ -1026,16 +1207,57 @@ def loop():  # Main program loop
                 elif messageType == "resumeLogging":  # Resume logging
                     result = resumeLogging()
                     phpConn.send(json.dumps(result).encode(encoding="utf-8"))
+                elif messageType == "reloadConfig":  # Apply changes to the config file
+                    result = reloadConfig()
+                    phpConn.send(json.dumps(result).encode(encoding="utf-8"))
+                elif messageType == "reloadCalibration":  # Apply changed Tilt calibration files
+                    if tilt is not None:
+                        colors = tilt.reloadCalibration()
+                        result = {'status': 0, 'statusMessage': "Reloaded calibration: {0}.".format(
+                            ', '.join(colors)) if colors else "No calibration changed."}
+                    else:
+                        result = {'status': 1, 'statusMessage': "Tilt is not running."}
+                    phpConn.send(json.dumps(result).encode(encoding="utf-8"))
+                elif messageType == "getAnalytics":  # Echo rolling statistics
+                    phpConn.sendall(json.dumps(analytics.results()).encode(encoding="utf-8"))
+                elif messageType == "getRecent":  # Echo recent readings from memory
+                    try:
+                        seconds, since = brewpiHistory.parseRecent(value)
+                    except (ValueError, AttributeError):
+                        # Not the whole buffer for a request we cannot read
+                        logError("Invalid getRecent request '{0}'.".format(value))
+                        recent = {'error': "Invalid getRecent request '{0}'.".format(value)}
+                    else:
+                        if history is not None:
+                            recent = history.recent(seconds, since)
+                        else:
+                            recent = {'cols': [], 'rows': [], 'last': None}
+                    phpConn.sendall(json.dumps(recent).encode(encoding="utf-8"))
+                elif messageType == "queryData":  # Answer a query from the database
+                    if database is not None:
+                        try:
+                            request = json.loads(value)
+                            if isinstance(request, dict):
+                                result = database.query(request)
+                            else:
+                                result = {'error': "Query must be a JSON object."}
+                        except (ValueError, TypeError, AttributeError, KeyError,
+                                brewpiDatabase.sqlite3.Error) as e:
+                            result = {'error': str(e)}
+                    else:
+                        result = {'error': "No database configured."}
+                    phpConn.sendall(json.dumps(result).encode(encoding="utf-8"))
+                elif messageType == "getLogStats":  # Echo write metrics of each output
+                    phpConn.sendall(json.dumps(sinks.stats()).encode(encoding="utf-8"))
                 elif messageType == "dateTimeFormatDisplay":  # Change date time format
-                    config = util.configSet(
-                        'dateTimeFormatDisplay', value, configFile)
+                    setConfig('dateTimeFormatDisplay', value)
                     changeWwwSetting('dateTimeFormatDisplay', value)
                     logMessage("Changing date format config setting: " + value)
                 elif messageType == "setActiveProfile":  # Get and process beer profile
                     # Copy the profile CSV file to the working directory
                     logMessage(
                         "Setting profile '%s' as active profile." % value)
-                    config = util.configSet('profileName', value, configFile)
+                    setConfig('profileName', value)
                     changeWwwSetting('profileName', value)
                     profileSrcFile = util.addSlash(
                         config['wwwPath']) + "data/profiles/" + value + ".csv"
@@ -1174,7 +1396,7 @@ def loop():  # Main program loop
                                 else:
                                     apiTemp = Decimal(bc.convert(api['temp'], 'F', 'C'))
                                 # Clamp and round temp values
-                                apiTemp = clamp(round(apiTemp, 2), Decimal(config['clampTempLower']), Decimal(config['clampTempUpper']))
+                                apiTemp = clamp(round(apiTemp, 2), settings.clampTempLower, settings.clampTempUpper)
 
                                 # Handle ambient temp conversion
                                 apiAmbient = 0
@@ -1185,7 +1407,7 @@ def loop():  # Main program loop
                                 else:
                                     apiAmbient = Decimal(bc.convert(api['ambient'], 'F', 'C'))
                                 # Clamp and round temp values
-                                apiAmbient = clamp(round(apiAmbient, 2), Decimal(config['clampTempLower']), Decimal(config['clampTempUpper']))
+                                apiAmbient = clamp(round(apiAmbient, 2), settings.clampTempLower, settings.clampTempUpper)
 
                                 # Update prevTempJson if keys exist
                                 if checkKey(prevTempJson, 'bbbpm'):
@@ -1234,10 +1456,10 @@ def loop():  # Main program loop
                                         api['temperature'], 'F', 'C')
 
                                 # Clamp and round temp values
-                                _temp = clamp(round(_temp, 2), Decimal(config['clampTempLower']), Decimal(config['clampTempUpper']))
+                                _temp = clamp(round(_temp, 2), settings.clampTempLower, settings.clampTempUpper)
 
                                 # Clamp and round gravity values
-                                _gravity = clamp(api['gravity'], Decimal(config['clampSGLower']), Decimal(config['clampSGUpper']))
+                                _gravity = clamp(api['gravity'], settings.clampSGLower, settings.clampSGUpper)
 
                                 # Capture interval to set timeout
                                 _timeout = round(api['interval'] * 3.5)
@@ -1291,65 +1513,65 @@ def loop():  # Main program loop
                             else:
                                 pass  # Don't log JSON messages
 
-                            # Loop through (value) and match config["tiltColor"]
-                            for t in api:
-                                if t == "tilts":
-                                    if api['tilts']:
-                                        for c in api['tilts']:
-                                            if c == config["tiltColor"]:
-                                                # TiltBridge report reference
-                                                # https://github.com/thorrak/tiltbridge/blob/42adac730105c0efcb4f9ef7e0cacf84f795d333/src/tilt/tiltHydrometer.cpp#L270
-
-                                                # tilt.TILT_VERSIONS = ['Unknown', 'v1', 'v2', 'v3', 'Pro', 'v2 or 3']
-
-                                                if (checkKey(api['tilts'][config['tiltColor']], 'high_resolution') and api['tilts'][config['tiltColor']]['high_resolution']):
-                                                    prevTempJson[config['tiltColor'] + 'HWVer'] = 4
-                                                elif (checkKey(api['tilts'][config['tiltColor']], 'sends_battery') and api['tilts'][config['tiltColor']]['sends_battery']):
-                                                    prevTempJson[config['tiltColor'] + 'HWVer'] = 5 # Battery = >=2
-                                                else:
-                                                    prevTempJson[config['tiltColor'] + 'HWVer'] = 0
-
-                                                if (checkKey(api['tilts'][config['tiltColor']], 'SWVer')):
-                                                    prevTempJson[config["tiltColor"] + 'SWVer'] = int(api['tilts'][config['tiltColor']]['fwVersion'])
-
-                                                # Convert to proper temp unit
-                                                _temp = 0
-                                                if cc['tempFormat'] == api['tilts'][config['tiltColor']]['tempUnit']:
-                                                    _temp = Decimal(api['tilts'][config['tiltColor']]['temp'])
-                                                elif cc['tempFormat'] == 'F':
-                                                    _temp = bc.convert(Decimal(api['tilts'][config['tiltColor']]['temp']), 'C', 'F')
-                                                else:
-                                                    _temp = bc.convert(Decimal(api['tilts'][config['tiltColor']]['temp']), 'F', 'C')
-
-                                                _gravity = Decimal(api['tilts'][config['tiltColor']]['gravity'])
-
-                                                # Clamp and round gravity values
-                                                _temp = clamp(_temp, Decimal(config['clampTempLower']), Decimal(config['clampTempUpper']))
-
-                                                # Clamp and round temp values
-                                                _gravity = clamp(_gravity, Decimal(config['clampSGLower']), Decimal(config['clampSGUpper']))
-
-                                                # Choose proper resolution for SG and Temp
-                                                if (prevTempJson[config['tiltColor'] + 'HWVer']) == 4:
-                                                    changeWwwSetting('isHighResTilt', True)
-                                                    prevTempJson[config['tiltColor'] + 'SG'] = round(_gravity, 4)
-                                                    prevTempJson[config['tiltColor'] + 'Temp'] = round(_temp, 1)
-                                                else:
-                                                    changeWwwSetting('isHighResTilt', False)
-                                                    prevTempJson[config['tiltColor'] + 'SG'] = round(_gravity, 3)
-                                                    prevTempJson[config['tiltColor'] + 'Temp'] = round(_temp)
-
-                                                # Get battery value from anything >= Tilt v2
-                                                if prevTempJson[config['tiltColor'] + 'HWVer']:
-                                                    if int(prevTempJson[config['tiltColor'] + 'HWVer']) >= 2:
-                                                        if (checkKey(api['tilts'][config['tiltColor']], 'weeks_on_battery')):
-                                                            prevTempJson[config["tiltColor"] + 'Batt'] = int(api['tilts'][config['tiltColor']]['weeks_on_battery'])
-
-                                                # Set time of last update
-                                                lastTiltbridge = timestamp = time.time()
+                            # Pick the configured colors out of the report
+                            if api['tilts']:
+                                for color in tiltColors():
+                                    report = api['tilts'].get(color)
+                                    if report is None:
+                                        continue
+                                    # TiltBridge report reference
+                                    # https://github.com/thorrak/tiltbridge/blob/42adac730105c0efcb4f9ef7e0cacf84f795d333/src/tilt/tiltHydrometer.cpp#L270
+
+                                    # tilt.TILT_VERSIONS = ['Unknown', 'v1', 'v2', 'v3', 'Pro', 'v2 or 3']
+
+                                    if (checkKey(report, 'high_resolution') and report['high_resolution']):
+                                        prevTempJson[color + 'HWVer'] = 4
+                                    elif (checkKey(report, 'sends_battery') and report['sends_battery']):
+                                        prevTempJson[color + 'HWVer'] = 5 # Battery = >=2
+                                    else:
+                                        prevTempJson[color + 'HWVer'] = 0
+
+                                    if (checkKey(report, 'SWVer')):
+                                        prevTempJson[color + 'SWVer'] = int(report['fwVersion'])
+
+                                    # Convert to proper temp unit
+                                    _temp = 0
+                                    if cc['tempFormat'] == report['tempUnit']:
+                                        _temp = Decimal(report['temp'])
+                                    elif cc['tempFormat'] == 'F':
+                                        _temp = bc.convert(Decimal(report['temp']), 'C', 'F')
+                                    else:
+                                        _temp = bc.convert(Decimal(report['temp']), 'F', 'C')
+
+                                    _gravity = Decimal(report['gravity'])
+
+                                    # Clamp and round gravity values
+                                    _temp = clamp(_temp, settings.clampTempLower, settings.clampTempUpper)
 
+                                    # Clamp and round temp values
+                                    _gravity = clamp(_gravity, settings.clampSGLower, settings.clampSGUpper)
+
+                                    # Choose proper resolution for SG and Temp
+                                    if (prevTempJson[color + 'HWVer']) == 4:
+                                        prevTempJson[color + 'SG'] = round(_gravity, 4)
+                                        prevTempJson[color + 'Temp'] = round(_temp, 1)
                                     else:
-                                        logError("Failed to parse {} Tilt from Tiltbridge payload.".format(config["tiltColor"]))
+                                        prevTempJson[color + 'SG'] = round(_gravity, 3)
+                                        prevTempJson[color + 'Temp'] = round(_temp)
+
+                                    # Get battery value from anything >= Tilt v2
+                                    if prevTempJson[color + 'HWVer']:
+                                        if int(prevTempJson[color + 'HWVer']) >= 2:
+                                            if (checkKey(report, 'weeks_on_battery')):
+                                                prevTempJson[color + 'Batt'] = int(report['weeks_on_battery'])
+
+                                    # Set time of last update
+                                    lastTiltbridge = timestamp = time.time()
+
+                                updateHighResTilt()
+
+                            else:
+                                logError("Failed to parse {} Tilt from Tiltbridge payload.".format(', '.join(tiltColors())))
 
                         # END:  Tiltbridge Processing
 
@@ -1408,41 +1630,37 @@ def loop():  # Main program loop
 
                     # Begin: Tilt Items
                     if tilt or tiltbridge:
-                        if not prevTempJson[config['tiltColor'] + 'Temp'] == 0:
-                            if checkKey(prevTempJson, config['tiltColor'] + 'SG'):
-                                if prevTempJson[config['tiltColor'] + 'SG'] is not None:
+                        for color in tiltColors():
+                            # Name the Tilt when there are several
+                            prefix = color + " " if len(tiltColors()) > 1 else ""
+                            if prevTempJson.get(color + 'Temp') not in (0, None):
+                                if prevTempJson.get(color + 'SG') is not None:
                                     status[statusIndex] = {}
-                                    statusType = "Tilt SG: "
-                                    if checkKey(prevTempJson, config['tiltColor'] + 'HWVer') and prevTempJson[config['tiltColor'] + 'HWVer'] is not None:
-                                        if prevTempJson[config['tiltColor'] + 'HWVer'] == 4: # If we are running a Pro
-                                            statusValue = format(prevTempJson[config['tiltColor'] + 'SG'], '.4f')
-                                        else:
-                                            statusValue = format(prevTempJson[config['tiltColor'] + 'SG'], '.3f')
-                                    status[statusIndex].update({statusType: statusValue})
-                                    statusIndex = statusIndex + 1
-                        if checkKey(prevTempJson, config['tiltColor'] + 'Batt'):
-                            if prevTempJson[config['tiltColor'] + 'Batt'] is not None:
-                                if not prevTempJson[config['tiltColor'] + 'Batt'] == 0:
-                                    status[statusIndex] = {}
-                                    statusType = "Tilt Batt Age: "
-                                    if round(prevTempJson[config['tiltColor'] + 'Batt']) == 1:
-                                        statusValue = str(round(prevTempJson[config['tiltColor'] + 'Batt'])) + " wk"
+                                    statusType = prefix + "Tilt SG: "
+                                    if prevTempJson.get(color + 'HWVer') == 4: # If we are running a Pro
+                                        statusValue = format(prevTempJson[color + 'SG'], '.4f')
                                     else:
-                                        statusValue = str(round(prevTempJson[config['tiltColor'] + 'Batt'])) + " wks"
-                                    status[statusIndex].update({statusType: statusValue})
-                                    statusIndex = statusIndex + 1
-                        if checkKey(prevTempJson, config['tiltColor'] + 'Temp'):
-                            if prevTempJson[config['tiltColor'] + 'Temp'] is not None:
-                                if not prevTempJson[config['tiltColor'] + 'Temp'] == 0:
-                                    status[statusIndex] = {}
-                                    statusType = "Tilt Temp: "
-                                    if checkKey(prevTempJson, config['tiltColor'] + 'HWVer') and prevTempJson[config['tiltColor'] + 'HWVer'] is not None:
-                                        if prevTempJson[config['tiltColor'] + 'HWVer'] == 4: # If we are running a Pro
-                                            statusValue = format(prevTempJson[config['tiltColor'] + 'Temp'], '.1f') + tempSuffix
-                                        else:
-                                            statusValue = str(round(prevTempJson[config['tiltColor'] + 'Temp'])) + tempSuffix
+                                        statusValue = format(prevTempJson[color + 'SG'], '.3f')
                                     status[statusIndex].update({statusType: statusValue})
                                     statusIndex = statusIndex + 1
+                            if prevTempJson.get(color + 'Batt') not in (0, None):
+                                status[statusIndex] = {}
+                                statusType = prefix + "Tilt Batt Age: "
+                                if round(prevTempJson[color + 'Batt']) == 1:
+                                    statusValue = str(round(prevTempJson[color + 'Batt'])) + " wk"
+                                else:
+                                    statusValue = str(round(prevTempJson[color + 'Batt'])) + " wks"
+                                status[statusIndex].update({statusType: statusValue})
+                                statusIndex = statusIndex + 1
+                            if prevTempJson.get(color + 'Temp') not in (0, None):
+                                status[statusIndex] = {}
+                                statusType = prefix + "Tilt Temp: "
+                                if prevTempJson.get(color + 'HWVer') == 4: # If we are running a Pro
+                                    statusValue = format(prevTempJson[color + 'Temp'], '.1f') + tempSuffix
+                                else:
+                                    statusValue = str(round(prevTempJson[color + 'Temp'])) + tempSuffix
+                                status[statusIndex].update({statusType: statusValue})
+                                statusIndex = statusIndex + 1
                     # End: Tilt Items
 
                     # Begin: iSpindel Items
@@ -1470,6 +1688,30 @@ def loop():  # Main program loop
                                 statusIndex = statusIndex + 1
                     # End: iSpindel Items
 
+                    # Begin: Analytics Items
+                    gravity = analytics.results().get('gravity')
+                    if gravity is not None:
+                        sgWindow = analytics.results()['SG']['windows'][str(int(analytics.windows[-1]))]
+                        if sgWindow['slope'] is not None:
+                            status[statusIndex] = {}
+                            statusType = "SG Trend: "
+                            statusValue = "stable" if gravity['stable'] else format(sgWindow['slope'], '+.4f') + "/day"
+                            status[statusIndex].update({statusType: statusValue})
+                            statusIndex = statusIndex + 1
+                        if gravity['attenuation'] is not None:
+                            status[statusIndex] = {}
+                            statusType = "Attenuation: "
+                            statusValue = format(gravity['attenuation'], '.0f') + "% (" + format(gravity['abv'], '.1f') + "% ABV)"
+                            status[statusIndex].update({statusType: statusValue})
+                            statusIndex = statusIndex + 1
+                        if gravity['hoursLeft'] is not None:
+                            status[statusIndex] = {}
+                            statusType = "Time to FG: "
+                            statusValue = format(gravity['hoursLeft'], '.0f') + " hrs"
+                            status[statusIndex].update({statusType: statusValue})
+                            statusIndex = statusIndex + 1
+                    # End: Analytics Items
+
                     phpConn.send(json.dumps(status).encode(encoding="utf-8"))
                 else:  # Invalid message received
                     logMessage(
@@ -1498,7 +1740,7 @@ def loop():  # Main program loop
                     bgSerialConn.writeln("s")
 
                 # If no new data has been received for serialRequestInteval seconds
-                if (time.time() - prevDataTime) >= Decimal(config['interval']):
+                if (time.time() - prevDataTime) >= settings.interval:
                     if prevDataTime == 0:  # First time through set the previous time
                         prevDataTime = time.time()
                     prevDataTime += 5  # Give the controller some time to respond to prevent requesting twice
@@ -1506,7 +1748,7 @@ def loop():  # Main program loop
                     prevDataTime += 5  # Give the controller some time to respond to prevent requesting twice
 
                 # Controller not responding
-                elif (time.time() - prevDataTime) > Decimal(config['interval']) + 2 * Decimal(config['interval']):
+                elif (time.time() - prevDataTime) > settings.interval + 2 * settings.interval:
                     logMessage(
                         "ERROR: Controller is not responding to new data requests.")
 
@@ -1533,46 +1775,51 @@ def loop():  # Main program loop
 
                                 # If we are running Tilt, get current values
                                 if (tilt is not None) and (tiltbridge is not None):
-                                    # Check each of the Tilt colors
-                                    for color in Tilt.TILT_COLORS:
-                                        # Only log the Tilt if the color matches the config
-                                        if color == config["tiltColor"]:
-                                            tiltValue = tilt.getValue(color)
-                                            if tiltValue is not None:
-                                                _temp = tiltValue.temperature
-                                                prevTempJson[color + 'HWVer'] = tiltValue.hwVersion
-                                                prevTempJson[color + 'SWVer'] = tiltValue.fwVersion
-
-                                                # Clamp temp values
-                                                _temp = clamp(_temp, Decimal(config['clampTempLower']), Decimal(config['clampTempUpper']))
-
-                                                # Convert to C
-                                                if cc['tempFormat'] == 'C':
-                                                    _temp = bc.convert(_temp, 'F', 'C')
-
-                                                # Clamp SG Values
-                                                _grav = clamp(tiltValue.gravity, Decimal(config['clampSGLower']), Decimal(config['clampSGUpper']))
-
-                                                if prevTempJson[color + 'HWVer'] == 4:
-                                                    changeWwwSetting('isHighResTilt', True)
-                                                    prevTempJson[color + 'SG'] = round(_grav, 4)
-                                                    prevTempJson[color + 'Temp'] = round(_temp, 2)
-                                                else:
-                                                    changeWwwSetting('isHighResTilt', False)
-                                                    prevTempJson[color + 'SG'] = round(_grav, 3)
-                                                    prevTempJson[color + 'Temp'] = round(_temp, 1)
-
-                                                prevTempJson[color + 'Batt'] = round(tiltValue.battery, 2)
+                                    # Only the configured colors are looked up
+                                    missing = []
+                                    for color in tiltColors():
+                                        tiltValue = tilt.getValue(color)
+                                        if tiltValue is not None:
+                                            _temp = tiltValue.temperature
+                                            prevTempJson[color + 'HWVer'] = tiltValue.hwVersion
+                                            prevTempJson[color + 'SWVer'] = tiltValue.fwVersion
+
+                                            # Clamp temp values
+                                            _temp = clamp(_temp, settings.clampTempLower, settings.clampTempUpper)
+
+                                            # Convert to C
+                                            if cc['tempFormat'] == 'C':
+                                                _temp = bc.convert(_temp, 'F', 'C')
+
+                                            # Clamp SG Values
+                                            _grav = clamp(tiltValue.gravity, settings.clampSGLower, settings.clampSGUpper)
+
+                                            if prevTempJson[color + 'HWVer'] == 4:
+                                                prevTempJson[color + 'SG'] = round(_grav, 4)
+                                                prevTempJson[color + 'Temp'] = round(_temp, 2)
                                             else:
-                                                logError("Failed to retrieve {} Tilt value, restarting Tilt.".format(color))
-                                                initTilt()
+                                                prevTempJson[color + 'SG'] = round(_grav, 3)
+                                                prevTempJson[color + 'Temp'] = round(_temp, 1)
+
+                                            prevTempJson[color + 'Batt'] = round(tiltValue.battery, 2)
+                                        else:
+                                            missing.append(color)
 
-                                                prevTempJson[color + 'HWVer'] = None
-                                                prevTempJson[color + 'SWVer'] = None
+                                            prevTempJson[color + 'HWVer'] = None
+                                            prevTempJson[color + 'SWVer'] = None
 
-                                                prevTempJson[color + 'Temp'] = None
-                                                prevTempJson[color + 'SG'] = None
-                                                prevTempJson[color + 'Batt'] = None
+                                            prevTempJson[color + 'Temp'] = None
+                                            prevTempJson[color + 'SG'] = None
+                                            prevTempJson[color + 'Batt'] = None
+
+                                    updateHighResTilt()
+
+                                    # One Tilt out of range is no reason to restart, none at all is
+                                    if missing and len(missing) == len(tiltColors()):
+                                        logError("Failed to retrieve {} Tilt value, restarting Tilt.".format(', '.join(missing)))
+                                        initTilt()
+                                    elif missing:
+                                        logError("Failed to retrieve {} Tilt value.".format(', '.join(missing)))
 
                                 # Expire old BB keypairs
                                 if (time.time() - lastBbApi) > timeoutBB:
@@ -1595,14 +1842,14 @@ def loop():  # Main program loop
                                 # Expire old Tiltbridge values
                                 if ((time.time() - lastTiltbridge) > timeoutTiltbridge) and tiltbridge == True:
                                     tiltbridge = False  # Turn off Tiltbridge in case we switched to BT
-                                    color = config['tiltColor']
-                                    logMessage("Expired {} tilt and turned off Tiltbridge.".format(color))
-                                    if checkKey(prevTempJson, color + 'Temp'):
-                                        prevTempJson[color + 'Temp'] = None
-                                    if checkKey(prevTempJson, color + 'SG'):
-                                        prevTempJson[color + 'SG'] = None
-                                    if checkKey(prevTempJson, color + 'Batt'):
-                                        prevTempJson[color + 'Batt'] = None
+                                    logMessage("Expired {} tilt and turned off Tiltbridge.".format(', '.join(tiltColors())))
+                                    for color in tiltColors():
+                                        if checkKey(prevTempJson, color + 'Temp'):
+                                            prevTempJson[color + 'Temp'] = None
+                                        if checkKey(prevTempJson, color + 'SG'):
+                                            prevTempJson[color + 'SG'] = None
+                                        if checkKey(prevTempJson, color + 'Batt'):
+                                            prevTempJson[color + 'Batt'] = None
 
                                 # Get newRow
                                 newRow = prevTempJson
@@ -1616,102 +1863,10 @@ def loop():  # Main program loop
                                 else:                       # Don't log JSON messages
                                     pass
 
-                                # Add row to JSON file
-                                # Handle if we are running Tilt or iSpindel
-                                if checkKey(config, 'tiltColor'):
-                                    brewpiJson.addRow(
-                                        localJsonFileName, newRow, config['tiltColor'], None)
-                                elif checkKey(config, 'iSpindel'):
-                                    brewpiJson.addRow(
-                                        localJsonFileName, newRow, None, config['iSpindel'])
-                                else:
-                                    brewpiJson.addRow(
-                                        localJsonFileName, newRow, None, None)
-
-                                # Copy to www dir. Do not write directly to www dir to
-                                # prevent blocking www file.
-                                shutil.copyfile(
-                                    localJsonFileName, wwwJsonFileName)
-
-                                # Check if CSV file exists, if not do a header
-                                if not os.path.exists(localCsvFileName):
-                                    csvFile = open(localCsvFileName, "a")
-                                    delim = ','
-                                    sepSemaphore = "SEP=" + delim + '\r\n'
-                                    lineToWrite = sepSemaphore  # Has to be first line
-                                    try:
-                                        lineToWrite += ('Timestamp' + delim +
-                                                        'Beer Temp' + delim +
-                                                        'Beer Set' + delim +
-                                                        'Beer Annot' + delim +
-                                                        'Chamber Temp' + delim +
-                                                        'Chamber Set' + delim +
-                                                        'Chamber Annot' + delim +
-                                                        'Room Temp' + delim +
-                                                        'State')
-
-                                        # If we are configured to run a Tilt
-                                        if tilt:
-                                            # Write out Tilt Temp and SG Values
-                                            for color in Tilt.TILT_COLORS:
-                                                # Only log the Tilt if the color is correct according to config
-                                                if color == config["tiltColor"]:
-                                                    if prevTempJson.get(color + 'Temp') is not None:
-                                                        lineToWrite += (delim +
-                                                                        color + 'Tilt SG')
-
-                                        # If we are configured to run an iSpindel
-                                        if ispindel:
-                                            lineToWrite += (delim +
-                                                            'iSpindel SG')
-
-                                        lineToWrite += '\r\n'
-                                        csvFile.write
-                                        csvFile.write(lineToWrite)
-                                        csvFile.close()
-
-                                    except IOError as e:
-                                        logMessage(
-                                            "Unknown error: %s" % str(e))
-
-                                # Now write data to csv file as well
-                                csvFile = open(localCsvFileName, "a")
-                                delim = ','
-                                try:
-                                    lineToWrite = (time.strftime("%Y-%m-%d %H:%M:%S") + delim +
-                                                   json.dumps(newRow['BeerTemp']) + delim +
-                                                   json.dumps(newRow['BeerSet']) + delim +
-                                                   json.dumps(newRow['BeerAnn']) + delim +
-                                                   json.dumps(newRow['FridgeTemp']) + delim +
-                                                   json.dumps(newRow['FridgeSet']) + delim +
-                                                   json.dumps(newRow['FridgeAnn']) + delim +
-                                                   json.dumps(newRow['RoomTemp']) + delim +
-                                                   json.dumps(newRow['State']))
-
-                                    # If we are configured to run a Tilt
-                                    if tilt:
-                                        # Write out Tilt Temp and SG Values
-                                        for color in Tilt.TILT_COLORS:
-                                            # Only log the Tilt if the color is correct according to config
-                                            if color == config["tiltColor"]:
-                                                if prevTempJson.get(color + 'SG') is not None:
-                                                    lineToWrite += (delim + json.dumps(
-                                                        prevTempJson[color + 'SG']))
-
-                                    # If we are configured to run an iSpindel
-                                    if ispindel:
-                                        lineToWrite += (delim +
-                                                        json.dumps(newRow['spinSG']))
-
-                                    lineToWrite += '\r\n'
-                                    csvFile.write(lineToWrite)
-                                except KeyError as e:
-                                    logMessage(
-                                        "KeyError in line from controller: %s" % str(e))
-
-                                csvFile.close()
-                                shutil.copyfile(
-                                    localCsvFileName, wwwCsvFileName)
+                                # Queue row for the files and other outputs
+                                sinks.publish(newRow, beer=config['beerName'])
+                                history.add(newRow)
+                                analytics.add(newRow)
                             elif line[0] == 'D':  # Debug message received
                                 # Should already been filtered out, but print anyway here.
                                 logMessage(
@@ -1765,6 +1920,8 @@ def loop():  # Main program loop
                             logMessage("Line received was: " + line)
 
                     if message is not None:  # Other (debug?) message received
+                        if database is not None:
+                            database.addEvent(config['beerName'], 'controller', message)
                         try:
                             pass  # I don't think we need to log this
                             # expandedMessage = expandLogMessage.expandLogMessage(message)
@@ -1816,6 +1973,8 @@ def loop():  # Main program loop
 def shutdown():  # Process a graceful shutdown
     global bgSerialConn
     global tilt
+    global compactor
+    global sinks
     global threads
     global serialConn
     global bgSerialConn
@@ -1836,6 +1995,16 @@ def shutdown():  # Process a graceful shutdown
         logMessage("Stopping Tilt.")
         tilt.stop()
 
+    if sinks is not None:
+        logMessage("Writing buffered data.")
+        sinks.stop()
+
+    flushWwwSettings()  # Write www settings still pending
+
+    if compactor is not None:
+        logMessage("Stopping data compression.")
+        compactor.stop()
+
     try:
         threads  # Allow any spawned threads to quit
     except NameError:
@@ -1870,6 +2039,12 @@ def main():
     getGit()  # Retrieve git (version) information
     options()  # Parse command line options
     config()  # Load config file
+    initPermissions()  # Register owner and group of the data trees
+    if repairPerms:
+        logMessage("Setting owner and permissions on data files.")
+        fixed = util.permissions.repair()
+        logMessage("Done, {0} file(s) and directories updated.".format(fixed))
+        sys.exit(0)
     checkDoNotRun()  # Check do not run file
     checkOthers()  # Check for other running brewpi
     if checkStartupOnly:
@@ -1879,6 +2054,11 @@ def main():
     startLogs()  # Start log file(s)
     initTilt()  # Set up Tilt
     initISpindel()  # Initialize iSpindel
+    initCompactor()  # Start compressing closed day files
+    initPersistence()  # Start writing samples in the background
+    initDatabase()  # Start the optional SQLite store
+    initSinks()  # Start the optional network outputs
+    initAnalytics()  # Set up the rolling statistics
     startSerial()  # Begin serial connections
 
     loop()  # Main processing loop
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+# Derives fermentation statistics from the readings as they arrive: an
+# exponentially weighted moving average and, over each window, the mean,
+# variance and least-squares slope of beer temperature, chamber temperature
+# and gravity. Adding a reading costs the same however long the windows
+# are. From gravity it derives apparent attenuation, ABV and an estimate of
+# the time left until terminal gravity.
+
+import math
+import time
+from collections import deque
+import BrewConvert
+
+SECONDS_PER_DAY = 86400.0
+
+# Gravity counts as stable once it moved less than this per day over the
+# longest window
+STABLE_SLOPE = 0.001
+
+
+def attenuation(og, sg):
+    """
+    Returns the apparent attenuation in percent, from degrees Plato
+    """
+    plato = BrewConvert.sgToPlato(og)
+    if plato <= 0:
+        return None
+    return (plato - BrewConvert.sgToPlato(sg)) / plato * 100
+
+
+def abv(og, sg):
+    """
+    Returns the alcohol by volume in percent
+    """
+    return (76.08 * (og - sg) / (1.775 - og)) * (sg / 0.794)
+
+
+class Ewma():
+    """
+    Exponentially weighted moving average for irregularly spaced samples
+    """
+
+    def __init__(self, halfLife):
+        """
+        :param halfLife: Seconds after which a sample weighs half as much
+        """
+        self.halfLife = halfLife
+        self.value = None
+        self.last = None
+
+    def add(self, timestamp, value):
+        if self.value is None:
+            self.value = value
+        else:
+            dt = max(0.0, timestamp - self.last)
+            alpha = 1 - math.exp(-dt * math.log(2) / self.halfLife)
+            self.value += alpha * (value - self.value)
+        self.last = timestamp
+        return self.value
+
+
+class Window():
+    """
+    Mean, variance and least-squares slope of the samples of the last
+    seconds
+
+    Running sums are kept relative to a sample in the window, so small
+    changes of a large value (e.g. gravity) keep their precision. Once per
+    window length they are worked out again from a newer sample, which keeps
+    the offsets small and sheds rounding errors at an average cost of one
+    sum per sample.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()
+        self.reset()
+
+    def reset(self):
+        self.samples.clear()
+        self.t0 = None
+        self.v0 = None
+        self.n = 0
+        self.sumT = self.sumV = self.sumTT = self.sumTV = self.sumVV = 0.0
+
+    def add(self, timestamp, value):
+        if self.t0 is None:
+            self.t0 = timestamp
+            self.v0 = value
+        self.samples.append((timestamp, value))
+        self.__sum(timestamp, value, 1)
+        # Drop what fell out of the window
+        cutoff = timestamp - self.seconds
+        while self.samples[0][0] < cutoff:
+            oldTime, oldValue = self.samples.popleft()
+            self.__sum(oldTime, oldValue, -1)
+        if self.samples[0][0] - self.t0 > self.seconds:
+            self.__rebase()
+
+    def mean(self):
+        return self.v0 + self.sumV / self.n if self.n else None
+
+    def variance(self):
+        if self.n < 2:
+            return None
+        return max(0.0, (self.sumVV - self.sumV * self.sumV / self.n) / (self.n - 1))
+
+    def slope(self):
+        """
+        Returns the change per second, None with too few samples
+        """
+        if self.n < 2:
+            return None
+        denominator = self.n * self.sumTT - self.sumT * self.sumT
+        if denominator <= 0:
+            return None
+        return (self.n * self.sumTV - self.sumT * self.sumV) / denominator
+
+    def span(self):
+        """
+        Returns the seconds between the oldest and newest sample
+        """
+        return self.samples[-1][0] - self.samples[0][0] if self.samples else 0.0
+
+    def __rebase(self):
+        samples = list(self.samples)
+        self.reset()
+        self.t0, self.v0 = samples[0]
+        for timestamp, value in samples:
+            self.samples.append((timestamp, value))
+            self.__sum(timestamp, value, 1)
+
+    def __sum(self, timestamp, value, sign):
+        t = timestamp - self.t0
+        v = value - self.v0
+        self.n += sign
+        self.sumT += sign * t
+        self.sumV += sign * v
+        self.sumTT += sign * t * t
+        self.sumTV += sign * t * v
+        self.sumVV += sign * v * v
+
+
+class Series():
+    """
+    Statistics of one column
+    """
+
+    def __init__(self, windows, halfLife):
+        self.ewma = Ewma(halfLife)
+        self.windows = [Window(seconds) for seconds in windows]
+        self.last = None
+
+    def add(self, timestamp, value):
+        self.last = value
+        self.ewma.add(timestamp, value)
+        for window in self.windows:
+            window.add(timestamp, value)
+
+    def summary(self, slopeUnit, digits):
+        """
+        :param slopeUnit: Seconds the slope is given per, e.g. 3600 for per hour
+        :param digits: Decimals to round to
+        """
+        summary = {'last': round(self.last, digits), 'ewma': round(self.ewma.value, digits), 'windows': {}}
+        for window in self.windows:
+            variance = window.variance()
+            slope = window.slope()
+            summary['windows'][str(int(window.seconds))] = {
+                'n': window.n,
+                'mean': round(window.mean(), digits),
+                'stdev': round(math.sqrt(variance), digits + 1) if variance is not None else None,
+                'slope': round(slope * slopeUnit, digits + 1) if slope is not None else None,
+            }
+        return summary
+
+
+class Analytics():
+    """
+    Keeps rolling statistics of the readings and what follows from them.
+    Results are worked out when asked for and kept until the next reading.
+    """
+
+    def __init__(self, windows=(3600, 21600, 86400), halfLife=1800, og=None, fg=None, sgColumn=None):
+        """
+        :param windows: Lengths of the windows in seconds
+        :param halfLife: Half-life of the moving averages in seconds
+        :param og: Original gravity, defaults to the highest seen
+        :param fg: Expected final gravity, used for the time left
+        :param sgColumn: Id of the gravity column followed, e.g. 'RedSG'.
+                         Defaults to the first one found in each reading.
+        """
+        self.windows = sorted(windows)
+        self.halfLife = halfLife
+        self.og = og
+        self.fg = fg
+        self.sgColumn = sgColumn
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything, e.g. for a new brew
+        """
+        self.series = {}
+        self.maxSG = None
+        self.updated = None
+        self.cache = None
+
+    def add(self, row, timestamp=None):
+        """
+        Add a reading
+
+        :param row: dict of values, keyed by column id
+        :param timestamp: Epoch time of the reading, defaults to now
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        gravityColumn = self.sgColumn or sgColumn(row)
+        for name, column in (('BeerTemp', 'BeerTemp'), ('FridgeTemp', 'FridgeTemp'), ('SG', gravityColumn)):
+            value = row.get(column) if column else None
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if name == 'SG':
+                if value < 0.9 or value > 1.2:
+                    continue  # Not a gravity reading, e.g. a Tilt still starting
+                self.maxSG = value if self.maxSG is None else max(self.maxSG, value)
+            if name not in self.series:
+                self.series[name] = Series(self.windows, self.halfLife)
+            self.series[name].add(timestamp, value)
+        self.updated = timestamp
+        self.cache = None
+
+    def results(self):
+        """
+        Returns the statistics as a dict: per column the last value, moving
+        average and per window (keyed by seconds) the sample count, mean,
+        standard deviation and slope. Temperature slopes are per hour,
+        gravity slopes per day. 'gravity' holds the derived values.
+        """
+        if self.cache is None:
+            results = {'updated': self.updated, 'windows': self.windows}
+            for name in ('BeerTemp', 'FridgeTemp'):
+                if name in self.series:
+                    results[name] = self.series[name].summary(3600, 2)
+            if 'SG' in self.series:
+                results['SG'] = self.series['SG'].summary(SECONDS_PER_DAY, 4)
+                results['gravity'] = self.__gravity()
+            self.cache = results
+        return self.cache
+
+    def __gravity(self):
+        series = self.series['SG']
+        og = self.og or self.maxSG
+        sg = series.ewma.value
+        gravity = {'og': round(og, 4), 'sg': round(sg, 4), 'attenuation': None,
+                   'abv': None, 'stable': False, 'hoursLeft': None}
+        if og > 1.0:
+            aa = attenuation(og, sg)
+            gravity['attenuation'] = round(aa, 1) if aa is not None else None
+            gravity['abv'] = round(max(0.0, abv(og, sg)), 2)
+        longest = series.windows[-1]
+        slope = longest.slope()
+        if slope is None:
+            return gravity
+        perDay = slope * SECONDS_PER_DAY
+        # Only call it stable once the window has (nearly) filled
+        if longest.span() >= longest.seconds * 0.9 and abs(perDay) < STABLE_SLOPE:
+            gravity['stable'] = True
+        elif self.fg is not None and perDay < 0 and sg > self.fg:
+            gravity['hoursLeft'] = round((sg - self.fg) / -perDay * 24, 1)
+        return gravity
+
+
+def sgColumn(row):
+    """
+    Returns the id of the gravity column of a reading (a Tilt color or the
+    iSpindel), None if it has none
+    """
+    for column in row:
+        if column.endswith('SG') and row[column] is not None:
+            return column
+    return None
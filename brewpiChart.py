@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+# Converts chart files between the Google Charts layout and the compact
+# layout (see brewpiJson.CHART_FORMATS), e.g.:
+#
+# {"format":"compact","version":1,"scale":[1,100,100,null,...],"cols":[...],"rows":[
+# [1580511909,1994,2000,null,...],
+# [60,-2,0,null,...]]}
+
+import os
+import sys
+import time
+from datetime import datetime
+import simplejson as json
+import brewpiJson
+from BrewPiUtil import logMessage
+from BrewPiUtil import logError
+
+
+def isCompact(chart):
+    """
+    Returns True if a loaded chart is in the compact layout
+    """
+    return chart.get('format') == 'compact'
+
+
+def compactToGoogle(chart):
+    """
+    Converts a loaded compact chart to the Google Charts layout
+
+    Params:
+    chart: dict as loaded from a compact chart file
+
+    Returns:
+    dict with 'cols' and 'rows'
+    """
+    scales = chart['scale']
+    last = [0] * len(scales)
+    rows = []
+    for values in chart['rows']:
+        cells = []
+        for i, value in enumerate(values):
+            scale = scales[i]
+            if value is None:
+                cells.append(None)
+                continue
+            if scale is not None:
+                last[i] += value
+                value = last[i] if scale == 1 else last[i] / scale
+            if i == 0:
+                now = datetime.fromtimestamp(value)
+                value = "Date({0},{1},{2},{3},{4},{5})".format(
+                    now.year, now.month - 1, now.day, now.hour, now.minute, now.second)
+            cells.append({'v': value})
+        rows.append({'c': cells})
+    return {'cols': chart['cols'], 'rows': rows}
+
+
+def googleToCompact(chart):
+    """
+    Converts a loaded Google Charts chart to the compact layout
+
+    Params:
+    chart: dict with 'cols' and 'rows'
+
+    Returns:
+    dict in the compact layout
+    """
+    scales = brewpiJson.compactScales([col['id'] for col in chart['cols']])
+    last = [0] * len(scales)
+    rows = []
+    for row in chart['rows']:
+        values = []
+        for i, cell in enumerate(row['c']):
+            value = cell['v'] if cell is not None else None
+            if i == 0 and value is not None:
+                value = int(time.mktime(brewpiJson.rowTime(value).timetuple()))
+            if value is None or scales[i] is None:
+                values.append(value)
+                continue
+            quantized = int(round(float(value) * scales[i]))
+            values.append(quantized - last[i])
+            last[i] = quantized
+        rows.append(values)
+    return {'format': 'compact', 'version': brewpiJson.COMPACT_VERSION,
+            'scale': scales, 'cols': chart['cols'], 'rows': rows}
+
+
+def loadChart(jsonFileName):
+    """
+    Loads a (possibly compressed) chart file in the Google Charts layout,
+    whichever layout it is stored in
+    """
+    chart = brewpiJson.loadFile(jsonFileName)
+    if isCompact(chart):
+        chart = compactToGoogle(chart)
+    return chart
+
+
+def writeChart(jsonFileName, chart):
+    """
+    Writes a chart with one row per line, as brewpiJson.addRows() does, so
+    more rows can be appended to it
+
+    The file is written to a temporary name first and then renamed into
+    place.
+    """
+    header = dict((key, chart[key]) for key in chart if key != 'rows')
+    # Keep the header keys in the order newEmptyFile() writes them
+    order = ['format', 'version', 'scale', 'cols']
+    data = '{' + ','.join(
+        '{0}:{1}'.format(json.dumps(key), json.dumps(header[key], separators=(',', ':')))
+        for key in sorted(header, key=lambda key: order.index(key) if key in order else len(order)))
+    data += ',"rows":['
+    if chart['rows']:
+        rows = [json.dumps(row, separators=(',', ':')) for row in chart['rows']]
+        data += os.linesep + (',' + os.linesep).join(rows)
+    data += ']}'
+    tempName = '{0}.tmp'.format(jsonFileName)
+    with open(tempName, 'w') as jsonFile:
+        jsonFile.write(data)
+    os.replace(tempName, jsonFileName)
+
+
+def convertFile(jsonFileName, chartFormat, outFileName=None):
+    """
+    Converts a chart file to a layout
+
+    Params:
+    jsonFileName: Path of the chart file, it may be compressed
+    chartFormat: 'google' or 'compact'
+    outFileName: Where to write the result, defaults to jsonFileName
+
+    Returns:
+    True if converted, False if not
+    """
+    try:
+        chart = brewpiJson.loadFile(jsonFileName)
+    except (IOError, OSError, ValueError) as e:
+        logError("Unable to read chart {0}: {1}".format(jsonFileName, e))
+        return False
+    if chartFormat == 'compact' and not isCompact(chart):
+        chart = googleToCompact(chart)
+    elif chartFormat == 'google' and isCompact(chart):
+        chart = compactToGoogle(chart)
+    try:
+        writeChart(outFileName or jsonFileName, chart)
+    except (IOError, OSError) as e:
+        logError("Unable to write chart {0}: {1}".format(outFileName or jsonFileName, e))
+        return False
+    return True
+
+
+def main():
+    # Convert chart files between the Google Charts and compact layouts
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Convert BrewPi chart files between the Google Charts and compact layouts")
+    parser.add_argument("file", nargs='+', help="chart JSON file")
+    parser.add_argument("-f", "--format", choices=brewpiJson.CHART_FORMATS,
+                        default='google', help="layout to convert to")
+    parser.add_argument("-o", "--output", help="output file, only with a single input file")
+    args = parser.parse_args()
+    if args.output and len(args.file) > 1:
+        parser.error("--output needs a single input file")
+    for fileName in args.file:
+        if convertFile(fileName, args.format, args.output):
+            logMessage("Converted {0} to {1}.".format(fileName, args.format))
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
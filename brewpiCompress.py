@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import lzma
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+from BrewPiUtil import logMessage
+from BrewPiUtil import logError
+
+# Supported compression methods: file suffix and opener
+COMPRESSORS = {
+    'gzip': ('.gz', gzip.open),
+    'lzma': ('.xz', lzma.open),
+}
+
+# Closed day files look like <beer>-YYYYMMDD.json or <beer>-YYYYMMDD-N.json
+DAY_FILE = re.compile(r'^.+-\d{8}(-\d+)?\.json$')
+
+
+def compressedName(fileName, method):
+    """
+    Returns the name of the compressed version of a file
+
+    Params:
+    fileName: Path of the uncompressed file
+    method: Compression method, one of COMPRESSORS
+
+    Returns:
+    Path with the compression suffix appended
+    """
+    return '{0}{1}'.format(fileName, COMPRESSORS[method][0])
+
+
+def findDataFile(fileName):
+    """
+    Finds a data file whether or not it has been compressed
+
+    Params:
+    fileName: Path of the uncompressed file
+
+    Returns:
+    Path of the plain or compressed file which exists, or None
+    """
+    if os.path.isfile(fileName):
+        return fileName
+    for method in COMPRESSORS:
+        candidate = compressedName(fileName, method)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def openDataFile(fileName, mode='rt'):
+    """
+    Opens a data file for reading, decompressing on the fly when only a
+    compressed copy exists
+
+    Params:
+    fileName: Path of the uncompressed file (or of a compressed copy)
+    mode: 'rt' for text or 'rb' for bytes
+
+    Returns:
+    A file object, raises IOError if no version of the file exists
+    """
+    path = findDataFile(fileName)
+    if path is None:
+        raise IOError("No plain or compressed copy of '{0}'.".format(fileName))
+    for method in COMPRESSORS:
+        suffix, opener = COMPRESSORS[method]
+        if path.endswith(suffix):
+            return opener(path, mode)
+    return open(path, mode)
+
+
+def readDataFile(fileName):
+    """
+    Reads the whole of a (possibly compressed) data file as text
+    """
+    with openDataFile(fileName, 'rt') as dataFile:
+        return dataFile.read()
+
+
+def compressFile(fileName, method='gzip'):
+    """
+    Compresses a file, replacing the original
+
+    The compressed copy is written to a temporary file and renamed into
+    place before the original is removed, so a crash leaves one complete
+    copy behind. Ownership, mode and timestamps are carried over.
+
+    Params:
+    fileName: Path of the file to compress
+    method: Compression method, one of COMPRESSORS
+
+    Returns:
+    Path of the compressed file, or None if nothing was done
+    """
+    if method not in COMPRESSORS or not os.path.isfile(fileName):
+        return None
+    target = compressedName(fileName, method)
+    tempName = '{0}.tmp'.format(target)
+    opener = COMPRESSORS[method][1]
+    try:
+        with open(fileName, 'rb') as src, opener(tempName, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        shutil.copystat(fileName, tempName)
+        try:
+            fileStat = os.stat(fileName)
+            os.chown(tempName, fileStat.st_uid, fileStat.st_gid)
+        except OSError:
+            pass  # Not running as root, keep our own ownership
+        os.replace(tempName, target)
+        os.remove(fileName)
+    except (IOError, OSError) as e:
+        logError("Unable to compress {0}: {1}".format(fileName, e))
+        if os.path.isfile(tempName):
+            os.remove(tempName)
+        return None
+    return target
+
+
+def closedDayFiles(path, current=None):
+    """
+    Lists the uncompressed day files in a directory which are no longer
+    being written to
+
+    Params:
+    path: Directory to check
+    current: Path of the file currently being logged to, which is skipped
+
+    Returns:
+    List of paths
+    """
+    closed = []
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return closed
+    for name in sorted(names):
+        fileName = os.path.join(path, name)
+        if DAY_FILE.match(name) and fileName != current:
+            closed.append(fileName)
+    return closed
+
+
+class Compactor():
+    """
+    Compresses closed day files in a background thread so the main loop is
+    never held up by compression
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.run = False
+        self.compressed = 0
+
+    def start(self):
+        self.run = True
+        if not self.thread:
+            self.thread = threading.Thread(target=self.__compactThread)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.run = False
+        if self.thread:
+            self.thread.join()  # Wait for the current file to finish
+            self.thread = None
+
+    def add(self, fileName, method='gzip', callback=None):
+        """
+        Queue a closed file for compression
+
+        :param fileName: Path of the file to compress
+        :param method: Compression method, one of COMPRESSORS
+        :param callback: Called from the compactor thread as
+                         callback(fileName, compressedName, method) once
+                         the file has been compressed
+        """
+        if fileName and method in COMPRESSORS:
+            self.queue.put((fileName, method, callback))
+
+    def scan(self, path, current=None, method='gzip', callback=None):
+        """
+        Queue all closed day files in a directory for compression
+        """
+        for fileName in closedDayFiles(path, current):
+            self.add(fileName, method, callback)
+
+    def __compactThread(self):
+        while self.run:
+            try:
+                fileName, method, callback = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            target = compressFile(fileName, method)
+            if target:
+                self.compressed += 1
+                if callback is not None:
+                    callback(fileName, target, method)
+
+
+def main():
+    # Compress closed day files in the directories given on the command line
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Compress closed BrewPi day files")
+    parser.add_argument("path", nargs='+', help="beer data directory")
+    parser.add_argument("-m", "--method", choices=sorted(COMPRESSORS),
+                        default='gzip', help="compression method")
+    args = parser.parse_args()
+    # Files from today may still be open in a running BrewPi, leave them be
+    today = '-{0}'.format(time.strftime("%Y%m%d"))
+    for path in args.path:
+        for fileName in closedDayFiles(path):
+            if today in os.path.basename(fileName):
+                continue
+            result = compressFile(fileName, args.method)
+            if result:
+                logMessage("Compressed {0}.".format(result))
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+# Typed view of the settings. ConfigObj gives every value as a string, so
+# each setting is checked and converted once when the config is loaded,
+# and the main loop reads native numbers, booleans and paths from the
+# result instead of converting strings for every reading.
+
+from decimal import Decimal, InvalidOperation
+from BrewPiUtil import addSlash
+from brewpiJson import TILT_COLORS
+
+
+def toPath(value):
+    return addSlash(str(value))
+
+
+def toText(value):
+    return str(value)
+
+
+def toOptional(value):
+    # Empty and 'None' mean not set
+    if value is None or str(value).strip() in ('', 'None'):
+        return None
+    return str(value).strip()
+
+
+def toBool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('true', 'yes', 'on', '1'):
+        return True
+    if text in ('false', 'no', 'off', '0', '', 'none'):
+        return False
+    raise ValueError("'{0}' is not true or false".format(value))
+
+
+def toOptionalBool(value):
+    # Not set is kept apart from false, e.g. logJson
+    return None if toOptional(value) is None else toBool(value)
+
+
+def toInt(value):
+    return int(str(value).strip())
+
+
+def toFloat(value):
+    return float(str(value).strip())
+
+
+def toOptionalFloat(value):
+    return None if toOptional(value) is None else toFloat(value)
+
+
+def toDecimal(value):
+    try:
+        return Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError("'{0}' is not a number".format(value))
+
+
+def toPositive(convert):
+    def positive(value):
+        value = convert(value)
+        if value <= 0:
+            raise ValueError("'{0}' is not above 0".format(value))
+        return value
+    return positive
+
+
+def toHoursList(value):
+    # Comma separated hours, ConfigObj may already have split them
+    if isinstance(value, (list, tuple)):
+        value = ','.join(value)
+    hours = [toFloat(hour) for hour in str(value).split(',') if hour.strip()]
+    if not hours or min(hours) <= 0:
+        raise ValueError("'{0}' is not a list of hours".format(value))
+    return hours
+
+
+def toColorList(value):
+    # Comma separated Tilt colors, ConfigObj may already have split them
+    if isinstance(value, (list, tuple)):
+        value = ','.join(value)
+    colors = []
+    for color in str(value).split(','):
+        color = color.strip().title()
+        if not color or color in colors:
+            continue
+        if color not in TILT_COLORS:
+            raise ValueError("'{0}' is not a Tilt color".format(color))
+        colors.append(color)
+    return colors
+
+
+def toChoice(*choices):
+    def choice(value):
+        value = str(value).strip()
+        if value not in choices:
+            raise ValueError("'{0}' is not one of {1}".format(value, ', '.join(choices)))
+        return value
+    return choice
+
+
+# Name, conversion and default for settings missing from defaults.cfg
+SCHEMA = [
+    ('toolPath', toPath, '/home/pi/brewpi-tools-rmx/'),
+    ('scriptPath', toPath, '/home/brewpi/'),
+    ('wwwPath', toPath, '/var/www/html/'),
+    ('port', toText, 'auto'),
+    ('altport', toOptional, None),
+    ('boardType', toText, 'arduino'),
+    ('beerName', toOptional, None),
+    ('interval', toPositive(toDecimal), Decimal('120.0')),
+    ('dataLogging', toChoice('active', 'paused', 'stopped'), 'active'),
+    ('logJson', toOptionalBool, None),  # True full, False terse, None no JSON
+    ('clampSGUpper', toDecimal, Decimal('1.175')),
+    ('clampSGLower', toDecimal, Decimal('0.970')),
+    ('clampTempUpper', toDecimal, Decimal('110.0')),
+    ('clampTempLower', toDecimal, Decimal('-5.0')),
+    ('tiltColor', toOptional, None),
+    ('tiltColors', toColorList, []),
+    ('iSpindel', toOptional, None),
+    ('startupDelay', toFloat, 10.0),
+    ('useInetSocket', toBool, False),
+    ('socketHost', toText, 'localhost'),
+    ('socketPort', toInt, 6332),
+    ('chartFormat', toChoice('google', 'compact'), 'google'),
+    ('compressData', toChoice('none', 'gzip', 'lzma'), 'none'),
+    ('logDurability', toChoice('immediate', 'interval', 'fsync'), 'immediate'),
+    ('logFlushInterval', toPositive(toFloat), 60.0),
+    ('logFlushRows', toPositive(toInt), 10),
+    ('logQueueSize', toPositive(toInt), 1000),
+    ('historyHours', toPositive(toFloat), 24.0),
+    ('database', toChoice('none', 'sqlite'), 'none'),
+    ('databaseFile', toOptional, None),
+    ('httpSink', toOptional, None),
+    ('httpSinkInterval', toPositive(toFloat), 30.0),
+    ('exportUrl', toOptional, None),
+    ('exportMeasurement', toText, 'brewpi'),
+    ('exportInterval', toPositive(toFloat), 10.0),
+    ('exportSpool', toOptional, None),
+    ('analyticsWindows', toHoursList, [1.0, 6.0, 24.0]),
+    ('originalGravity', toOptionalFloat, None),
+    ('finalGravity', toOptionalFloat, None),
+]
+
+
+class Settings():
+    """
+    The converted settings as attributes, e.g. settings.clampTempLower is
+    a Decimal and settings.useInetSocket a bool
+    """
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return 'Settings({0})'.format(self.__dict__)
+
+
+def parse(config, defaults=None):
+    """
+    Converts the settings of a ConfigObj
+
+    Params:
+    config: ConfigObj of the merged settings
+    defaults: ConfigObj of defaults.cfg, used where a value is invalid
+
+    Returns:
+    Tuple of (Settings, list of error messages)
+    """
+    values = {}
+    errors = []
+    for name, convert, default in SCHEMA:
+        value = config.get(name)
+        if value is None or (value == '' and convert not in (toOptional, toOptionalFloat, toOptionalBool, toText)):
+            values[name] = default
+            continue
+        try:
+            values[name] = convert(value)
+        except (TypeError, ValueError) as e:
+            errors.append("Invalid setting {0} = {1}: {2}".format(name, value, e))
+            try:
+                values[name] = convert(defaults[name]) if defaults and name in defaults else default
+            except (TypeError, ValueError):
+                values[name] = default
+    for low, high in (('clampTempLower', 'clampTempUpper'), ('clampSGLower', 'clampSGUpper')):
+        if values[low] >= values[high]:
+            errors.append("Invalid settings: {0} ({1}) is not below {2} ({3})".format(
+                low, values[low], high, values[high]))
+    return Settings(values), errors
+
+
+# Settings which only take effect when the script is restarted
+RESTART_SETTINGS = ['toolPath', 'scriptPath', 'wwwPath', 'port', 'altport', 'boardType',
+                    'startupDelay', 'useInetSocket', 'socketHost', 'socketPort', 'database',
+                    'databaseFile', 'httpSink', 'httpSinkInterval', 'exportUrl',
+                    'exportMeasurement', 'exportInterval', 'exportSpool']
+
+
+def changes(old, new):
+    """
+    Returns the names of the settings which differ between two Settings
+    """
+    return [name for name, convert, default in SCHEMA
+            if getattr(old, name, None) != getattr(new, name, None)]
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+from datetime import datetime
+import simplejson as json
+import brewpiEncoder
+import brewpiJournal
+import brewpiJson
+from BrewPiUtil import logMessage
+from BrewPiUtil import logError
+from BrewPiUtil import permissions
+
+# Durability policies for writing samples:
+#   immediate   = Write every sample as it arrives (default)
+#   interval    = Buffer samples, write every flushInterval seconds or
+#                 flushRows samples, whichever comes first
+#   fsync       = Write every sample and fsync it to the card
+POLICIES = ['immediate', 'interval', 'fsync']
+
+
+def csvHeader(tiltColor=None, iSpindel=None):
+    """
+    Returns the header lines of a new CSV file
+    """
+    delim = ','
+    sepSemaphore = "SEP=" + delim + '\r\n'
+    lineToWrite = sepSemaphore  # Has to be first line
+    lineToWrite += ('Timestamp' + delim +
+                    'Beer Temp' + delim +
+                    'Beer Set' + delim +
+                    'Beer Annot' + delim +
+                    'Chamber Temp' + delim +
+                    'Chamber Set' + delim +
+                    'Chamber Annot' + delim +
+                    'Room Temp' + delim +
+                    'State')
+
+    # If we are configured to run a Tilt
+    if tiltColor:
+        for column in brewpiJson.tiltColumns(tiltColor):
+            # e.g. RedTilt SG, RedTilt Temp
+            for suffix in ('SG', 'Temp', 'Batt'):
+                if column.endswith(suffix):
+                    lineToWrite += (delim + column[:-len(suffix)] + 'Tilt ' + suffix)
+
+    # If we are configured to run an iSpindel
+    elif iSpindel:
+        lineToWrite += (delim + 'iSpindel SG')
+
+    lineToWrite += '\r\n'
+    return lineToWrite
+
+
+def csvLine(row, now, tiltColor=None, iSpindel=None):
+    """
+    Formats a row of data as a CSV line
+    """
+    delim = ','
+    try:
+        lineToWrite = (now.strftime("%Y-%m-%d %H:%M:%S") + delim +
+                       json.dumps(row['BeerTemp']) + delim +
+                       json.dumps(row['BeerSet']) + delim +
+                       json.dumps(row['BeerAnn']) + delim +
+                       json.dumps(row['FridgeTemp']) + delim +
+                       json.dumps(row['FridgeSet']) + delim +
+                       json.dumps(row['FridgeAnn']) + delim +
+                       json.dumps(row['RoomTemp']) + delim +
+                       json.dumps(row['State']))
+
+        # If we are configured to run a Tilt
+        if tiltColor:
+            for column in brewpiJson.tiltColumns(tiltColor):
+                lineToWrite += (delim + json.dumps(row.get(column)))
+
+        # If we are configured to run an iSpindel
+        elif iSpindel:
+            lineToWrite += (delim + json.dumps(row.get('spinSG')))
+
+        lineToWrite += '\r\n'
+    except KeyError as e:
+        logMessage("KeyError in line from controller: %s" % str(e))
+        lineToWrite = ''
+    return lineToWrite
+
+
+def recover(journalFileName):
+    """
+    Repairs the chart JSON and CSV files a journal belongs to after a crash
+
+    Rows cut short in the JSON and CSV files are dropped, readings from the
+    journal which never made it to the files are added, the repaired files
+    are copied to the web server and the journal is removed.
+
+    Params:
+    journalFileName: Path of the journal left behind
+
+    Returns:
+    Number of readings restored from the journal, or None on failure
+    """
+    try:
+        header, readings, bad = brewpiJournal.readJournal(journalFileName)
+    except (IOError, OSError) as e:
+        logError("Unable to read journal {0}: {1}".format(journalFileName, e))
+        return None
+    if header is None:
+        logError("Journal {0} has no header, unable to recover.".format(journalFileName))
+        return None
+    if bad:
+        logMessage("Skipped {0} damaged record(s) in {1}.".format(bad, journalFileName))
+
+    tiltColor = header.get('tiltColor')
+    iSpindel = header.get('iSpindel')
+    jsonFileName = header['json']
+    csvFileName = header['csv']
+    restored = 0
+
+    try:
+        # Rebuild the JSON file from its complete rows plus anything newer
+        # from the journal, then swap it in
+        chartFormat = brewpiJson.chartFormat(jsonFileName)
+        encoder = brewpiEncoder.fileEncoder(jsonFileName, tiltColor, iSpindel)
+        rows = brewpiJson.readRows(jsonFileName)
+        if chartFormat == 'compact':
+            lastTime = encoder.lastTime()
+        else:
+            lastTime = brewpiJson.rowTime(rows[-1]) if rows else None
+        for timestamp, row in readings:
+            now = datetime.fromtimestamp(timestamp)
+            if lastTime is None or now.replace(microsecond=0) > lastTime:
+                rows.append(encoder.encodeJson(row, now))
+                restored += 1
+        tempName = '{0}.tmp'.format(jsonFileName)
+        brewpiJson.newEmptyFile(tempName, tiltColor, iSpindel, chartFormat)
+        brewpiJson.addRows(tempName, rows, True)
+        os.replace(tempName, jsonFileName)
+        permissions.newFile(jsonFileName)
+
+        # Cut a partial last line from the CSV file and add what is missing
+        data = b''
+        if os.path.isfile(csvFileName):
+            with open(csvFileName, 'rb') as csvFile:
+                data = csvFile.read()
+            data = data[:data.rfind(b'\n') + 1]
+        lastStamp = ''
+        lastLine = data[data.rfind(b'\n', 0, len(data) - 1) + 1:]
+        if lastLine[:2].isdigit():
+            lastStamp = lastLine[:19].decode('utf-8')
+        lines = b''
+        csvIsNew = not os.path.isfile(csvFileName)
+        if not data:
+            lines = csvHeader(tiltColor, iSpindel).encode('utf-8')
+        for timestamp, row in readings:
+            now = datetime.fromtimestamp(timestamp)
+            if now.strftime("%Y-%m-%d %H:%M:%S") > lastStamp:
+                lines += encoder.encodeCsv(row, now)
+        with open(csvFileName, 'wb') as csvFile:
+            csvFile.write(data + lines)
+            csvFile.flush()
+            os.fsync(csvFile.fileno())
+        if csvIsNew:
+            permissions.newFile(csvFileName)
+
+        permissions.copyFile(jsonFileName, header['wwwJson'])
+        permissions.copyFile(csvFileName, header['wwwCsv'])
+    except (IOError, OSError, KeyError) as e:
+        logError("Unable to recover from journal {0}: {1}".format(journalFileName, e))
+        return None
+
+    os.remove(journalFileName)
+    return restored
+
+
+def recoverAll(path, manifest=None):
+    """
+    Recovers every journal left behind in a beer data directory, updating
+    the manifest entries of the repaired files
+
+    Returns:
+    Number of readings restored
+    """
+    restored = 0
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return restored
+    for name in names:
+        if name.endswith(brewpiJournal.JOURNAL_SUFFIX):
+            result = recover(os.path.join(path, name))
+            if result is not None:
+                logMessage("Recovered {0} from its journal, {1} reading(s) restored.".format(
+                    name, result))
+                restored += result
+                if manifest is not None:
+                    manifest.update('{0}.json'.format(name[:-len(brewpiJournal.JOURNAL_SUFFIX)]))
+                    manifest.save()
+    return restored
+
+
+class DataLog():
+    """
+    Writes samples to the chart JSON and CSV files of a beer and mirrors
+    them to the web server, according to a durability policy
+    """
+
+    def __init__(self, jsonFileName, csvFileName, wwwJsonFileName, wwwCsvFileName,
+                 tiltColor=None, iSpindel=None, policy='immediate', flushInterval=60, flushRows=10,
+                 manifest=None):
+        self.jsonFileName = jsonFileName
+        self.csvFileName = csvFileName
+        self.wwwJsonFileName = wwwJsonFileName
+        self.wwwCsvFileName = wwwCsvFileName
+        self.tiltColor = tiltColor
+        self.iSpindel = iSpindel
+        self.manifest = manifest
+        self.manifestName = os.path.basename(jsonFileName)
+        if policy not in POLICIES:
+            logError("Unknown logDurability '{0}', using 'immediate'.".format(policy))
+            policy = 'immediate'
+        self.policy = policy
+        self.flushInterval = float(flushInterval)
+        self.flushRows = int(flushRows)
+        # The file was made by setFiles() in the configured chartFormat
+        self.encoder = brewpiEncoder.fileEncoder(jsonFileName, tiltColor, iSpindel)
+
+        self.pendingJson = []
+        self.pendingCsv = []
+        self.lastFlush = time.time()
+        self.journal = None
+
+        # Metrics
+        self.rowsAdded = 0
+        self.journalBytes = 0  # Bytes written ahead to the journal
+        self.rowsFlushed = 0
+        self.flushes = 0
+        self.bytesFlushed = 0  # Bytes appended to the local JSON and CSV
+        self.bytesCopied = 0  # Bytes copied to the web server
+        self.lastLatency = 0.0
+        self.maxLatency = 0.0
+        self.totalLatency = 0.0
+
+    def addRow(self, row, now=None):
+        """
+        Add a sample, writing it out if the policy calls for it
+
+        Params:
+        row: dict of values, keyed by column id
+        now: datetime of the reading, defaults to now
+        """
+        if now is None:
+            now = datetime.now()
+        self.addRows([(row, now)])
+
+    def addRows(self, readings):
+        """
+        Add a batch of samples, writing them out together if the policy
+        calls for it
+
+        Params:
+        readings: list of (row, datetime) in the order they were taken
+        """
+        for row, now in readings:
+            self.__buffer(row, now)
+        if self.policy != 'interval' or len(self.pendingJson) >= self.flushRows:
+            self.flush()
+        else:
+            self.poll()
+
+    def __buffer(self, row, now):
+        # Write ahead to the journal so the sample survives a crash while
+        # the chart files are being updated
+        if self.journal is None:
+            self.journal = brewpiJournal.Journal(
+                brewpiJournal.journalName(self.jsonFileName), {
+                    'json': self.jsonFileName,
+                    'csv': self.csvFileName,
+                    'wwwJson': self.wwwJsonFileName,
+                    'wwwCsv': self.wwwCsvFileName,
+                    'tiltColor': self.tiltColor,
+                    'iSpindel': self.iSpindel,
+                }, self.policy == 'fsync')
+        self.journalBytes += self.journal.append(now.timestamp(), row)
+        if self.manifest is not None:
+            self.manifest.addRow(self.manifestName, now.timestamp(), row)
+        self.pendingJson.append(self.encoder.encodeJson(row, now))
+        self.pendingCsv.append(self.encoder.encodeCsv(row, now))
+        self.rowsAdded += 1
+
+    def poll(self):
+        """
+        Flush buffered samples when the flush interval has passed. Call this
+        regularly from the main loop.
+        """
+        if self.pendingJson and (time.time() - self.lastFlush) >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered samples to disk and copy the files to the web
+        server
+        """
+        self.lastFlush = time.time()
+        if not self.pendingJson:
+            return
+        sync = self.policy == 'fsync'
+        start = time.time()
+        written = brewpiJson.addRows(self.jsonFileName, self.pendingJson, sync)
+        written += self.__writeCsv(self.pendingCsv, sync)
+
+        # Copy to www dir. Do not write directly to www dir to
+        # prevent blocking www file.
+        permissions.copyFile(self.jsonFileName, self.wwwJsonFileName)
+        permissions.copyFile(self.csvFileName, self.wwwCsvFileName)
+        latency = time.time() - start
+
+        self.rowsFlushed += len(self.pendingJson)
+        self.pendingJson = []
+        self.pendingCsv = []
+        self.flushes += 1
+        self.bytesFlushed += written
+        self.bytesCopied += os.path.getsize(self.wwwJsonFileName) + os.path.getsize(self.wwwCsvFileName)
+        self.lastLatency = latency
+        self.maxLatency = max(self.maxLatency, latency)
+        self.totalLatency += latency
+
+        if self.manifest is not None:
+            self.manifest.setBytes(self.manifestName, os.path.getsize(self.jsonFileName))
+            self.manifest.saveIfDue()
+
+    def close(self):
+        """
+        Flush anything still buffered. Once everything is safely in the
+        chart files the journal is no longer needed.
+        """
+        try:
+            self.flush()
+        except (IOError, OSError) as e:
+            logError("Unable to flush data log: {0}".format(e))
+            return  # Keep the journal for recovery
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.journal is not None:
+            self.journal.remove()
+            self.journal = None
+
+    def stats(self):
+        """
+        Returns the write metrics as a dict
+        """
+        return {
+            'policy': self.policy,
+            'rowsAdded': self.rowsAdded,
+            'rowsFlushed': self.rowsFlushed,
+            'journalBytes': self.journalBytes,
+            'rowsPending': len(self.pendingJson),
+            'flushes': self.flushes,
+            'bytesFlushed': self.bytesFlushed,
+            'bytesCopied': self.bytesCopied,
+            'lastLatency': round(self.lastLatency, 4),
+            'maxLatency': round(self.maxLatency, 4),
+            'avgLatency': round(self.totalLatency / self.flushes, 4) if self.flushes else 0.0,
+        }
+
+    def __writeCsv(self, lines, sync):
+        data = b''
+        # Check if CSV file exists, if not do a header
+        isNew = not os.path.exists(self.csvFileName)
+        if isNew:
+            data = csvHeader(self.tiltColor, self.iSpindel).encode('utf-8')
+        data += b''.join(lines)
+        csvFile = open(self.csvFileName, "ab")
+        csvFile.write(data)
+        if sync:
+            csvFile.flush()
+            os.fsync(csvFile.fileno())
+        csvFile.close()
+        if isNew:
+            permissions.newFile(self.csvFileName)
+        return len(data)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+# Optional SQLite store of readings and events. Readings are kept one value
+# per row (beer, ts, key, value) so Tilt, iSpindel and Brew Bubbles values
+# need no schema changes. Events hold mode and setpoint changes from the
+# socket and messages from the controller.
+
+import os
+import sqlite3
+import threading
+import time
+from BrewPiUtil import permissions
+from brewpiPipeline import Sink
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS readings (beer TEXT NOT NULL, ts REAL NOT NULL, '
+    'key TEXT NOT NULL, value REAL)',
+    'CREATE INDEX IF NOT EXISTS readings_beer_ts ON readings (beer, ts)',
+    'CREATE INDEX IF NOT EXISTS readings_beer_key_ts ON readings (beer, key, ts)',
+    'CREATE TABLE IF NOT EXISTS events (beer TEXT, ts REAL NOT NULL, '
+    'kind TEXT NOT NULL, data TEXT)',
+    'CREATE INDEX IF NOT EXISTS events_beer_ts ON events (beer, ts)',
+]
+
+# Socket commands recorded as events
+EVENT_COMMANDS = ['setBeer', 'setFridge', 'setOff', 'setParameters', 'setActiveProfile',
+                  'startNewBrew', 'stopLogging', 'pauseLogging', 'resumeLogging', 'interval']
+
+AGGREGATES = ['avg', 'min', 'max', 'count', 'sum']
+
+
+def connect(fileName):
+    """
+    Opens a connection in WAL mode, creating the tables if needed
+    """
+    conn = sqlite3.connect(fileName, timeout=10)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+def readingValues(beer, timestamp, row):
+    """
+    Returns the (beer, ts, key, value) rows of the numbers in a reading
+    """
+    values = []
+    for key in row:
+        value = row[key]
+        if value is None or isinstance(value, (bool, str)):
+            continue
+        try:
+            values.append((beer, timestamp, key, float(value)))
+        except (TypeError, ValueError):
+            pass
+    return values
+
+
+class Database(Sink):
+    """
+    Stores readings and events in SQLite, written from its sink thread.
+    Queries run on a connection of the calling thread.
+    """
+
+    name = 'database'
+
+    def __init__(self, fileName, maxQueue=1000, maxBatch=500):
+        """
+        :param fileName: Path of the database file
+        :param maxQueue: Most items waiting before new ones are dropped
+        :param maxBatch: Most readings written in one transaction
+        """
+        # A locked database is worth another go before giving up on a batch
+        Sink.__init__(self, maxQueue, maxBatch, retries=2, retryDelay=1.0)
+        self.fileName = fileName
+        self.conn = None
+        self.reader = None
+        self.readerThread = None
+        self.transactions = 0
+        self.rowsWritten = 0
+
+    def start(self):
+        # Create the database up front so it gets its owner and mode
+        isNew = not os.path.exists(self.fileName)
+        connect(self.fileName).close()
+        if isNew:
+            permissions.newFile(self.fileName)
+        Sink.start(self)
+
+    def stop(self):
+        """
+        Write everything still queued and stop the writer thread
+        """
+        Sink.stop(self)
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def addEvent(self, beer, kind, data=None, timestamp=None):
+        """
+        Queue an event
+
+        :param beer: Beer name, None if not logging
+        :param kind: Kind of event, e.g. the socket command
+        :param data: Text of the event, e.g. the command's value
+        :param timestamp: Epoch time, defaults to now
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self.control('event', beer, timestamp, kind, data, wait=False)
+
+    def query(self, request):
+        """
+        Answers a query
+
+        :param request: dict with 'q' and its arguments:
+            range:      beer, from, to, [keys]  readings between two times
+            last:       beer, n, [keys]         the last n readings
+            aggregate:  beer, key, fn, from, to, [bucket]
+                        fn is one of AGGREGATES, bucket groups by seconds
+            events:     beer, from, to          events between two times
+        :return: dict with 'cols' and 'rows'
+        """
+        conn = self.__readerConnection()
+        kind = request.get('q')
+        beer = request.get('beer')
+        start = float(request.get('from', 0))
+        end = float(request.get('to', time.time()))
+        keys = request.get('keys')
+
+        if kind == 'range' or kind == 'last':
+            where = 'beer = ?'
+            args = [beer]
+            if keys:
+                where += ' AND key IN ({0})'.format(','.join('?' * len(keys)))
+                args += keys
+            if kind == 'range':
+                sql = 'SELECT ts, key, value FROM readings WHERE {0} AND ts >= ? AND ts <= ? ORDER BY ts'.format(where)
+                rows = conn.execute(sql, args + [start, end]).fetchall()
+            else:
+                n = int(request.get('n', 100))
+                sql = ('SELECT ts, key, value FROM readings WHERE {0} AND ts IN '
+                       '(SELECT DISTINCT ts FROM readings WHERE beer = ? ORDER BY ts DESC LIMIT ?) '
+                       'ORDER BY ts').format(where)
+                rows = conn.execute(sql, args + [beer, n]).fetchall()
+            return self.__pivot(rows)
+
+        if kind == 'aggregate':
+            fn = request.get('fn', 'avg')
+            if fn not in AGGREGATES:
+                raise ValueError("Unknown aggregate '{0}'".format(fn))
+            bucket = float(request.get('bucket', 0))
+            group = 'CAST(ts / ? AS INTEGER) * ?' if bucket else '0'
+            sql = ('SELECT {0} AS bucket, {1}(value) FROM readings WHERE beer = ? AND key = ? '
+                   'AND ts >= ? AND ts <= ? GROUP BY bucket ORDER BY bucket').format(group, fn)
+            args = ([bucket, bucket] if bucket else []) + [beer, request.get('key'), start, end]
+            return {'cols': ['Time', fn], 'rows': [list(row) for row in conn.execute(sql, args)]}
+
+        if kind == 'events':
+            sql = 'SELECT ts, kind, data FROM events WHERE (beer = ? OR beer IS NULL) AND ts >= ? AND ts <= ? ORDER BY ts'
+            rows = conn.execute(sql, [beer, start, end]).fetchall()
+            return {'cols': ['Time', 'kind', 'data'], 'rows': [list(row) for row in rows]}
+
+        raise ValueError("Unknown query '{0}'".format(kind))
+
+    def stats(self):
+        stats = Sink.stats(self)
+        stats['transactions'] = self.transactions
+        stats['rowsWritten'] = self.rowsWritten
+        return stats
+
+    def connect(self):
+        self.conn = connect(self.fileName)
+
+    def disconnect(self):
+        self.conn.close()
+        self.conn = None
+
+    def write(self, batch):
+        values = []
+        for record in batch:
+            values.extend(readingValues(record.beer, record.time.timestamp(), record.row))
+        with self.conn:
+            self.conn.executemany('INSERT INTO readings VALUES (?, ?, ?, ?)', values)
+        self.transactions += 1
+        self.rowsWritten += len(values)
+
+    def handle(self, control):
+        if control.action == 'event':
+            with self.conn:
+                self.conn.execute('INSERT INTO events VALUES (?, ?, ?, ?)', control.args)
+            self.transactions += 1
+            self.rowsWritten += 1
+
+    def __pivot(self, rows):
+        # Turn (ts, key, value) rows into one row per time
+        keys = []
+        byTime = {}
+        for ts, key, value in rows:
+            if key not in keys:
+                keys.append(key)
+            byTime.setdefault(ts, {})[key] = value
+        return {
+            'cols': ['Time'] + keys,
+            'rows': [[ts] + [byTime[ts].get(key) for key in keys] for ts in sorted(byTime)],
+        }
+
+    def __readerConnection(self):
+        # sqlite3 connections belong to the thread which made them
+        if self.reader is None or self.readerThread != threading.get_ident():
+            self.reader = connect(self.fileName)
+            self.readerThread = threading.get_ident()
+        return self.reader
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+# Row encoders turn a reading into the bytes appended to the chart JSON and
+# CSV files. The work that only depends on the columns (which Tilt color or
+# iSpindel is logged, which columns hold text) is done once when the encoder
+# is built, leaving a single string format per row and format.
+
+import sys
+import threading
+import time
+from datetime import datetime
+import simplejson as json
+import brewpiJson
+
+# Columns holding text rather than numbers
+STRING_COLUMNS = ['BeerAnn', 'FridgeAnn']
+
+# One encoder per column schema
+encoders = {}
+encodersLock = threading.Lock()
+
+
+def getEncoder(tiltColor=None, iSpindel=None):
+    """
+    Returns the shared encoder for a column schema
+
+    Params:
+    tiltColor: Color of the Tilt being logged, or list of colors, see
+               brewpiJson.tiltColumns()
+    iSpindel: Name of the iSpindel being logged, if any
+
+    Returns:
+    RowEncoder object
+    """
+    # The iSpindel name does not change the columns, only that there is one
+    if isinstance(tiltColor, list):
+        tiltColor = tuple(tiltColor)
+    key = (tiltColor or None, None if tiltColor else bool(iSpindel))
+    with encodersLock:
+        encoder = encoders.get(key)
+        if encoder is None:
+            encoder = RowEncoder(tiltColor, iSpindel)
+            encoders[key] = encoder
+        return encoder
+
+
+def fileEncoder(jsonFileName, tiltColor=None, iSpindel=None):
+    """
+    Returns an encoder for appending to an existing chart file, in the
+    layout the file was created with
+
+    Params:
+    jsonFileName: Path of the chart JSON file
+    tiltColor: Color of the Tilt being logged, if any
+    iSpindel: Name of the iSpindel being logged, if any
+
+    Returns:
+    RowEncoder object, a CompactEncoder primed with the rows in the file
+    for compact files
+    """
+    if brewpiJson.chartFormat(jsonFileName) == 'compact':
+        encoder = CompactEncoder(tiltColor, iSpindel)
+        encoder.prime(brewpiJson.readRows(jsonFileName))
+        return encoder
+    return getEncoder(tiltColor, iSpindel)
+
+
+def jsonNumber(value):
+    return 'null' if value is None else '{"v":%s}' % value
+
+
+def jsonString(value):
+    return 'null' if value is None else '{"v":"%s"}' % value
+
+
+def csvNumber(value):
+    return 'null' if value is None else '%s' % value
+
+
+def csvString(value):
+    return 'null' if value is None else json.dumps(value)
+
+
+class RowEncoder():
+    """
+    Encodes rows of one column schema for the chart JSON and CSV files
+    """
+
+    def __init__(self, tiltColor=None, iSpindel=None):
+        self.columns = brewpiJson.columnIds(tiltColor, iSpindel)
+        keys = self.columns[1:]  # Time is taken from the reading
+        self.jsonFields = tuple(
+            (key, jsonString if key in STRING_COLUMNS else jsonNumber) for key in keys)
+        self.csvFields = tuple(
+            (key, csvString if key in STRING_COLUMNS else csvNumber) for key in keys)
+        self.jsonFormat = '{"c":[{"v":"Date(%d,%d,%d,%d,%d,%d)"},' + ','.join(['%s'] * len(keys)) + ']}'
+        self.csvFormat = '%04d-%02d-%02d %02d:%02d:%02d,' + ','.join(['%s'] * len(keys)) + '\r\n'
+
+    def encodeJson(self, row, now):
+        """
+        Encodes a row for the chart JSON file
+
+        :param row: dict of values, keyed by column id, missing ones are null
+        :param now: datetime of the reading
+        :return: bytes, same text as brewpiJson.formatRow()
+        """
+        get = row.get
+        values = (now.year, now.month - 1, now.day, now.hour, now.minute, now.second) + \
+            tuple([cell(get(key)) for key, cell in self.jsonFields])
+        return (self.jsonFormat % values).encode('utf-8')
+
+    def encodeCsv(self, row, now):
+        """
+        Encodes a row for the CSV file
+
+        :param row: dict of values, keyed by column id, missing ones are null
+        :param now: datetime of the reading
+        :return: bytes of the line, same text as brewpiDataLog.csvLine()
+        """
+        get = row.get
+        values = (now.year, now.month, now.day, now.hour, now.minute, now.second) + \
+            tuple([cell(get(key)) for key, cell in self.csvFields])
+        return (self.csvFormat % values).encode('utf-8')
+
+
+class CompactEncoder(RowEncoder):
+    """
+    Encodes rows for a chart JSON file in the compact format (see
+    brewpiJson.CHART_FORMATS). Each row is stored relative to the one
+    before, so use one encoder per file and prime() it when appending to a
+    file which already holds rows.
+    """
+
+    def __init__(self, tiltColor=None, iSpindel=None):
+        RowEncoder.__init__(self, tiltColor, iSpindel)
+        self.scales = brewpiJson.compactScales(self.columns)
+        self.keys = self.columns[1:]
+        self.last = [0] * len(self.columns)  # Last non-null quantized values
+
+    def prime(self, rows):
+        """
+        Take up the state after the rows already in a file
+
+        :param rows: List of compact row strings, e.g. from brewpiJson.readRows()
+        """
+        for row in rows:
+            values = json.loads(row) if isinstance(row, str) else row
+            for i, value in enumerate(values):
+                if value is not None and self.scales[i] is not None:
+                    self.last[i] += value
+
+    def lastTime(self):
+        """
+        Returns the datetime of the last row encoded or primed, or None
+        """
+        return datetime.fromtimestamp(self.last[0]) if self.last[0] else None
+
+    def encodeJson(self, row, now):
+        """
+        Encodes a row for the chart JSON file
+
+        :param row: dict of values, keyed by column id, missing ones are null
+        :param now: datetime of the reading
+        :return: bytes, e.g. [60,-2,0,null,1,0,null,null,0,-1]
+        """
+        timestamp = int(time.mktime(now.timetuple()))
+        cells = [str(timestamp - self.last[0])]
+        self.last[0] = timestamp
+        for i, key in enumerate(self.keys, 1):
+            value = row.get(key)
+            scale = self.scales[i]
+            if value is None:
+                cells.append('null')
+            elif scale is None:
+                cells.append(json.dumps(str(value)))
+            else:
+                quantized = int(round(float(value) * scale))
+                cells.append(str(quantized - self.last[i]))
+                self.last[i] = quantized
+        return ('[' + ','.join(cells) + ']').encode('utf-8')
+
+
+def main():
+    # Compare the rows per second of the encoders with formatting each
+    # field separately, as was done before
+    import argparse
+    import brewpiDataLog
+    parser = argparse.ArgumentParser(
+        description="Benchmark the chart JSON and CSV row encoders")
+    parser.add_argument("-n", "--rows", type=int, default=100000,
+                        help="number of rows to encode")
+    parser.add_argument("-t", "--tilt", default='Red',
+                        help="Tilt color to include, empty for none")
+    args = parser.parse_args()
+
+    tiltColor = args.tilt or None
+    row = {'BeerTemp': 19.94, 'BeerSet': 20.0, 'BeerAnn': None,
+           'FridgeTemp': 18.51, 'FridgeSet': 19.6, 'FridgeAnn': 'Cooling',
+           'RoomTemp': 21.3, 'State': 4}
+    if tiltColor:
+        row[tiltColor + 'SG'] = 1.0502
+    now = datetime.now()
+
+    start = time.perf_counter()
+    for _ in range(args.rows):
+        brewpiJson.formatRow(row, tiltColor, None, now).encode('utf-8')
+        brewpiDataLog.csvLine(row, now, tiltColor, None).encode('utf-8')
+    before = args.rows / (time.perf_counter() - start)
+
+    encoder = getEncoder(tiltColor, None)
+    start = time.perf_counter()
+    for _ in range(args.rows):
+        encoder.encodeJson(row, now)
+        encoder.encodeCsv(row, now)
+    after = args.rows / (time.perf_counter() - start)
+
+    print("Per field: {0:.0f} rows/s".format(before))
+    print("Encoder:   {0:.0f} rows/s ({1:.1f}x)".format(after, after / before))
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import time
+from array import array
+
+# Columns holding text rather than numbers
+STRING_COLUMNS = ['BeerAnn', 'FridgeAnn']
+
+NAN = float('nan')
+
+
+def parseRecent(value):
+    """
+    Parses the value of a getRecent socket command
+
+    Params:
+    value: '<seconds>[,since=<rowId>]', e.g. '3600,since=1234'
+
+    Returns:
+    Tuple of (seconds, since), either may be None
+    """
+    seconds = None
+    since = None
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if part.startswith('since='):
+            since = int(part[6:])
+        else:
+            seconds = float(part)
+    return seconds, since
+
+
+class History():
+    """
+    Keeps the most recent readings in memory for the live chart
+
+    Every number column is a fixed-size array of doubles (NaN for null),
+    written round robin. Each reading gets an increasing row id, so a client
+    can ask for just the rows after the last one it has.
+    """
+
+    def __init__(self, columns, capacity):
+        """
+        :param columns: List of column ids, without Time
+        :param capacity: Number of readings kept
+        """
+        self.columns = list(columns)
+        self.capacity = max(1, int(capacity))
+        self.times = array('d', [0.0]) * self.capacity
+        self.values = []
+        for column in self.columns:
+            if column in STRING_COLUMNS:
+                self.values.append([None] * self.capacity)
+            else:
+                self.values.append(array('d', [NAN]) * self.capacity)
+        self.nextId = 0  # Row id of the next reading
+
+    def add(self, row, timestamp=None):
+        """
+        Store a reading, replacing the oldest once full
+
+        :param row: dict of values, keyed by column id
+        :param timestamp: Epoch time of the reading, defaults to now
+        :return: Row id of the reading
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        rowId = self.nextId
+        index = rowId % self.capacity
+        self.times[index] = timestamp
+        for column, values in zip(self.columns, self.values):
+            value = row.get(column)
+            if isinstance(values, list):
+                values[index] = value
+            elif value is None:
+                values[index] = NAN
+            else:
+                try:
+                    values[index] = float(value)
+                except (TypeError, ValueError):
+                    values[index] = NAN
+        self.nextId = rowId + 1
+        return rowId
+
+    def recent(self, seconds=None, since=None, now=None):
+        """
+        Returns the readings of the last seconds newer than a row id
+
+        :param seconds: How far back to go, None for everything kept
+        :param since: Last row id the client has, None for none
+        :param now: Epoch time to count back from, defaults to now
+        :return: dict with 'cols', 'rows' of [rowId, time, values...] oldest
+                 first and 'last', the newest row id (or None when empty)
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - seconds if seconds is not None else None
+        first = max(0, self.nextId - self.capacity)
+        if since is not None:
+            first = max(first, since + 1)
+        rows = []
+        # Walk back from the newest reading until one is too old
+        for rowId in range(self.nextId - 1, first - 1, -1):
+            index = rowId % self.capacity
+            timestamp = self.times[index]
+            if cutoff is not None and timestamp < cutoff:
+                break
+            row = [rowId, round(timestamp, 3)]
+            for values in self.values:
+                value = values[index]
+                if isinstance(value, float) and math.isnan(value):
+                    value = None
+                row.append(value)
+            rows.append(row)
+        rows.reverse()
+        return {
+            'cols': ['id', 'Time'] + self.columns,
+            'rows': rows,
+            'last': self.nextId - 1 if self.nextId else None,
+        }
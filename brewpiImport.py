@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+# Indexes the chart files of earlier brews: builds the manifest of every
+# beer directory and can compress closed files and write column stores.
+# Files already in a manifest with the same size are skipped, and each
+# manifest is saved as files are done, so the tool can be stopped and run
+# again at any time. The beer BrewPi is logging to is left alone, its
+# manifest is kept by the running brewpi.py.
+#
+# Usage: brewpiImport.py [-j 4] [-m gzip] [--columns] [data directory]
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+import brewpiChart
+import brewpiCompress
+import brewpiJson
+import brewpiManifest
+import BrewPiUtil as util
+from BrewPiUtil import logMessage
+from BrewPiUtil import logError
+
+COLUMN_DIR = 'columns'
+
+# Save a manifest after this many files, so an interrupted run loses little
+SAVE_EVERY = 20
+
+
+def chartFiles(path):
+    """
+    Lists the chart files in a beer directory
+
+    Returns:
+    List of (name, dataFile) with name being the uncompressed file name
+    """
+    files = []
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return files
+    for name in names:
+        dataName = name
+        for method in brewpiCompress.COMPRESSORS:
+            suffix = brewpiCompress.COMPRESSORS[method][0]
+            if name.endswith(suffix):
+                dataName = name[:-len(suffix)]
+        if dataName.endswith('.json') and dataName != brewpiManifest.MANIFEST_NAME:
+            files.append((dataName, os.path.join(path, name)))
+    return files
+
+
+def isIndexed(entry, dataFile):
+    """
+    Returns True if a manifest entry is complete and matches the file
+    """
+    if entry is None or entry.get('rows') is None:
+        return False
+    try:
+        return entry.get('bytes') == os.path.getsize(dataFile)
+    except OSError:
+        return False
+
+
+def writeColumns(jsonFileName, columnFileName):
+    """
+    Writes the numeric columns of a chart file as numpy arrays, with epoch
+    seconds in 'Time' and NaN for null
+    """
+    chart = brewpiChart.loadChart(jsonFileName)
+    ids = [col['id'] for col in chart['cols']]
+    types = [col.get('type') for col in chart['cols']]
+    arrays = {}
+    times = []
+    for row in chart['rows']:
+        cells = row['c']
+        timestamp = None
+        if cells and cells[0] is not None:
+            timestamp = brewpiJson.rowTime(cells[0]['v'])
+        times.append(time.mktime(timestamp.timetuple()) if timestamp else np.nan)
+    arrays['Time'] = np.array(times, dtype=np.float64)
+    for i, column in enumerate(ids):
+        if i == 0 or types[i] != 'number':
+            continue
+        values = np.full(len(chart['rows']), np.nan)
+        for j, row in enumerate(chart['rows']):
+            cell = row['c'][i] if i < len(row['c']) else None
+            if cell is not None and cell.get('v') is not None:
+                values[j] = float(cell['v'])
+        arrays[column] = values
+    tempName = '{0}.tmp.npz'.format(columnFileName[:-4])
+    np.savez_compressed(tempName, **arrays)
+    os.replace(tempName, columnFileName)
+    util.permissions.newFile(columnFileName)
+
+
+def indexFile(task):
+    """
+    Worker: compress and index one chart file
+
+    Params:
+    task: Tuple of (path, name, dataFile, method, columns)
+
+    Returns:
+    Tuple of (path, name, entry, bytesRead, error)
+    """
+    path, name, dataFile, method, columns = task
+    jsonFileName = os.path.join(path, name)
+    try:
+        bytesRead = os.path.getsize(dataFile)
+        if method and dataFile == jsonFileName:
+            if brewpiCompress.compressFile(jsonFileName, method) is None:
+                return path, name, None, bytesRead, "compression failed"
+        entry = brewpiManifest.fileStats(jsonFileName)
+        if entry is None:
+            return path, name, None, bytesRead, "unable to read"
+        if columns:
+            columnPath = os.path.join(path, COLUMN_DIR)
+            util.permissions.makeDirs(columnPath)
+            writeColumns(jsonFileName, os.path.join(
+                columnPath, '{0}.npz'.format(name[:-len('.json')])))
+        return path, name, entry, bytesRead, None
+    except Exception as e:
+        return path, name, None, 0, str(e)
+
+
+def activeBeer():
+    """
+    Returns the name of the beer directory BrewPi logs to, or None
+    """
+    try:
+        config = util.readCfgWithDefaults()
+    except Exception:
+        return None
+    # Even with logging stopped a running brewpi.py keeps the manifest in
+    # memory and saves it on resume
+    return config.get('beerName') or None
+
+
+def findTasks(dataPath, method, columns, today, active=None):
+    """
+    Lists the files of all beer directories which still need doing
+
+    Params:
+    active: Name of the beer directory in use by a running BrewPi, skipped
+
+    Returns:
+    Tuple of (tasks, skipped)
+    """
+    tasks = []
+    skipped = 0
+    for beer in sorted(os.listdir(dataPath)):
+        path = os.path.join(dataPath, beer)
+        if not os.path.isdir(path):
+            continue
+        if beer == active:
+            skipped += len(chartFiles(path))  # Manifest owned by brewpi.py
+            continue
+        manifest = brewpiManifest.getManifest(path)
+        for name, dataFile in chartFiles(path):
+            if today in name:
+                skipped += 1  # May still be written by a running BrewPi
+                continue
+            entry = manifest.files.get(name)
+            done = isIndexed(entry, dataFile)
+            if done and method and not entry.get('compressed'):
+                done = False
+            if done and columns and not os.path.isfile(os.path.join(
+                    path, COLUMN_DIR, '{0}.npz'.format(name[:-len('.json')]))):
+                done = False
+            if done:
+                skipped += 1
+            else:
+                tasks.append((path, name, dataFile, method, columns))
+    return tasks, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index and archive the chart files of earlier brews")
+    parser.add_argument("path", nargs='?', default='{0}data/'.format(util.scriptPath()),
+                        help="data directory holding one directory per beer")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("-m", "--method", choices=sorted(brewpiCompress.COMPRESSORS),
+                        help="also compress the files")
+    parser.add_argument("--columns", action='store_true',
+                        help="also write numpy column stores to <beer>/{0}/".format(COLUMN_DIR))
+    parser.add_argument("-w", "--www", help="web data directory to copy the manifests to")
+    args = parser.parse_args()
+
+    util.permissions.addTree(args.path, 'brewpi', 'brewpi')
+    if args.www:
+        util.permissions.addTree(args.www, 'brewpi', 'www-data')
+
+    today = '-{0}'.format(time.strftime("%Y%m%d"))
+    tasks, skipped = findTasks(args.path, args.method, args.columns, today, activeBeer())
+    logMessage("{0} file(s) to index, {1} already done or in use.".format(len(tasks), skipped))
+    if not tasks:
+        return
+
+    start = time.time()
+    files = 0
+    failed = 0
+    rows = 0
+    bytesRead = 0
+    unsaved = {}  # Manifest: files done since it was last saved
+    pool = multiprocessing.Pool(max(1, args.jobs))
+    try:
+        for path, name, entry, size, error in pool.imap_unordered(indexFile, tasks):
+            manifest = brewpiManifest.getManifest(path)
+            if args.www:
+                manifest.wwwPath = os.path.join(args.www, os.path.basename(path))
+            if error:
+                logError("Unable to index {0}: {1}".format(os.path.join(path, name), error))
+                failed += 1
+            else:
+                with manifest.lock:
+                    manifest.files[name] = entry
+                files += 1
+                rows += entry['rows']
+                bytesRead += size
+            unsaved[manifest] = unsaved.get(manifest, 0) + 1
+            if unsaved[manifest] >= SAVE_EVERY:
+                manifest.save()
+                unsaved[manifest] = 0
+    finally:
+        pool.close()
+        pool.join()
+        for manifest in unsaved:
+            manifest.save()
+
+    elapsed = max(time.time() - start, 0.001)
+    logMessage("Indexed {0} file(s), {1} failed, in {2:.1f}s: {3:.1f} files/s, {4:.0f} rows/s, {5:.2f} MB/s.".format(
+        files, failed, elapsed, files / elapsed, rows / elapsed, bytesRead / elapsed / 1048576))
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+# The journal is an append-only file with one record per line:
+#
+#   <crc32 of payload as 8 hex digits> <JSON payload>
+#
+# The first record is a header describing the files the journal belongs
+# to: {"h": {...}}. Every other record is a reading: {"t": epoch, "r": row}.
+# A record which is cut short or fails its checksum is skipped on reading.
+
+import os
+import zlib
+import simplejson as json
+from BrewPiUtil import permissions
+
+JOURNAL_SUFFIX = '.journal'
+
+
+def journalName(jsonFileName):
+    """
+    Returns the name of the journal kept next to a chart JSON file
+    """
+    return '{0}{1}'.format(os.path.splitext(jsonFileName)[0], JOURNAL_SUFFIX)
+
+
+def encodeRecord(payload):
+    """
+    Encodes a payload as a checksummed journal line
+
+    Params:
+    payload: JSON serializable object
+
+    Returns:
+    bytes of the record, including the line end
+    """
+    data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(data), data)
+
+
+def decodeRecord(line):
+    """
+    Decodes a journal line
+
+    Params:
+    line: bytes of one line, with or without the line end
+
+    Returns:
+    The payload, or None if the record is incomplete or corrupt
+    """
+    if not line.endswith(b'\n'):
+        return None  # Cut short by a crash
+    crc, sep, data = line.rstrip(b'\n').partition(b' ')
+    if not sep or len(crc) != 8:
+        return None
+    try:
+        if int(crc, 16) != zlib.crc32(data):
+            return None
+        return json.loads(data.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class Journal():
+    """
+    Append-only journal of readings written ahead of the chart files
+    """
+
+    def __init__(self, fileName, header, sync=False):
+        """
+        Opens (creating if needed) a journal
+
+        :param fileName: Path of the journal
+        :param header: dict describing the files the journal belongs to
+        :param sync: If True, fsync every record
+        """
+        self.fileName = fileName
+        self.sync = sync
+        self.records = 0
+        isNew = not os.path.isfile(fileName)
+        self.file = open(fileName, 'ab')
+        if isNew:
+            permissions.newFile(fileName)
+            self.__write(encodeRecord({'h': header}))
+
+    def append(self, timestamp, row):
+        """
+        Write a reading to the journal
+
+        :param timestamp: Epoch time of the reading
+        :param row: dict of values, keyed by column id
+        :return: Number of bytes written
+        """
+        record = encodeRecord({'t': timestamp, 'r': row})
+        self.__write(record)
+        self.records += 1
+        return len(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        """
+        Close and delete the journal once its readings are safely in the
+        chart files
+        """
+        self.close()
+        if os.path.isfile(self.fileName):
+            os.remove(self.fileName)
+
+    def __write(self, record):
+        self.file.write(record)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+
+
+def readJournal(fileName):
+    """
+    Reads all intact records from a journal
+
+    Params:
+    fileName: Path of the journal
+
+    Returns:
+    Tuple of (header, readings, bad) where header is the header dict (or
+    None), readings is a list of (timestamp, row) and bad is the number
+    of records skipped
+    """
+    header = None
+    readings = []
+    bad = 0
+    with open(fileName, 'rb') as journalFile:
+        for line in journalFile:
+            payload = decodeRecord(line)
+            if payload is None:
+                bad += 1
+            elif 'h' in payload:
+                header = payload['h']
+            elif 't' in payload and 'r' in payload:
+                readings.append((payload['t'], payload['r']))
+            else:
+                bad += 1
+    return header, readings, bad
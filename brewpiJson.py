@@ -34,11 +34,29 @@ from datetime import datetime
 import time
 import os
 import re
-import Tilt
+import simplejson as json
+import brewpiCompress
+import brewpiEncoder
 from BrewPiUtil import Unbuffered
 from BrewPiUtil import logMessage
 from BrewPiUtil import logError
 
+# Chart file layouts:
+#   google  = Google Charts DataTable, rows of {"c":[{"v":"Date(...)"},...]}
+#   compact = Rows of integers: epoch seconds and values multiplied by the
+#             column's scale and rounded, each stored as the difference to
+#             the last non-null value of its column. Text columns are kept
+#             as is. See brewpiChart for converting between the two.
+CHART_FORMATS = ['google', 'compact']
+COMPACT_VERSION = 1
+
+# Tilt colors, in the order of their iBeacon UUIDs (see Tilt.TILT_UUIDS)
+TILT_COLORS = ['Red', 'Green', 'Black', 'Purple', 'Orange', 'Blue', 'Yellow', 'Pink']
+
+# Scale factors of the compact format: centi-degrees and 1/10000 SG
+TEMP_SCALE = 100
+SG_SCALE = 10000
+
 
 def fixJson(j):
     j = re.sub(r"'{\s*?(|\w)", r'{"\1', j)
@@ -49,93 +67,258 @@ def fixJson(j):
 
 
 def addRow(jsonFileName, row, tiltColor = None, iSpindel = None):
-    jsonFile = open(jsonFileName, "r+")
-    # jsonFile.seek(-3, 2)  # Go insert point to add the last row
-    jsonFile.seek(0, os.SEEK_END)
-    jsonFile.seek(jsonFile.tell() - 3, os.SEEK_SET)
+    if chartFormat(jsonFileName) == 'compact':
+        # The new row is stored relative to the ones already in the file
+        encoder = brewpiEncoder.fileEncoder(jsonFileName, tiltColor, iSpindel)
+        addRows(jsonFileName, [encoder.encodeJson(row, datetime.now())])
+    else:
+        addRows(jsonFileName, [formatRow(row, tiltColor, iSpindel)])
+
+
+def addRows(jsonFileName, rows, sync = False):
+    """
+    Appends rows to a chart JSON file in a single write
+
+    Params:
+    jsonFileName: Path of the chart JSON file
+    rows: List of rows as made by formatRow() (str) or by a
+          brewpiEncoder.RowEncoder (bytes)
+    sync: If True, fsync the file before closing it
+
+    Returns:
+    Number of bytes written
+    """
+    if not rows:
+        return 0
+    rows = [row.encode('utf-8') if isinstance(row, str) else row for row in rows]
+    jsonFile = open(jsonFileName, "rb+")
+    jsonFile.seek(-3, os.SEEK_END)  # Go insert point to add the last row
     ch = jsonFile.read(1)
     jsonFile.seek(0, os.SEEK_CUR)
     # When alternating between reads and writes, the file contents should be flushed, see
     # http://bugs.python.org/issue3207. This prevents IOError, Errno 0
-    if ch != '[':
+    linesep = os.linesep.encode('utf-8')
+    data = b''
+    if ch != b'[':
         # not the first item
-        jsonFile.write(',')
-    newRow = {}
-    newRow['Time'] = datetime.today()
-
-    # Insert a new JSON row
-    # {"c":[{"v":"Date(2012,8,26,0,1,0)"},{"v":18.96},{"v":19.0},null,{"v":19.94},{"v":19.6},null]},
-    jsonFile.write(os.linesep)
-    jsonFile.write("{\"c\":[")
-    now = datetime.now()
-    jsonFile.write("{{\"v\":\"Date({y},{M},{d},{h},{m},{s})\"}},".format(
-        y=now.year, M=(now.month - 1), d=now.day, h=now.hour, m=now.minute, s=now.second))
+        data = b','
+    data += linesep + (b',' + linesep).join(rows)
+    # rewrite end of json file
+    data += b"]}"
+    jsonFile.write(data)
+    if sync:
+        jsonFile.flush()
+        os.fsync(jsonFile.fileno())
+    jsonFile.close()
+    return len(data)
+
+
+def formatRow(row, tiltColor = None, iSpindel = None, now = None):
+    """
+    Formats a row of data as a Google Charts JSON row
+
+    Params:
+    row: dict of values, keyed by column id
+    tiltColor: Color of the Tilt being logged, or list of colors, see
+               tiltColumns()
+    iSpindel: Name of the iSpindel being logged, if any
+    now: datetime of the reading, defaults to now
+
+    Returns:
+    String with the row, e.g.
+    {"c":[{"v":"Date(2012,8,26,0,1,0)"},{"v":18.96},{"v":19.0},null,{"v":19.94},{"v":19.6},null]}
+    """
+    if now is None:
+        now = datetime.now()
+    line = "{\"c\":["
+    line += "{{\"v\":\"Date({y},{M},{d},{h},{m},{s})\"}},".format(
+        y=now.year, M=(now.month - 1), d=now.day, h=now.hour, m=now.minute, s=now.second)
     if row['BeerTemp'] is None:
-        jsonFile.write("null,")
+        line += "null,"
     else:
-        jsonFile.write("{\"v\":" + str(row['BeerTemp']) + "},")
+        line += "{\"v\":" + str(row['BeerTemp']) + "},"
 
     if row['BeerSet'] is None:
-        jsonFile.write("null,")
+        line += "null,"
     else:
-        jsonFile.write("{\"v\":" + str(row['BeerSet']) + "},")
+        line += "{\"v\":" + str(row['BeerSet']) + "},"
 
     if row['BeerAnn'] is None:
-        jsonFile.write("null,")
+        line += "null,"
     else:
-        jsonFile.write("{\"v\":\"" + str(row['BeerAnn']) + "\"},")
+        line += "{\"v\":\"" + str(row['BeerAnn']) + "\"},"
 
     if row['FridgeTemp'] is None:
-        jsonFile.write("null,")
+        line += "null,"
     else:
-        jsonFile.write("{\"v\":" + str(row['FridgeTemp']) + "},")
+        line += "{\"v\":" + str(row['FridgeTemp']) + "},"
 
     if row['FridgeSet'] is None:
-        jsonFile.write("null,")
+        line += "null,"
     else:
-        jsonFile.write("{\"v\":" + str(row['FridgeSet']) + "},")
+        line += "{\"v\":" + str(row['FridgeSet']) + "},"
 
     if row['FridgeAnn'] is None:
-        jsonFile.write("null,")
+        line += "null,"
     else:
-        jsonFile.write("{\"v\":\"" + str(row['FridgeAnn']) + "\"},")
+        line += "{\"v\":\"" + str(row['FridgeAnn']) + "\"},"
 
     if row['RoomTemp'] is None:
-        jsonFile.write("null,")
+        line += "null,"
     else:
-        jsonFile.write("{\"v\":" + str(row['RoomTemp']) + "},")
+        line += "{\"v\":" + str(row['RoomTemp']) + "},"
 
     if row['State'] is None:
-        jsonFile.write("null")
+        line += "null"
     else:
-        jsonFile.write("{\"v\":" + str(row['State']) + "}")
+        line += "{\"v\":" + str(row['State']) + "}"
 
     # Write Tilt values
     if tiltColor:
-        for color in Tilt.TILT_COLORS:
-            # Only log the Tilt if the color matches the config
-            if color == tiltColor:
-                jsonFile.write(",")
-
-                # Log Tilt SG
-                if row.get(color + 'SG', None) is None:
-                    jsonFile.write("null")
-                else:
-                    jsonFile.write("{\"v\":" + str(row[color + 'SG']) + "}")
+        for column in tiltColumns(tiltColor):
+            line += ","
+            if row.get(column, None) is None:
+                line += "null"
+            else:
+                line += "{\"v\":" + str(row[column]) + "}"
 
     # Write iSpindel values
     elif iSpindel:
         if row['spinSG'] is None:
-            jsonFile.write(",null")
+            line += ",null"
         else:
-            jsonFile.write(",{\"v\":" + str(row['spinSG']) + "}")
+            line += ",{\"v\":" + str(row['spinSG']) + "}"
 
-    # rewrite end of json file
-    jsonFile.write("]}]}")
+    line += "]}"
+    return line
+
+
+def readRows(jsonFileName):
+    """
+    Reads the complete rows from a chart JSON file, even when the file was
+    cut short by a crash
+
+    Params:
+    jsonFileName: Path of the chart JSON file
+
+    Returns:
+    List of row strings as made by formatRow()
+    """
+    rows = []
+    try:
+        jsonFile = open(jsonFileName, "r")
+    except IOError:
+        return rows
+    # The header is on the first line, then each row is on a line of its own
+    jsonFile.readline()
+    for line in jsonFile:
+        line = line.strip()
+        if line.endswith(','):
+            line = line[:-1]
+        try:
+            json.loads(line)
+        except ValueError:
+            if not line.endswith(']}'):
+                continue  # Partial row
+            line = line[:-2]  # Last row, followed by the end of the file
+            try:
+                json.loads(line)
+            except ValueError:
+                continue
+        rows.append(line)
     jsonFile.close()
+    return rows
+
 
+def rowTime(row):
+    """
+    Returns the datetime of a row string made by formatRow(), or None
+    """
+    match = re.search(r'Date\((\d+),(\d+),(\d+),(\d+),(\d+),(\d+)\)', row)
+    if match is None:
+        return None
+    y, M, d, h, m, s = [int(part) for part in match.groups()]
+    return datetime(y, M + 1, d, h, m, s)
 
-def newEmptyFile(jsonFileName, tiltColor = None, iSpindel = None):
+
+def compactScales(columns):
+    """
+    Returns the compact format scale factor of each column, None for text
+    columns
+    """
+    scales = []
+    for column in columns:
+        if column in ['BeerAnn', 'FridgeAnn']:
+            scales.append(None)
+        elif column in ['Time', 'State']:
+            scales.append(1)
+        elif column.endswith('SG'):
+            scales.append(SG_SCALE)
+        elif column.endswith('Batt'):
+            scales.append(1)
+        else:
+            scales.append(TEMP_SCALE)
+    return scales
+
+
+def chartFormat(jsonFileName):
+    """
+    Returns the layout of a chart JSON file, 'google' or 'compact'
+    """
+    try:
+        with brewpiCompress.openDataFile(jsonFileName) as jsonFile:
+            header = jsonFile.readline(4096)
+    except (IOError, OSError):
+        return 'google'
+    return 'compact' if header.startswith('{"format":"compact"') else 'google'
+
+
+def tiltColumns(tiltColor):
+    """
+    Returns the ids of the Tilt columns of a data file
+
+    Params:
+    tiltColor: Color of the Tilt being logged, which logs its gravity, or
+               a list of colors (the tiltColors setting), which logs the
+               gravity, temperature and battery of each
+
+    Returns:
+    List of column ids, e.g. ['RedSG'] or ['RedSG', 'RedTemp', 'RedBatt']
+    """
+    if not tiltColor:
+        return []
+    if isinstance(tiltColor, str):
+        return [tiltColor + 'SG']
+    columns = []
+    for color in tiltColor:
+        columns += [color + 'SG', color + 'Temp', color + 'Batt']
+    return columns
+
+
+def tiltColumnLabel(column):
+    """
+    Returns the chart label of a Tilt column, e.g. 'Red Tilt Gravity'
+    """
+    for suffix, label in (('SG', 'Gravity'), ('Temp', 'Temp.'), ('Batt', 'Battery Age')):
+        if column.endswith(suffix):
+            return '{0} Tilt {1}'.format(column[:-len(suffix)], label)
+    return column
+
+
+def columnIds(tiltColor = None, iSpindel = None):
+    """
+    Returns the list of column ids written by newEmptyFile()
+    """
+    columns = ['Time', 'BeerTemp', 'BeerSet', 'BeerAnn', 'FridgeTemp',
+               'FridgeSet', 'FridgeAnn', 'RoomTemp', 'State']
+    if tiltColor:
+        columns += tiltColumns(tiltColor)
+    elif iSpindel:
+        columns.append('spinSG')
+    return columns
+
+
+def newEmptyFile(jsonFileName, tiltColor = None, iSpindel = None, chartFormat = 'google'):
     # Munge together standard column headers
     standardCols = ('"cols":[' +
                 '{"type":"datetime","id":"Time","label":"Time"},' +
@@ -150,7 +333,8 @@ def newEmptyFile(jsonFileName, tiltColor = None, iSpindel = None):
 
     # Now get Tilt data if we are using it
     if tiltColor:
-        tiltCols = (',{"type":"number","id":"' + tiltColor + 'SG","label":"' + tiltColor + ' Tilt Gravity"}')
+        tiltCols = ''.join(',{"type":"number","id":"' + column + '","label":"' + tiltColumnLabel(column) + '"}'
+                           for column in tiltColumns(tiltColor))
         jsonCols = ('{' + standardCols + tiltCols + '],"rows":[]}')
 
     # Or get iSpindel data if we are using that
@@ -162,6 +346,27 @@ def newEmptyFile(jsonFileName, tiltColor = None, iSpindel = None):
     else:
         jsonCols = ('{' + standardCols + '],"rows":[]}')
 
+    # The compact format describes its scale factors ahead of the columns
+    if chartFormat == 'compact':
+        scales = compactScales(columnIds(tiltColor, iSpindel))
+        jsonCols = ('{"format":"compact","version":' + str(COMPACT_VERSION) +
+                    ',"scale":' + json.dumps(scales, separators=(',', ':')) +
+                    ',' + jsonCols[1:])
+
     jsonFile = open(jsonFileName, 'w')
     jsonFile.write(jsonCols)
     jsonFile.close()
+
+
+def loadFile(jsonFileName):
+    """
+    Reads and parses a chart JSON file, decompressing it if the day has
+    been closed and compressed
+
+    Params:
+    jsonFileName: Path of the uncompressed .json file
+
+    Returns:
+    dict with 'cols' and 'rows'
+    """
+    return json.loads(brewpiCompress.readDataFile(jsonFileName))
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+
+# Each beer directory holds a manifest.json describing its day files:
+#
+# {"version": 1, "files": {"Beer-20200101.json": {
+#     "start": 1577880000, "end": 1577966340, "rows": 720,
+#     "columns": ["Time", "BeerTemp", ..., "RedSG"], "kind": "tilt",
+#     "bytes": 81234, "compressed": "gzip",
+#     "min": {"BeerTemp": 19.8, ...}, "max": {"BeerTemp": 20.3, ...}}}}
+#
+# "start" and "end" are epoch seconds, "kind" is "tilt", "ispindel" or
+# null and "compressed" is null or the method used on the data tree copy
+# (the web tree copy stays plain).
+
+import os
+import threading
+import time
+import simplejson as json
+import brewpiChart
+import brewpiCompress
+import brewpiJson
+from BrewPiUtil import logError
+from BrewPiUtil import permissions
+
+MANIFEST_NAME = 'manifest.json'
+VERSION = 1
+
+# Longest time (seconds) row counts may stay unsaved while logging
+SAVE_INTERVAL = 300
+
+# Columns which are not summarized with min/max values
+UNSUMMARIZED = ['Time', 'BeerAnn', 'FridgeAnn', 'State']
+
+# One shared manifest per directory, so the logging code and the compactor
+# thread never overwrite each other's changes
+manifests = {}
+manifestsLock = threading.Lock()
+
+
+def getManifest(path, wwwPath=None):
+    """
+    Returns the shared manifest of a beer data directory
+
+    Params:
+    path: Beer data directory
+    wwwPath: Beer directory on the web server the manifest is copied to
+
+    Returns:
+    Manifest object
+    """
+    path = os.path.abspath(path)
+    with manifestsLock:
+        manifest = manifests.get(path)
+        if manifest is None:
+            manifest = Manifest(path, wwwPath)
+            manifests[path] = manifest
+        elif wwwPath:
+            manifest.wwwPath = wwwPath
+        return manifest
+
+
+def fileKind(columns):
+    """
+    Returns the kind of gravity data in a list of column ids
+    """
+    if 'spinSG' in columns:
+        return 'ispindel'
+    for column in columns:
+        if column.endswith('SG'):
+            return 'tilt'
+    return None
+
+
+def fileStats(jsonFileName):
+    """
+    Works out a manifest entry by reading a (possibly compressed) chart
+    JSON file
+
+    Params:
+    jsonFileName: Path of the uncompressed .json file
+
+    Returns:
+    dict manifest entry, or None if the file cannot be read
+    """
+    dataFile = brewpiCompress.findDataFile(jsonFileName)
+    if dataFile is None:
+        return None
+    try:
+        chart = brewpiJson.loadFile(jsonFileName)
+    except ValueError:
+        # Cut short by a crash, use the header and the rows which are complete
+        chart = {'cols': [], 'rows': []}
+        try:
+            with brewpiCompress.openDataFile(jsonFileName) as jsonFile:
+                chart = json.loads(jsonFile.readline().strip() + ']}')
+        except (ValueError, KeyError):
+            pass
+        chart['rows'] = [json.loads(row) for row in brewpiJson.readRows(jsonFileName)]
+    except (IOError, OSError):
+        return None
+    if brewpiChart.isCompact(chart):
+        chart = brewpiChart.compactToGoogle(chart)
+
+    columns = [col['id'] for col in chart.get('cols', [])]
+    entry = newEntry(columns)
+    for row in chart.get('rows', []):
+        cells = row.get('c', [])
+        if not cells or cells[0] is None:
+            continue
+        timestamp = brewpiJson.rowTime(cells[0]['v'])
+        values = {}
+        for column, cell in zip(columns[1:], cells[1:]):
+            values[column] = cell['v'] if cell is not None else None
+        addToEntry(entry, timestamp.timestamp() if timestamp else None, values)
+    entry['bytes'] = os.path.getsize(dataFile)
+    for method in brewpiCompress.COMPRESSORS:
+        if dataFile.endswith(brewpiCompress.COMPRESSORS[method][0]):
+            entry['compressed'] = method
+    return entry
+
+
+def newEntry(columns):
+    """
+    Returns an empty manifest entry for a file with the given columns
+    """
+    return {
+        'start': None,
+        'end': None,
+        'rows': 0,
+        'columns': list(columns),
+        'kind': fileKind(columns),
+        'bytes': 0,
+        'compressed': None,
+        'min': {},
+        'max': {},
+    }
+
+
+def addToEntry(entry, timestamp, row):
+    """
+    Updates a manifest entry with one row of data
+
+    Params:
+    entry: Manifest entry
+    timestamp: Epoch seconds of the row
+    row: dict of values keyed by column id
+    """
+    if timestamp is not None:
+        timestamp = int(timestamp)
+        if entry['start'] is None:
+            entry['start'] = timestamp
+        entry['end'] = timestamp
+    entry['rows'] += 1
+    for column in entry['columns']:
+        if column in UNSUMMARIZED:
+            continue
+        value = row.get(column)
+        if value is None:
+            continue
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if column not in entry['min'] or value < entry['min'][column]:
+            entry['min'][column] = value
+        if column not in entry['max'] or value > entry['max'][column]:
+            entry['max'][column] = value
+
+
+class Manifest():
+    """
+    Index of the day files of one beer, updated as files are created,
+    written to and compressed
+    """
+
+    def __init__(self, path, wwwPath=None):
+        self.path = path
+        self.wwwPath = wwwPath
+        self.fileName = os.path.join(path, MANIFEST_NAME)
+        self.lock = threading.RLock()
+        self.files = {}
+        self.dirty = False  # Changed since the last save
+        self.lastSave = 0.0
+        self.load()
+
+    def load(self):
+        """
+        Load the manifest from disk. Without one, build a basic one from a
+        single listing of the directory.
+        """
+        with self.lock:
+            try:
+                with open(self.fileName, 'r') as manifestFile:
+                    self.files = json.load(manifestFile).get('files', {})
+                return
+            except (IOError, OSError):
+                pass
+            except ValueError:
+                logError("Damaged manifest {0}, rebuilding it.".format(self.fileName))
+            self.files = {}
+            try:
+                names = os.listdir(self.path)
+            except OSError:
+                names = []
+            for name in names:
+                dataName = name
+                method = None
+                for candidate in brewpiCompress.COMPRESSORS:
+                    suffix = brewpiCompress.COMPRESSORS[candidate][0]
+                    if name.endswith(suffix):
+                        dataName = name[:-len(suffix)]
+                        method = candidate
+                if brewpiCompress.DAY_FILE.match(dataName) and dataName not in self.files:
+                    entry = newEntry([])
+                    entry['rows'] = None  # Unknown until the file is indexed
+                    entry['bytes'] = os.path.getsize(os.path.join(self.path, name))
+                    entry['compressed'] = method
+                    self.files[dataName] = entry
+
+    def save(self):
+        """
+        Write the manifest to disk (replacing the old one in a single step)
+        and copy it to the web server
+        """
+        # The logging, persistence and compactor threads all save, so the
+        # shared temp file and the replace must not overlap
+        with self.lock:
+            data = json.dumps({'version': VERSION, 'files': self.files}, sort_keys=True)
+            tempName = '{0}.tmp'.format(self.fileName)
+            try:
+                with open(tempName, 'w') as manifestFile:
+                    manifestFile.write(data)
+                os.replace(tempName, self.fileName)
+                permissions.newFile(self.fileName)
+                if self.wwwPath:
+                    permissions.copyFile(self.fileName, os.path.join(self.wwwPath, MANIFEST_NAME))
+                self.dirty = False
+                self.lastSave = time.time()
+            except (IOError, OSError) as e:
+                logError("Unable to write manifest {0}: {1}".format(self.fileName, e))
+
+    def saveIfDue(self, interval=SAVE_INTERVAL):
+        """
+        Save the manifest if it changed and the last save is more than
+        interval seconds ago. Day files being written to call this instead
+        of save() so each sample does not rewrite the manifest.
+        """
+        with self.lock:
+            if self.dirty and (time.time() - self.lastSave) >= interval:
+                self.save()
+
+    def nextFileName(self, baseName):
+        """
+        Returns the first free day file name
+
+        Params:
+        baseName: Name without suffix, e.g. 'Beer-20200101'
+
+        Returns:
+        'Beer-20200101.json', or 'Beer-20200101-N.json' if that is taken
+        """
+        with self.lock:
+            name = '{0}.json'.format(baseName)
+            i = 1
+            # Also check the disk, a lost or stale manifest must not lead to
+            # an existing day file, or its compressed copy, being replaced
+            while name in self.files or brewpiCompress.findDataFile(os.path.join(self.path, name)):
+                name = '{0}-{1}.json'.format(baseName, i)
+                i += 1
+            return name
+
+    def addFile(self, name, columns):
+        """
+        Record a newly created day file
+        """
+        with self.lock:
+            self.files[name] = newEntry(columns)
+
+    def addRow(self, name, timestamp, row):
+        """
+        Record a row written to a day file
+        """
+        with self.lock:
+            entry = self.files.get(name)
+            if entry is not None:
+                addToEntry(entry, timestamp, row)
+                self.dirty = True
+
+    def setBytes(self, name, size):
+        with self.lock:
+            if name in self.files:
+                self.files[name]['bytes'] = size
+                self.dirty = True
+
+    def setCompressed(self, name, method, size):
+        """
+        Record that a day file has been compressed
+        """
+        with self.lock:
+            if name in self.files:
+                self.files[name]['compressed'] = method
+                self.files[name]['bytes'] = size
+
+    def onCompressed(self, fileName, target, method):
+        """
+        Compactor callback, records the compressed file and saves the
+        manifest
+        """
+        self.setCompressed(os.path.basename(fileName), method, os.path.getsize(target))
+        self.save()
+
+    def update(self, name):
+        """
+        Re-read a day file and replace its entry
+        """
+        entry = fileStats(os.path.join(self.path, name))
+        if entry is not None:
+            with self.lock:
+                self.files[name] = entry
+
+    def entries(self):
+        """
+        Returns a list of (name, entry) sorted by start time
+        """
+        with self.lock:
+            return sorted(self.files.items(), key=lambda item: (item[1]['start'] or 0, item[0]))
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+# Readings are published once to a SinkHub, which hands them to every
+# output (chart files, database, network). Each sink has its own bounded
+# queue, thread, batching window and retries, so a slow or unreachable
+# output never holds up the others or the main loop.
+
+import queue
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+# A reading as handed from the main loop to the sinks. The row is a copy,
+# so the loop may keep changing its own dict.
+ReadingRecord = namedtuple('ReadingRecord', ['time', 'row', 'queued', 'beer'])
+
+# Work other than readings, kept in the same queue so it happens in order
+Control = namedtuple('Control', ['action', 'args'])
+
+# Longest wait between two attempts at writing a batch
+MAX_RETRY_DELAY = 60.0
+
+
+def newRecord(row, now=None, beer=None):
+    """
+    Returns a ReadingRecord for a row of values
+
+    Params:
+    row: dict of values, keyed by column id
+    now: datetime of the reading, defaults to now
+    beer: Name of the beer being logged
+
+    Returns:
+    ReadingRecord
+    """
+    if now is None:
+        now = datetime.now()
+    return ReadingRecord(now, dict(row), time.time(), beer)
+
+
+class Sink():
+    """
+    An output readings are published to, written from its own thread
+
+    Readings and control items go through one bounded queue and are handled
+    in the order they were put. Readings are gathered into batches of up to
+    batchSize, waiting up to batchWindow seconds for a batch to fill. A batch
+    which fails is tried again after retryDelay, doubling each time, up to
+    retries times. Errors are collected for the main loop to report.
+
+    Subclasses implement write() and may implement connect(), disconnect(),
+    poll(), handle() and onFailed().
+    """
+
+    name = 'sink'
+
+    def __init__(self, maxQueue=1000, batchSize=50, batchWindow=0.0, retries=0, retryDelay=1.0):
+        """
+        :param maxQueue: Most items waiting before new readings are dropped
+        :param batchSize: Most readings written in one go
+        :param batchWindow: Seconds to wait for more readings to fill a batch
+        :param retries: Times a failed batch is tried again
+        :param retryDelay: Seconds before the first retry
+        """
+        self.queue = queue.Queue(maxQueue)
+        self.errors = queue.Queue()
+        self.batchSize = max(1, batchSize)
+        self.batchWindow = batchWindow
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.thread = None
+        self.run = False
+        self.wake = threading.Event()  # Cuts retry waits short when stopping
+
+        # Metrics
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.maxDepth = 0
+        self.lastLatency = 0.0  # Seconds from queueing to written
+        self.maxLatency = 0.0
+        self.totalLatency = 0.0
+        self.lastError = None
+
+    def start(self):
+        self.run = True
+        self.wake.clear()
+        if not self.thread:
+            self.thread = threading.Thread(target=self.__sinkThread)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """
+        Write everything still queued and stop the thread. Failed batches
+        are not retried once stopping.
+        """
+        if self.thread:
+            self.run = False
+            self.wake.set()
+            self.thread.join()
+            self.thread = None
+
+    def put(self, record):
+        """
+        Queue a reading to be written
+
+        :param record: ReadingRecord
+        :return: True if queued, False if the queue was full
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.errors.put("{0} queue full, reading dropped.".format(self.name.capitalize()))
+            return False
+        self.queued += 1
+        self.maxDepth = max(self.maxDepth, self.queue.qsize())
+        return True
+
+    def control(self, action, *args, wait=True):
+        """
+        Queue work for handle(), in order with the readings
+
+        :param action: Name of the work
+        :param args: Its arguments
+        :param wait: Wait for room if the queue is full, for work which must
+                     not be lost. Otherwise it is dropped.
+        :return: True if queued, False if the queue was full
+        """
+        try:
+            self.queue.put(Control(action, args), block=wait)
+        except queue.Full:
+            self.dropped += 1
+            self.errors.put("{0} queue full, {1} dropped.".format(self.name.capitalize(), action))
+            return False
+        return True
+
+    def checkErrors(self):
+        """
+        Returns the errors raised since the last call
+        """
+        errors = []
+        while True:
+            try:
+                errors.append(self.errors.get_nowait())
+            except queue.Empty:
+                return errors
+
+    def stats(self):
+        """
+        Returns the queue and write metrics
+        """
+        return {
+            'queueDepth': self.queue.qsize(),
+            'maxQueueDepth': self.maxDepth,
+            'queued': self.queued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'retried': self.retried,
+            'batches': self.batches,
+            'lastLatency': round(self.lastLatency, 4),
+            'maxLatency': round(self.maxLatency, 4),
+            'avgLatency': round(self.totalLatency / self.written, 4) if self.written else 0.0,
+            'lastError': self.lastError,
+        }
+
+    def connect(self):
+        """
+        Called from the sink thread before anything is written
+        """
+        pass
+
+    def disconnect(self):
+        """
+        Called from the sink thread once it is done
+        """
+        pass
+
+    def write(self, batch):
+        """
+        Write a batch of readings, raising an exception if it failed
+
+        :param batch: List of ReadingRecord
+        """
+        raise NotImplementedError
+
+    def handle(self, control):
+        """
+        Carry out a control item
+
+        :param control: Control
+        """
+        pass
+
+    def poll(self):
+        """
+        Called when the queue has been empty for a while
+        """
+        pass
+
+    def onFailed(self, batch):
+        """
+        Called with a batch which could not be written after all retries
+        """
+        pass
+
+    def __sinkThread(self):
+        if not self.__call(self.connect):
+            self.run = False
+            return  # Readings queue up and are dropped once it is full
+        while self.run or not self.queue.empty():
+            try:
+                item = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                self.__call(self.poll)
+                continue
+            batch, item = self.__gather(item)
+            if batch:
+                self.__writeBatch(batch)
+            if item is not None:
+                self.__call(self.handle, item)
+        self.__call(self.disconnect)
+
+    def __gather(self, item):
+        # Gather the readings behind this one into a batch, until it is full,
+        # the window has passed or a control item comes up
+        batch = []
+        deadline = time.time() + self.batchWindow
+        while isinstance(item, ReadingRecord):
+            batch.append(item)
+            if len(batch) >= self.batchSize:
+                return batch, None
+            try:
+                wait = deadline - time.time()
+                if wait > 0 and self.run:
+                    item = self.queue.get(timeout=wait)
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                return batch, None
+        return batch, item
+
+    def __writeBatch(self, batch):
+        attempt = 0
+        while True:
+            try:
+                self.write(batch)
+                break
+            except Exception as e:
+                self.lastError = str(e)
+                if attempt >= self.retries or not self.run:
+                    self.failed += len(batch)
+                    self.errors.put("Unable to write {0} reading(s) to {1}: {2}".format(
+                        len(batch), self.name, e))
+                    self.__call(self.onFailed, batch)
+                    return
+            # Back off before trying again, unless told to stop
+            self.retried += 1
+            self.wake.wait(min(self.retryDelay * 2 ** attempt, MAX_RETRY_DELAY))
+            attempt += 1
+        done = time.time()
+        self.batches += 1
+        for record in batch:
+            latency = done - record.queued
+            self.written += 1
+            self.lastLatency = latency
+            self.maxLatency = max(self.maxLatency, latency)
+            self.totalLatency += latency
+
+    def __call(self, function, *args):
+        try:
+            function(*args)
+        except Exception as e:
+            self.lastError = str(e)
+            self.errors.put("Error in {0} thread: {1}".format(self.name, e))
+            return False
+        return True
+
+
+class PersistenceStage(Sink):
+    """
+    Writes readings to the chart and CSV files so the main loop never waits
+    on the SD card
+    """
+
+    name = 'logging'
+
+    def __init__(self, changeSetting=None, maxQueue=1000, maxBatch=50):
+        """
+        :param changeSetting: Function called as changeSetting(name, value)
+                              to update a web server setting
+        :param maxQueue: Most items waiting before new readings are dropped
+        :param maxBatch: Most readings written in one go
+        """
+        Sink.__init__(self, maxQueue, maxBatch)
+        self.changeSetting = changeSetting
+        self.writer = None
+        self.settings = {}  # Last value written for each www setting
+        self.queuedSettings = {}  # Last value queued, kept by the main thread
+
+    def stop(self):
+        """
+        Write everything still queued, close the writer and stop the thread
+        """
+        if self.thread:
+            self.setWriter(None)
+        Sink.stop(self)
+
+    def setWriter(self, writer, onClosed=None):
+        """
+        Switch to a new writer once everything queued so far is written. The
+        old writer is closed from the persistence thread.
+
+        :param writer: DataLog to write to, or None to stop writing
+        :param onClosed: Called without arguments after the old writer has
+                         been closed, e.g. to compress its files
+        """
+        self.control('writer', writer, onClosed)
+
+    def flush(self):
+        """
+        Ask the writer to write out anything it has buffered
+        """
+        self.control('flush')
+
+    def close(self):
+        """
+        Ask the writer to write out and close its files. It stays in use and
+        opens them again with the next reading.
+        """
+        self.control('close')
+
+    def setting(self, name, value):
+        """
+        Queue a change to a web server setting. Unchanged values are not
+        queued or written again. A change is dropped rather than waited on
+        when the queue is full, the next call sends it again.
+        """
+        if name in self.queuedSettings and self.queuedSettings[name] == value:
+            return
+        if self.control('setting', name, value, wait=False):
+            self.queuedSettings[name] = value
+
+    def stats(self):
+        """
+        Returns the queue and write metrics, plus those of the writer
+        """
+        stats = Sink.stats(self)
+        writer = self.writer
+        if writer is not None:
+            stats['writer'] = writer.stats()
+        return stats
+
+    def write(self, batch):
+        if self.writer is None:
+            return  # Logging stopped while the readings were queued
+        self.writer.addRows([(record.row, record.time) for record in batch])
+
+    def poll(self):
+        if self.writer is not None:
+            self.writer.poll()
+
+    def handle(self, control):
+        if control.action == 'writer':
+            writer, onClosed = control.args
+            if self.writer is not None:
+                self.writer.close()
+            self.writer = writer
+            if onClosed is not None:
+                onClosed()
+        elif control.action == 'flush':
+            if self.writer is not None:
+                self.writer.flush()
+        elif control.action == 'close':
+            if self.writer is not None:
+                self.writer.close()
+        elif control.action == 'setting':
+            name, value = control.args
+            if self.changeSetting is None:
+                return
+            if name not in self.settings or self.settings[name] != value:
+                self.changeSetting(name, value)
+                self.settings[name] = value
+
+
+class SinkHub():
+    """
+    Publishes each reading once to every sink added
+    """
+
+    def __init__(self):
+        self.sinks = []
+
+    def add(self, sink):
+        """
+        Add a started sink
+        """
+        self.sinks.append(sink)
+
+    def publish(self, row, now=None, beer=None):
+        """
+        Queue a reading on every sink, without waiting on any of them
+
+        :param row: dict of values, keyed by column id
+        :param now: datetime of the reading, defaults to now
+        :param beer: Name of the beer being logged
+        :return: Number of sinks which queued the reading
+        """
+        record = newRecord(row, now, beer)
+        return sum(1 for sink in self.sinks if sink.put(record))
+
+    def stop(self):
+        """
+        Stop every sink, each writing what it still has queued
+        """
+        for sink in self.sinks:
+            sink.stop()
+
+    def checkErrors(self):
+        """
+        Returns the errors raised by any sink since the last call
+        """
+        errors = []
+        for sink in self.sinks:
+            errors.extend(sink.checkErrors())
+        return errors
+
+    def stats(self):
+        """
+        Returns the metrics of each sink, keyed by name
+        """
+        return dict((sink.name, sink.stats()) for sink in self.sinks)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018, 2019 Lee C. Bussy (@LBussy)
+
+# This file is part of LBussy's BrewPi Script Remix (BrewPi-Script-RMX).
+#
+# BrewPi Script RMX is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# BrewPi Script RMX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi Script RMX. If not, see <https://www.gnu.org/licenses/>.
+# Network outputs for readings, added to the SinkHub of brewpi.py when
+# configured.
+
+import os
+import socket
+import sys
+import time
+from urllib.parse import urlparse
+import requests
+import simplejson as json
+from brewpiPipeline import Sink, MAX_RETRY_DELAY
+from BrewPiUtil import permissions
+
+# Largest UDP datagram sent, to stay below the usual MTU
+MAX_DATAGRAM = 1400
+
+# Spooled lines sent again in one go once the endpoint is back
+SPOOL_CHUNK = 5000
+
+
+def escapeKey(value):
+    """
+    Escapes a measurement, tag key, tag value or field key for line protocol
+    """
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def lineProtocol(measurement, tags, fields, timestamp):
+    """
+    Formats one line of InfluxDB line protocol
+
+    Params:
+    measurement: Name of the measurement
+    tags: dict of tag values, None values are left out
+    fields: dict of numeric field values, None values are left out
+    timestamp: Epoch time in seconds
+
+    Returns:
+    The line without a newline, or None if there are no fields
+    """
+    fieldSet = []
+    for key in sorted(fields):
+        value = fields[key]
+        if value is None:
+            continue
+        fieldSet.append('{0}={1}'.format(escapeKey(key), repr(float(value))))
+    if not fieldSet:
+        return None
+    line = escapeKey(measurement)
+    for key in sorted(tags):
+        if tags[key] is not None and tags[key] != '':
+            line += ',{0}={1}'.format(escapeKey(key), escapeKey(tags[key]))
+    return '{0} {1} {2}'.format(line, ','.join(fieldSet), int(round(timestamp * 1e9)))
+
+
+def readingLine(record, measurement='brewpi'):
+    """
+    Formats the numbers of a ReadingRecord as a line, tagged with the beer.
+    Annotations and other text are left out.
+    """
+    fields = {}
+    for key in record.row:
+        value = record.row[key]
+        if value is None or isinstance(value, (bool, str)):
+            continue
+        try:
+            fields[key] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return lineProtocol(measurement, {'beer': record.beer}, fields, record.time.timestamp())
+
+
+class HttpPostSink(Sink):
+    """
+    Posts batches of readings as JSON to a web endpoint:
+
+    {"readings": [{"time": 1580511909.0, "beer": "My Beer", "BeerTemp": 19.94, ...}, ...]}
+    """
+
+    name = 'http'
+
+    def __init__(self, url, timeout=10, batchWindow=30.0, maxQueue=1000, batchSize=100):
+        """
+        :param url: Address to post to
+        :param timeout: Seconds to wait for the endpoint to answer
+        :param batchWindow: Seconds to gather readings into one post
+        :param maxQueue: Most readings waiting before new ones are dropped
+        :param batchSize: Most readings in one post
+        """
+        Sink.__init__(self, maxQueue, batchSize, batchWindow, retries=3, retryDelay=5.0)
+        self.url = url
+        self.timeout = timeout
+        self.session = None
+
+    def connect(self):
+        self.session = requests.Session()
+        self.session.headers['Content-Type'] = 'application/json'
+
+    def disconnect(self):
+        self.session.close()
+        self.session = None
+
+    def write(self, batch):
+        readings = []
+        for record in batch:
+            reading = {'time': record.time.timestamp(), 'beer': record.beer}
+            reading.update(record.row)
+            readings.append(reading)
+        response = self.session.post(self.url, data=json.dumps({'readings': readings}),
+                                     timeout=self.timeout)
+        response.raise_for_status()
+
+
+class LineProtocolSink(Sink):
+    """
+    Exports readings as InfluxDB line protocol to an HTTP endpoint (e.g.
+    http://influx:8086/write?db=brewpi or a Telegraf/VictoriaMetrics
+    listener) or over UDP (udp://host:8089).
+
+    Batches which cannot be sent after the retries are appended to a spool
+    file, and sent again once the endpoint answers.
+    """
+
+    name = 'export'
+
+    def __init__(self, url, measurement='brewpi', spoolFile=None, maxSpool=10485760,
+                 timeout=10, batchWindow=10.0, maxQueue=5000, batchSize=500):
+        """
+        :param url: http(s):// address to post to or udp://host:port
+        :param measurement: Measurement name of the lines
+        :param spoolFile: File keeping lines while the endpoint is down,
+                          None to drop them
+        :param maxSpool: Most bytes kept in the spool file
+        :param timeout: Seconds to wait for the endpoint to answer
+        :param batchWindow: Seconds to gather readings into one payload
+        :param maxQueue: Most readings waiting before new ones are dropped
+        :param batchSize: Most readings in one payload
+        """
+        Sink.__init__(self, maxQueue, batchSize, batchWindow, retries=2, retryDelay=2.0)
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https', 'udp'):
+            raise ValueError("Unknown export address '{0}'".format(url))
+        self.url = url
+        self.udp = parsed.scheme == 'udp'
+        self.address = (parsed.hostname, parsed.port) if self.udp else None
+        self.measurement = measurement
+        self.spoolFile = spoolFile
+        self.maxSpool = maxSpool
+        self.timeout = timeout
+        self.session = None
+        self.sock = None
+        self.downDelay = 0.0  # Wait before trying a down endpoint again
+        self.nextTry = 0.0
+
+        # Metrics
+        self.lines = 0
+        self.bytesSent = 0
+        self.spooled = 0
+        self.unspooled = 0
+        self.spoolDropped = 0
+
+    def connect(self):
+        if self.udp:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.session = requests.Session()
+            self.session.headers['Content-Type'] = 'text/plain; charset=utf-8'
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def stats(self):
+        stats = Sink.stats(self)
+        stats.update({
+            'lines': self.lines,
+            'bytesSent': self.bytesSent,
+            'spooled': self.spooled,
+            'unspooled': self.unspooled,
+            'spoolDropped': self.spoolDropped,
+            'spoolBytes': self.__spoolSize(),
+        })
+        return stats
+
+    def write(self, batch):
+        lines = [line for line in (readingLine(record, self.measurement) for record in batch) if line]
+        if self.__spoolSize() and self.run:
+            if time.time() < self.nextTry:
+                self.__spool(lines)  # Keep the order until the endpoint is back
+                return
+            self.__unspool()
+        self.send(lines)
+
+    def poll(self):
+        if self.__spoolSize() and time.time() >= self.nextTry:
+            try:
+                self.__unspool()
+            except Exception as e:
+                self.lastError = str(e)
+                self.__backOff()
+
+    def onFailed(self, batch):
+        self.__backOff()
+        self.__spool([line for line in (readingLine(record, self.measurement) for record in batch) if line])
+
+    def send(self, lines):
+        """
+        Send lines to the endpoint, raising an exception if it failed
+        """
+        if not lines:
+            return
+        if self.udp:
+            datagram = b''
+            for line in lines:
+                data = line.encode('utf-8') + b'\n'
+                if datagram and len(datagram) + len(data) > MAX_DATAGRAM:
+                    self.sock.sendto(datagram, self.address)
+                    datagram = b''
+                datagram += data
+            self.sock.sendto(datagram, self.address)
+            size = sum(len(line) + 1 for line in lines)
+        else:
+            payload = '\n'.join(lines).encode('utf-8') + b'\n'
+            response = self.session.post(self.url, data=payload, timeout=self.timeout)
+            response.raise_for_status()
+            size = len(payload)
+        self.lines += len(lines)
+        self.bytesSent += size
+        self.downDelay = 0.0
+
+    def __backOff(self):
+        # Wait longer each time the endpoint is still down
+        self.downDelay = min(max(self.downDelay * 2, self.retryDelay), MAX_RETRY_DELAY)
+        self.nextTry = time.time() + self.downDelay
+
+    def __spoolSize(self):
+        if self.spoolFile is None:
+            return 0
+        try:
+            return os.path.getsize(self.spoolFile)
+        except OSError:
+            return 0
+
+    def __spool(self, lines):
+        if self.spoolFile is None or not lines:
+            self.spoolDropped += len(lines)
+            return
+        data = ''.join(line + '\n' for line in lines)
+        if self.__spoolSize() + len(data) > self.maxSpool:
+            self.spoolDropped += len(lines)
+            self.errors.put("Export spool {0} full, {1} line(s) dropped.".format(self.spoolFile, len(lines)))
+            return
+        isNew = not os.path.exists(self.spoolFile)
+        with open(self.spoolFile, 'a') as spoolFile:
+            spoolFile.write(data)
+        if isNew:
+            permissions.newFile(self.spoolFile)
+        self.spooled += len(lines)
+
+    def __unspool(self):
+        # Send the spool oldest first, keeping whatever was not sent
+        with open(self.spoolFile, 'r') as spoolFile:
+            lines = spoolFile.read().splitlines()
+        sent = 0
+        try:
+            while sent < len(lines):
+                chunk = lines[sent:sent + SPOOL_CHUNK]
+                self.send(chunk)
+                sent += len(chunk)
+        finally:
+            self.unspooled += sent
+            if sent >= len(lines):
+                os.remove(self.spoolFile)
+            elif sent:
+                tempName = '{0}.tmp'.format(self.spoolFile)
+                with open(tempName, 'w') as spoolFile:
+                    spoolFile.write(''.join(line + '\n' for line in lines[sent:]))
+                os.replace(tempName, self.spoolFile)
+
+
+def standIn():
+    """
+    Starts a local HTTP server which accepts line protocol posts, for
+    testing the exporter without a time-series database
+
+    Returns:
+    Tuple of (server, list of the bodies received)
+    """
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(self.rfile.read(int(self.headers['Content-Length'])))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, received
+
+
+def main():
+    # Measure the readings per second the exporter gets through to a local
+    # stand-in HTTP server
+    import argparse
+    from brewpiPipeline import newRecord
+    parser = argparse.ArgumentParser(
+        description="Benchmark the line protocol exporter against a local HTTP server")
+    parser.add_argument("-n", "--readings", type=int, default=20000,
+                        help="number of readings to export")
+    parser.add_argument("-b", "--batch", type=int, default=500,
+                        help="readings per post")
+    args = parser.parse_args()
+
+    server, received = standIn()
+    sink = LineProtocolSink('http://127.0.0.1:{0}/write'.format(server.server_port),
+                            maxQueue=args.readings, batchSize=args.batch, batchWindow=0)
+    row = {'BeerTemp': 19.94, 'BeerSet': 20.0, 'BeerAnn': None, 'FridgeTemp': 18.51,
+           'FridgeSet': 19.6, 'FridgeAnn': 'Cooling', 'RoomTemp': 21.3, 'State': 4,
+           'RedSG': 1.0502, 'RedTemp': 19.8, 'RedBatt': 3, 'bbbpm': 12.5}
+    start = time.perf_counter()
+    sink.start()
+    for _ in range(args.readings):
+        sink.put(newRecord(row, beer='Benchmark'))
+    sink.stop()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    stats = sink.stats()
+    print("Exported {0} readings in {1} posts, {2:.1f}s: {3:.0f} readings/s, {4:.2f} MB/s".format(
+        stats['lines'], len(received), elapsed, stats['lines'] / elapsed,
+        stats['bytesSent'] / elapsed / 1048576))
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
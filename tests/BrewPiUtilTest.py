@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 import BrewPiUtil as util
 import simplejson
@@ -21,3 +24,101 @@ class BrewPiUtilsTestCase(unittest.TestCase):
         # UnicodeDecodeError: 'utf8' codec can't decode byte 0xb0 in position 2: invalid start byte
         s = util.asciiToUnicode(s)
         simplejson.loads(s)
+
+
+class ConfigStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.defaultFile = os.path.join(self.path, 'defaults.cfg')
+        self.configFile = os.path.join(self.path, 'config.cfg')
+        with open(self.defaultFile, 'w') as cfg:
+            cfg.write("toolPath = /tools\nscriptPath = /home/brewpi\nwwwPath = /var/www/html\n"
+                      "beerName = Default\ninterval = 120.0\n")
+        with open(self.configFile, 'w') as cfg:
+            cfg.write("beerName = Mine\n")
+        self.store = util.ConfigStore(self.configFile, self.defaultFile)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_merged(self):
+        config = self.store.get()
+        self.assertEqual(config['beerName'], 'Mine')
+        self.assertEqual(config['interval'], '120.0')
+        self.assertEqual(config['scriptPath'], '/home/brewpi/')
+        # Callers get their own copy
+        config['beerName'] = 'Changed'
+        self.assertEqual(self.store.get()['beerName'], 'Mine')
+
+    def test_transactionWritesOnce(self):
+        with self.store.transaction():
+            self.store.set('beerName', 'New')
+            self.store.set('dataLogging', 'stopped')
+            self.assertEqual(self.store.get()['beerName'], 'New')
+            with open(self.configFile) as cfg:
+                self.assertNotIn('New', cfg.read())
+        with open(self.configFile) as cfg:
+            text = cfg.read()
+        self.assertIn('beerName = New', text)
+        self.assertIn('dataLogging = stopped', text)
+        self.assertNotIn('interval', text)  # Defaults stay in defaults.cfg
+        self.assertFalse(os.path.exists(self.configFile + '.tmp'))
+
+    def test_reloadsChangedFile(self):
+        self.store.get()
+        self.assertFalse(self.store.changed())
+        with open(self.configFile, 'a') as cfg:
+            cfg.write("logJson = True\n")
+        self.assertTrue(self.store.changed())
+        self.assertEqual(self.store.get()['logJson'], 'True')
+
+    def test_keepsLastGoodOnParseError(self):
+        self.store.get()
+        with open(self.configFile, 'a') as cfg:
+            cfg.write("[unclosed\n")
+        self.assertEqual(self.store.get()['beerName'], 'Mine')
+        self.assertTrue(self.store.parseError)
+        with open(self.configFile, 'w') as cfg:
+            cfg.write("beerName = Fixed\n")
+        self.assertEqual(self.store.get()['beerName'], 'Fixed')
+        self.assertIsNone(self.store.parseError)
+
+
+class WwwSettingsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        with open(os.path.join(self.path, 'defaultSettings.json'), 'w') as jsonFile:
+            jsonFile.write('{"tempFormat": "C", "isHighResTilt": false}')
+        self.settings = util.WwwSettings(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self):
+        with open(os.path.join(self.path, 'userSettings.json')) as jsonFile:
+            return simplejson.load(jsonFile)
+
+    def test_defaults(self):
+        self.assertEqual(self.settings.get('tempFormat'), 'C')
+        self.assertIsNone(self.settings.get('beerName'))
+
+    def test_writesOnlyChanges(self):
+        self.settings.set('isHighResTilt', True)
+        self.settings.set('beerName', 'Test')
+        self.settings.flush()
+        self.assertEqual(self.read(), {'isHighResTilt': True, 'beerName': 'Test'})
+        for _ in range(100):
+            self.settings.set('isHighResTilt', True)
+            self.settings.flush()
+        self.assertEqual(self.settings.writes, 1)
+
+    def test_keepsChangesFromWebServer(self):
+        self.settings.set('beerName', 'Test')
+        self.settings.flush()
+        with open(os.path.join(self.path, 'userSettings.json'), 'w') as jsonFile:
+            jsonFile.write('{"beerName": "Test", "profileName": "Web"}')
+        self.assertEqual(self.settings.get('profileName'), 'Web')
+        self.settings.set('tempFormat', 'F')
+        self.settings.flush()
+        self.assertEqual(self.read(), {'beerName': 'Test', 'profileName': 'Web', 'tempFormat': 'F'})
+
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..") # append parent directory to be able to import files
+import unittest
+import brewpiAnalytics
+
+
+class AnalyticsTestCase(unittest.TestCase):
+    def test_windowOfLine(self):
+        window = brewpiAnalytics.Window(3600)
+        for t in range(0, 7200, 60):
+            window.add(1.6e9 + t, 1.050 - 0.002 * t / 3600.0)
+        # Only the last hour is kept
+        self.assertEqual(window.n, 61)
+        self.assertAlmostEqual(window.slope() * 3600, -0.002)
+        self.assertAlmostEqual(window.mean(), 1.050 - 0.002 * 5340 / 3600.0, places=9)
+        self.assertAlmostEqual(window.variance(), (0.002 / 60) ** 2 * 61 * 62 / 12, places=12)
+
+    def test_ewmaHalfLife(self):
+        ewma = brewpiAnalytics.Ewma(600)
+        ewma.add(0, 0.0)
+        self.assertAlmostEqual(ewma.add(600, 10.0), 5.0)
+
+    def test_gravity(self):
+        analytics = brewpiAnalytics.Analytics(windows=[3600, 86400], fg=1.010)
+        for t in range(0, 86400, 300):
+            analytics.add({'BeerTemp': 20.0, 'RedSG': 1.050 - 0.010 * t / 86400.0, 'BeerAnn': None}, t)
+        gravity = analytics.results()['gravity']
+        self.assertEqual(gravity['og'], 1.05)
+        self.assertAlmostEqual(gravity['sg'], 1.040, places=3)
+        self.assertAlmostEqual(gravity['attenuation'], brewpiAnalytics.attenuation(1.05, gravity['sg']), places=0)
+        self.assertAlmostEqual(gravity['abv'], 1.3, delta=0.1)
+        self.assertFalse(gravity['stable'])
+        self.assertAlmostEqual(gravity['hoursLeft'], 72, delta=1)
+        self.assertIs(analytics.results(), analytics.results())
+        analytics.reset()
+        self.assertNotIn('gravity', analytics.results())
+
+    def test_gravityFollowsOneColumn(self):
+        analytics = brewpiAnalytics.Analytics(windows=[3600], sgColumn='RedSG')
+        analytics.add({'RedSG': 1.050, 'BlackSG': 1.020}, 0)
+        analytics.add({'RedSG': None, 'BlackSG': 1.020}, 300)  # Red out of range
+        self.assertEqual(analytics.results()['gravity']['og'], 1.05)
+        self.assertAlmostEqual(analytics.results()['gravity']['sg'], 1.050)
+
+
+if __name__ == '__main__':
+    unittest.main()
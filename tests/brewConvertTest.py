@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..") # append parent directory to be able to import files
+import unittest
+import math
+import numpy as np
+import BrewConvert
+
+
+class BrewConvertTestCase(unittest.TestCase):
+    def test_scalar(self):
+        self.assertAlmostEqual(BrewConvert.convert(1.040, 'sg', 'plato'), 9.9935, places=4)
+        self.assertAlmostEqual(BrewConvert.convert(10, 'brix', 'sg'), 1.0400, places=4)
+        self.assertEqual(BrewConvert.convert(20, 'C', 'F'), 68)
+        self.assertEqual(BrewConvert.convert(68, 'f', 'c'), 20)
+        self.assertEqual(BrewConvert.convert(1, 'sg', 'c'), 0)
+
+    def test_identity(self):
+        for unit in BrewConvert.GRAVITY_UNITS + BrewConvert.TEMPERATURE_UNITS:
+            self.assertEqual(BrewConvert.BrewConvert().convert(20.5, unit, unit), 20.5)
+
+    def test_arrayMatchesScalar(self):
+        values = [1.000, 1.040, 1.112, float('nan')]
+        for original, target in BrewConvert.CONVERSIONS:
+            result = BrewConvert.convertArray(values, original, target)
+            self.assertEqual(result.dtype, np.float64)
+            for value, converted in zip(values, result):
+                if math.isnan(value):
+                    self.assertTrue(np.isnan(converted))
+                else:
+                    self.assertAlmostEqual(converted, BrewConvert.convert(value, original, target))
+        self.assertIsNone(BrewConvert.convertArray(values, 'sg', 'f'))
+
+
+if __name__ == '__main__':
+    unittest.main()
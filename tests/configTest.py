@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..") # append parent directory to be able to import files
+import unittest
+from decimal import Decimal
+from configobj import ConfigObj
+import brewpiConfig
+
+
+class ConfigTestCase(unittest.TestCase):
+    def setUp(self):
+        self.defaults = ConfigObj(os.path.dirname(os.path.abspath(__file__)) + '/../settings/defaults.cfg')
+
+    def test_defaults(self):
+        settings, errors = brewpiConfig.parse(self.defaults)
+        self.assertEqual(errors, [])
+        self.assertEqual(settings.interval, Decimal('120.0'))
+        self.assertEqual(settings.clampTempLower, Decimal('-5.0'))
+        self.assertIs(settings.logJson, False)
+        self.assertIsNone(settings.altport)
+        self.assertEqual(settings.wwwPath, '/var/www/html/')
+        self.assertEqual(settings.historyHours, 24.0)
+
+    def test_types(self):
+        config = ConfigObj(self.defaults)
+        config.update({'useInetSocket': 'True', 'socketPort': '6333', 'tiltColor': 'Red',
+                       'analyticsWindows': ['2', '12'], 'finalGravity': '1.012',
+                       'tiltColors': ['red', ' Black', 'Red']})
+        settings, errors = brewpiConfig.parse(config)
+        self.assertEqual(errors, [])
+        self.assertIs(settings.useInetSocket, True)
+        self.assertEqual(settings.socketPort, 6333)
+        self.assertEqual(settings.tiltColor, 'Red')
+        self.assertEqual(settings.analyticsWindows, [2.0, 12.0])
+        self.assertEqual(settings.tiltColors, ['Red', 'Black'])
+        self.assertEqual(settings.finalGravity, 1.012)
+
+    def test_invalidFallsBackToDefaults(self):
+        config = ConfigObj(self.defaults)
+        config.update({'interval': 'often', 'clampSGLower': '1.2', 'chartFormat': 'xml',
+                       'tiltColors': 'Red, Mauve'})
+        settings, errors = brewpiConfig.parse(config, self.defaults)
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(settings.tiltColors, [])
+        self.assertEqual(settings.interval, Decimal('120.0'))
+        self.assertEqual(settings.chartFormat, 'google')
+        self.assertIn('clampSGLower', errors[-1])
+
+    def test_choices(self):
+        config = ConfigObj(self.defaults)
+        config.update({'compressData': 'zip', 'logDurability': 'fsync'})
+        settings, errors = brewpiConfig.parse(config, self.defaults)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(settings.compressData, 'none')
+        self.assertEqual(settings.logDurability, 'fsync')
+
+    def test_logJson(self):
+        # Full, terse or, when not set at all, no JSON
+        for value, expected in (('true', True), ('False', False), ('', None)):
+            config = ConfigObj(self.defaults)
+            config['logJson'] = value
+            self.assertIs(brewpiConfig.parse(config)[0].logJson, expected)
+        del config['logJson']
+        self.assertIsNone(brewpiConfig.parse(config)[0].logJson)
+
+    def test_changes(self):
+        old, errors = brewpiConfig.parse(self.defaults)
+        config = ConfigObj(self.defaults)
+        config.update({'logJson': 'True', 'tiltColor': 'Blue', 'interval': '120'})
+        new, errors = brewpiConfig.parse(config)
+        # 120 equals 120.0, so only two settings changed
+        self.assertEqual(brewpiConfig.changes(old, new), ['logJson', 'tiltColor'])
+
+
+if __name__ == '__main__':
+    unittest.main()
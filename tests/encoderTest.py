@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..") # append parent directory to be able to import files
+import unittest
+import simplejson
+from datetime import datetime
+from decimal import Decimal
+import brewpiChart
+import brewpiDataLog
+import brewpiEncoder
+import brewpiJson
+
+
+class EncoderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2020, 1, 31, 23, 5, 9)
+        self.rows = [
+            {'BeerTemp': 19.94, 'BeerSet': 20.0, 'BeerAnn': None, 'FridgeTemp': 18,
+             'FridgeSet': None, 'FridgeAnn': 'Cooling', 'RoomTemp': None, 'State': 4,
+             'RedSG': Decimal('1.0500'), 'RedTemp': 68.2, 'RedBatt': 3, 'BlackSG': 1.002,
+             'BlackTemp': None, 'BlackBatt': None, 'spinSG': 1.012},
+            {'BeerTemp': None, 'BeerSet': None, 'BeerAnn': 'Dry hop', 'FridgeTemp': None,
+             'FridgeSet': None, 'FridgeAnn': None, 'RoomTemp': 21.5, 'State': None,
+             'RedSG': None, 'spinSG': None},
+        ]
+
+    def test_jsonMatchesFormatRow(self):
+        for tiltColor, iSpindel in ((None, None), ('Red', None), (['Red', 'Black'], None), (None, 'Spindel')):
+            encoder = brewpiEncoder.getEncoder(tiltColor, iSpindel)
+            for row in self.rows:
+                self.assertEqual(
+                    encoder.encodeJson(row, self.now).decode('utf-8'),
+                    brewpiJson.formatRow(row, tiltColor, iSpindel, self.now))
+
+    def test_csvMatchesCsvLine(self):
+        for tiltColor, iSpindel in ((None, None), ('Red', None), (['Red', 'Black'], None), (None, 'Spindel')):
+            encoder = brewpiEncoder.getEncoder(tiltColor, iSpindel)
+            for row in self.rows:
+                self.assertEqual(
+                    encoder.encodeCsv(row, self.now).decode('utf-8'),
+                    brewpiDataLog.csvLine(row, self.now, tiltColor, iSpindel))
+
+    def test_tiltColors(self):
+        self.assertEqual(brewpiJson.columnIds('Red')[9:], ['RedSG'])
+        self.assertEqual(brewpiJson.columnIds(['Red', 'Black'])[9:],
+                         ['RedSG', 'RedTemp', 'RedBatt', 'BlackSG', 'BlackTemp', 'BlackBatt'])
+        self.assertTrue(brewpiDataLog.csvHeader(['Red']).endswith(',RedTilt SG,RedTilt Temp,RedTilt Batt\r\n'))
+        self.assertEqual(brewpiJson.compactScales(['RedSG', 'RedTemp', 'RedBatt']),
+                         [brewpiJson.SG_SCALE, brewpiJson.TEMP_SCALE, 1])
+
+    def test_encoderIsSharedPerSchema(self):
+        self.assertIs(brewpiEncoder.getEncoder('Red'), brewpiEncoder.getEncoder('Red'))
+        self.assertIs(brewpiEncoder.getEncoder(['Red']), brewpiEncoder.getEncoder(['Red']))
+        self.assertIsNot(brewpiEncoder.getEncoder('Red'), brewpiEncoder.getEncoder(['Red']))
+        self.assertIs(brewpiEncoder.getEncoder(None, 'a'), brewpiEncoder.getEncoder(None, 'b'))
+        self.assertIsNot(brewpiEncoder.getEncoder('Red'), brewpiEncoder.getEncoder('Blue'))
+
+    def test_compactRoundTrip(self):
+        encoder = brewpiEncoder.CompactEncoder('Red', None)
+        compact = {'format': 'compact', 'scale': encoder.scales, 'cols': [
+            {'id': column} for column in encoder.columns], 'rows': []}
+        google = {'cols': compact['cols'], 'rows': []}
+        for row in self.rows:
+            compact['rows'].append(simplejson.loads(encoder.encodeJson(row, self.now)))
+            google['rows'].append(simplejson.loads(brewpiJson.formatRow(row, 'Red', None, self.now)))
+        # The second row only holds differences to the first
+        self.assertEqual(compact['rows'][1][0], 0)
+        self.assertEqual(brewpiChart.compactToGoogle(compact), google)
+        self.assertEqual(brewpiChart.googleToCompact(google)['rows'], compact['rows'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..") # append parent directory to be able to import files
+import unittest
+import shutil
+import socket
+import tempfile
+import time
+from datetime import datetime
+from decimal import Decimal
+import brewpiPipeline
+import brewpiSinks
+
+
+def freePort():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server, self.received = brewpiSinks.standIn()
+        self.url = 'http://127.0.0.1:{0}/write'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def waitFor(self, condition):
+        for _ in range(200):
+            if condition():
+                return True
+            time.sleep(0.02)
+        return False
+
+    def test_readingLine(self):
+        record = brewpiPipeline.newRecord(
+            {'BeerTemp': 19.94, 'BeerAnn': 'Dry hop', 'State': 4, 'RedSG': Decimal('1.0500'),
+             'FridgeSet': None}, datetime.fromtimestamp(1580511909), 'My IPA, v2')
+        self.assertEqual(brewpiSinks.readingLine(record),
+                         'brewpi,beer=My\\ IPA\\,\\ v2 BeerTemp=19.94,RedSG=1.05,State=4.0 1580511909000000000')
+        record = brewpiPipeline.newRecord({'BeerAnn': 'Dry hop'}, beer='b')
+        self.assertIsNone(brewpiSinks.readingLine(record))
+
+    def test_throughput(self):
+        count = 5000
+        sink = brewpiSinks.LineProtocolSink(self.url, maxQueue=count, batchSize=500, batchWindow=0)
+        sink.start()
+        start = time.time()
+        for n in range(count):
+            sink.put(brewpiPipeline.newRecord({'BeerTemp': 20.0, 'n': n}, beer='b'))
+        sink.stop()
+        elapsed = time.time() - start
+        lines = b''.join(self.received).splitlines()
+        self.assertEqual(len(lines), count)
+        self.assertEqual(len(self.received), count // 500)
+        self.assertEqual(sink.stats()['dropped'], 0)
+        self.assertLess(elapsed, 10)
+
+    def test_spoolWhileDown(self):
+        spoolFile = os.path.join(self.path, 'export.spool')
+        sink = brewpiSinks.LineProtocolSink(
+            'http://127.0.0.1:{0}/write'.format(freePort()), spoolFile=spoolFile,
+            batchWindow=0, timeout=1)
+        sink.retries = 0
+        sink.start()
+        for n in range(3):
+            sink.put(brewpiPipeline.newRecord({'n': n}, beer='b'))
+        self.assertTrue(self.waitFor(lambda: sink.stats()['spooled'] == 3))
+
+        # The endpoint is back: the spool goes out first, in order
+        sink.url = self.url
+        sink.nextTry = 0
+        sink.put(brewpiPipeline.newRecord({'n': 3}, beer='b'))
+        self.assertTrue(self.waitFor(lambda: sink.stats()['lines'] == 4))
+        sink.stop()
+        values = [line.split(b' ')[1] for line in b''.join(self.received).splitlines()]
+        self.assertEqual(values, [b'n=0.0', b'n=1.0', b'n=2.0', b'n=3.0'])
+        self.assertFalse(os.path.exists(spoolFile))
+        self.assertEqual(sink.stats()['unspooled'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
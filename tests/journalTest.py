@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..") # append parent directory to be able to import files
+import shutil
+import tempfile
+import unittest
+import simplejson as json
+import brewpiDataLog
+import brewpiJournal
+import brewpiJson
+from datetime import datetime, timedelta
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.wwwDir = tempfile.mkdtemp()
+        self.jsonFileName = os.path.join(self.dir, 'Beer-20200101.json')
+        self.csvFileName = os.path.join(self.dir, 'Beer.csv')
+        self.wwwJsonFileName = os.path.join(self.wwwDir, 'Beer-20200101.json')
+        self.wwwCsvFileName = os.path.join(self.wwwDir, 'Beer.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        shutil.rmtree(self.wwwDir)
+
+    def newDataLog(self):
+        brewpiJson.newEmptyFile(self.jsonFileName, 'Red', None)
+        return brewpiDataLog.DataLog(
+            self.jsonFileName, self.csvFileName, self.wwwJsonFileName,
+            self.wwwCsvFileName, 'Red', None)
+
+    def row(self, temp):
+        return {'BeerTemp': temp, 'BeerSet': 20.0, 'BeerAnn': None,
+                'FridgeTemp': 18.0, 'FridgeSet': 19.0, 'FridgeAnn': None,
+                'RoomTemp': None, 'State': 1, 'RedSG': 1.050}
+
+    def test_recordRoundTrip(self):
+        record = brewpiJournal.encodeRecord({'t': 1.5, 'r': {'a': 1}})
+        self.assertEqual(brewpiJournal.decodeRecord(record), {'t': 1.5, 'r': {'a': 1}})
+
+    def test_truncatedRecordIsRejected(self):
+        record = brewpiJournal.encodeRecord({'t': 1.5, 'r': {'a': 1}})
+        self.assertIsNone(brewpiJournal.decodeRecord(record[:-4]))
+
+    def test_corruptRecordIsRejected(self):
+        record = brewpiJournal.encodeRecord({'t': 1.5, 'r': {'a': 1}})
+        self.assertIsNone(brewpiJournal.decodeRecord(record.replace(b'1.5', b'2.5')))
+
+    def test_cleanCloseRemovesJournal(self):
+        dataLog = self.newDataLog()
+        dataLog.addRow(self.row(20.0))
+        self.assertTrue(os.path.isfile(brewpiJournal.journalName(self.jsonFileName)))
+        dataLog.close()
+        self.assertFalse(os.path.isfile(brewpiJournal.journalName(self.jsonFileName)))
+
+    def test_recoverTornWrite(self):
+        dataLog = self.newDataLog()
+        start = datetime(2020, 1, 1, 12, 0, 0)
+        for i in range(3):
+            dataLog.addRow(self.row(20.0 + i), start + timedelta(minutes=i))
+        # Simulate a power cut: the last row is half written to both files
+        # and the journal holds one more reading
+        dataLog.journal.append((start + timedelta(minutes=3)).timestamp(), self.row(23.0))
+        dataLog.journal.close()
+        with open(self.jsonFileName, 'r+') as jsonFile:
+            jsonFile.truncate(os.path.getsize(self.jsonFileName) - 20)
+        with open(self.csvFileName, 'r+') as csvFile:
+            csvFile.truncate(os.path.getsize(self.csvFileName) - 10)
+
+        self.assertEqual(brewpiDataLog.recoverAll(self.dir), 2)
+        with open(self.jsonFileName) as jsonFile:
+            chart = json.load(jsonFile)
+        self.assertEqual([row['c'][1]['v'] for row in chart['rows']], [20.0, 21.0, 22.0, 23.0])
+        with open(self.csvFileName) as csvFile:
+            lines = csvFile.read().splitlines()
+        self.assertEqual(len(lines), 2 + 4)
+        self.assertTrue(os.path.isfile(self.wwwJsonFileName))
+        self.assertFalse(os.path.isfile(brewpiJournal.journalName(self.jsonFileName)))
+
+
+if __name__ == '__main__':
+    unittest.main()
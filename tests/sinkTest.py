@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..") # append parent directory to be able to import files
+import unittest
+import threading
+import time
+import brewpiPipeline
+
+
+class ListSink(brewpiPipeline.Sink):
+    name = 'list'
+
+    def __init__(self, **kwargs):
+        brewpiPipeline.Sink.__init__(self, **kwargs)
+        self.received = []
+        self.fail = 0
+        self.hold = threading.Event()
+        self.hold.set()
+
+    def write(self, batch):
+        self.hold.wait()
+        if self.fail:
+            self.fail -= 1
+            raise IOError("endpoint down")
+        self.received.append([record.row['n'] for record in batch])
+
+
+class SinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.hub = brewpiPipeline.SinkHub()
+
+    def tearDown(self):
+        self.hub.stop()
+
+    def addSink(self, **kwargs):
+        sink = ListSink(**kwargs)
+        sink.start()
+        self.hub.add(sink)
+        return sink
+
+    def test_publishReachesEverySink(self):
+        first = self.addSink()
+        second = self.addSink(batchSize=2)
+        for n in range(5):
+            self.assertEqual(self.hub.publish({'n': n}), 2)
+        self.hub.stop()
+        self.assertEqual(sum(first.received, []), list(range(5)))
+        self.assertEqual(sum(second.received, []), list(range(5)))
+        self.assertTrue(all(len(batch) <= 2 for batch in second.received))
+
+    def test_slowSinkDoesNotHoldUpOthers(self):
+        slow = self.addSink(maxQueue=2)
+        slow.hold.clear()
+        fast = self.addSink()
+        start = time.time()
+        for n in range(10):
+            self.hub.publish({'n': n})
+        self.assertLess(time.time() - start, 0.5)
+        slow.hold.set()
+        self.hub.stop()
+        self.assertEqual(sum(fast.received, []), list(range(10)))
+        self.assertGreater(slow.stats()['dropped'], 0)
+        self.assertTrue(self.hub.checkErrors())
+
+    def test_failedBatchIsRetried(self):
+        sink = self.addSink(retries=2, retryDelay=0.01)
+        sink.fail = 2
+        self.hub.publish({'n': 1})
+        for _ in range(100):
+            if sink.received:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sink.received, [[1]])
+        self.assertEqual(sink.stats()['retried'], 2)
+        self.assertEqual(sink.stats()['failed'], 0)
+
+    def test_settingNeverBlocks(self):
+        changed = []
+        stage = brewpiPipeline.PersistenceStage(lambda name, value: changed.append((name, value)), maxQueue=1)
+        stage.setting('isHighResTilt', True)
+        stage.setting('isHighResTilt', True)  # Unchanged, not queued again
+        self.assertEqual(stage.queue.qsize(), 1)
+        start = time.time()
+        stage.setting('isHighResTilt', False)  # Queue full, dropped
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(stage.stats()['dropped'], 1)
+        stage.start()
+        stage.setting('isHighResTilt', False)  # Sent again
+        stage.stop()
+        self.assertEqual(changed, [('isHighResTilt', True), ('isHighResTilt', False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/..") # append parent directory to be able to import files
+import unittest
+import datetime
+import random
+import shutil
+import tempfile
+import threading
+import time
+import simplejson
+from decimal import Decimal
+import aioblescan
+import Tilt
+
+
+class TiltBufferTestCase(unittest.TestCase):
+    def test_keepsCapacity(self):
+        buffer = Tilt.TiltBuffer(5)
+        for i in range(23):
+            buffer.append(i, 'aa', 5, 0, 60 + i, 1.0, 1)
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(list(buffer.view(buffer.timestamps)), [18, 19, 20, 21, 22])
+        self.assertEqual(list(buffer.view(buffer.temperatures)), [78, 79, 80, 81, 82])
+
+    def test_expire(self):
+        buffer = Tilt.TiltBuffer(100)
+        for i in range(10):
+            buffer.append(i, 'aa', 5, 0, 60, 1.0, 1)
+        buffer.expire(4)
+        self.assertEqual(list(buffer.view(buffer.timestamps)), [5, 6, 7, 8, 9])
+        buffer.expire(100)
+        self.assertEqual(len(buffer), 0)
+
+
+class SlidingMedianTestCase(unittest.TestCase):
+    def test_matchesMeanOfMedians(self):
+        rng = random.Random(3)
+        for window in (1, 2, 3, 10, 50):
+            median = Tilt.SlidingMedian(window)
+            kept = []
+            for _ in range(400):
+                if kept and rng.random() < 0.3:
+                    count = rng.randint(1, 5)
+                    median.expire(count)
+                    kept = kept[count:]
+                value = round(rng.gauss(1.050, 0.002), 4)
+                median.add(value)
+                kept.append(value)
+                self.assertAlmostEqual(median.value(), Tilt.meanOfMedians(kept, window), places=9)
+
+    def test_empty(self):
+        median = Tilt.SlidingMedian(3)
+        self.assertIsNone(median.value())
+        median.add(1)
+        median.expire(2)
+        self.assertIsNone(median.value())
+
+
+class DecodeTestCase(unittest.TestCase):
+    def test_matchesHciEvent(self):
+        for color, major, minor, txPower, evType in (('Red', 68, 1050, 3, 3), ('Pink', 681, 10512, 197, 0)):
+            data = Tilt.advertisement(color, major, minor, txPower, 'e8:ae:6b:42:cc:20', -71, evType)
+            reading = Tilt.decodeAdvertisement(data)
+            ev = aioblescan.HCI_Event()
+            ev.decode(data)
+            payload = ev.retrieve("Manufacturer Specific Data")[0].payload[1].val
+            self.assertEqual(reading.color, color)
+            self.assertEqual(reading.uuid, payload[2:18])
+            self.assertEqual(reading.major, major)
+            self.assertEqual(reading.minor, minor)
+            self.assertEqual(reading.txPower, txPower)
+            self.assertEqual(reading.mac, ev.retrieve("peer")[0].val)
+            self.assertEqual(reading.rssi, ev.retrieve("rssi")[-1].val)
+            self.assertEqual(reading.evType, int(ev.retrieve('ev type')[-1].val))
+
+    def test_rejectsOthers(self):
+        data = bytearray(Tilt.advertisement('Red', 68, 1050))
+        data[data.index(b'\xa4\x95')] = 0xb4  # Another iBeacon
+        self.assertIsNone(Tilt.decodeAdvertisement(bytes(data)))
+        self.assertIsNone(Tilt.decodeAdvertisement(b'\x04\x0e\x04\x01\x0c\x20\x00'))
+        self.assertIsNone(Tilt.decodeAdvertisement(Tilt.advertisement('Red', 68, 1050)[:20]))
+
+    def test_prefilter(self):
+        for flags in (True, False):
+            data = Tilt.advertisement('Red', 68, 1050, flags=flags)
+            self.assertTrue(Tilt.isTiltPacket(data))
+            self.assertEqual(Tilt.decodeAdvertisement(data).minor, 1050)
+        other = bytearray(Tilt.advertisement('Red', 68, 1050))
+        other[other.index(b'\xa4\x95')] = 0xb4
+        self.assertFalse(Tilt.isTiltPacket(bytes(other)))
+        self.assertFalse(Tilt.isTiltPacket(b'\x04\x0e\x04\x01\x0c\x20\x00'))
+
+        manager = Tilt.TiltManager(300, 0)
+        manager.blecallback(bytes(other))
+        manager.blecallback(Tilt.advertisement('Red', 68, 1050))
+        self.assertEqual(manager.stats(), {'accepted': 1, 'rejected': 1})
+
+    def test_callbackStores(self):
+        manager = Tilt.TiltManager(300, 0)
+        manager.blecallback(Tilt.advertisement('Blue', 681, 10512, 4))
+        value = manager.getValue('Blue')
+        self.assertAlmostEqual(value.temperature, 68.1)
+        self.assertAlmostEqual(value.gravity, 1.0512)
+        self.assertEqual(value.hwVersion, 4)
+        self.assertEqual(value.battery, 4)
+        self.assertIsNone(manager.getValue('Red'))
+
+
+class CalibrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.path, 'GRAVITY.red')
+        self.write('# Original, actual\n0.997, 0.999\n1.056, 1.060\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, data):
+        with open(self.fileName, 'w') as calFile:
+            calFile.write(data)
+
+    def test_fitIsApplied(self):
+        calibration = Tilt.TiltCalibration('gravity', 'Red', self.path)
+        self.assertAlmostEqual(float(calibration.apply(0.997)), 0.999)
+        self.assertEqual(list(calibration.apply([0.997, 1.056]).round(6)), [0.999, 1.06])
+        # No file, no calibration
+        self.assertEqual(float(Tilt.TiltCalibration('temperature', 'Red', self.path).apply(68)), 68.0)
+
+    def test_singlePointIsOffset(self):
+        self.write('67.5, 68\n')
+        calibration = Tilt.TiltCalibration('gravity', 'Red', self.path)
+        self.assertAlmostEqual(float(calibration.apply(60)), 60.5)
+
+    def test_fitIsCachedByContent(self):
+        Tilt.TiltCalibration('gravity', 'Red', self.path)
+        with open(self.fileName + '.fit') as fitFile:
+            fit = simplejson.load(fitFile)
+        fit['coefficients'] = [2.0, 0.0]
+        with open(self.fileName + '.fit', 'w') as fitFile:
+            simplejson.dump(fit, fitFile)
+        calibration = Tilt.TiltCalibration('gravity', 'Red', self.path)
+        self.assertAlmostEqual(float(calibration.apply(1.0)), 2.0)
+
+        # Changed content is fitted again
+        self.write('1.000, 1.002\n1.050, 1.052\n')
+        self.assertTrue(calibration.load())
+        self.assertAlmostEqual(float(calibration.apply(1.0)), 1.002)
+        self.assertFalse(calibration.load())
+
+    def test_untouchedFileIsNotRead(self):
+        calibration = Tilt.TiltCalibration('gravity', 'Red', self.path)
+        info = os.stat(self.fileName)
+        self.write('# Original, actual\n0.997, 0.999\n1.056, 1.070\n')
+        os.utime(self.fileName, ns=(info.st_atime_ns, info.st_mtime_ns))
+        self.assertFalse(calibration.load())
+        os.utime(self.fileName)
+        self.assertTrue(calibration.load())
+        self.assertAlmostEqual(float(calibration.apply(1.056)), 1.070)
+
+    def test_tiltIsCalibrated(self):
+        for medianWindow in (0, 3):
+            tilt = Tilt.Tilt('Red', 300, medianWindow, self.path)
+            now = datetime.datetime.now()
+            for gravity in (1.050, 1.050, 1.050):
+                tilt.setValues(now, 'aa:bb', 5, 0, 'Red', 68, gravity, 0)
+            expected = float(tilt.gravCal.apply(1.050))
+            self.assertAlmostEqual(tilt.getValues('Red').gravity, expected)
+            self.assertNotAlmostEqual(expected, 1.050, places=4)
+
+            # A new calibration applies to the readings already stored
+            self.write('1.050, 1.040\n')
+            self.assertTrue(tilt.calibrate())
+            self.assertAlmostEqual(tilt.getValues('Red').gravity, 1.040)
+            self.write('# Original, actual\n0.997, 0.999\n1.056, 1.060\n')
+
+
+class TiltTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.datetime.now()
+
+    def add(self, tilt, seconds, temperature, gravity, battery=3, hwVersion=5, fwVersion=0):
+        timestamp = self.now - datetime.timedelta(seconds=seconds)
+        tilt.setValues(timestamp, 'aa:bb', hwVersion, fwVersion, tilt.color,
+                       temperature, gravity, battery)
+
+    def test_average(self):
+        tilt = Tilt.Tilt('Red', 300)
+        self.add(tilt, 400, 90, Decimal('1.100'), battery=9)  # Expires
+        self.add(tilt, 30, 66, Decimal('1.050'), battery=197)
+        self.add(tilt, 20, 68, Decimal('1.052'), battery=4)
+        self.add(tilt, 10, 70, Decimal('1.054'), hwVersion=1, fwVersion=1002)
+        value = tilt.getValues('Red')
+        self.assertAlmostEqual(value.temperature, 68)
+        self.assertAlmostEqual(value.gravity, 1.052)
+        self.assertEqual(value.battery, 4)
+        self.assertEqual(value.hwVersion, 5)
+        self.assertEqual(value.fwVersion, 1002)
+        self.assertEqual(value.mac, 'aa:bb')
+        self.assertEqual(value.timestamp.replace(microsecond=0),
+                         (self.now - datetime.timedelta(seconds=10)).replace(microsecond=0))
+
+    def test_median(self):
+        tilt = Tilt.Tilt('Red', 300, 3)
+        for i, gravity in enumerate([1.050, 1.050, 1.090, 1.050, 1.050]):
+            self.add(tilt, 50 - i, 68, gravity)
+        value = tilt.getValues('Red')
+        # The spike is in every window but never its median
+        self.assertAlmostEqual(value.gravity, 1.050)
+        self.assertAlmostEqual(value.temperature, 68)
+
+    def test_empty(self):
+        self.assertIsNone(Tilt.Tilt('Red', 300).getValues('Red'))
+
+    def hammer(self, tilt, read, seconds=0.5):
+        # Store readings from one thread while another reads them, as the
+        # BLE thread and the main loop do
+        errors = []
+        stop = time.time() + seconds
+
+        def store():
+            try:
+                while time.time() < stop:
+                    self.now = datetime.datetime.now()
+                    self.add(tilt, random.random() * 1.5, 68, 1.050 + random.random() / 100)
+            except Exception as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=store)
+        writer.start()
+        try:
+            while time.time() < stop:
+                read()
+        except Exception as e:
+            errors.append(e)
+        writer.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(tilt.values.start, tilt.values.end)
+
+    def test_concurrentAverage(self):
+        tilt = Tilt.Tilt('Red', 1)
+        self.hammer(tilt, lambda: tilt.getValues('Red'))
+
+    def test_concurrentMedian(self):
+        tilt = Tilt.Tilt('Red', 1, 3)
+
+        def read():
+            tilt.getValues('Red')
+            tilt.resetMedians()
+
+        self.hammer(tilt, read)
+        with tilt.lock:
+            kept = tilt.values.view(tilt.values.gravities).tolist()
+            self.assertAlmostEqual(tilt.gravMedian.value(), Tilt.meanOfMedians(kept, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()